@@ -1,7 +1,9 @@
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import bcrypt  
-from db_utils import fetch_data, fetch_all_data, modify_data, fetch_latest_data, modify_and_return, get_connection
+from db_utils import fetch_data, fetch_all_data, modify_data, fetch_latest_data, modify_and_return, pool_stats, transaction, stream_all_data
+from db_utils import prepared_stats, register_query
+from db_utils import query_stats, metrics_text, replica_stats
 from datetime import datetime, timedelta
 import os
 import psycopg2
@@ -9,18 +11,34 @@ import traceback
 import threading
 import time
 import json
+import math
+import uuid
+from itertools import chain
 from pytz import timezone
 import gevent
+import numpy as np
 from greenlet import getcurrent
-from vitals_classifier import classify_temp, classify_respiration
+from vitals_classifier import classify_temp, classify_respiration, classify_temp_batch, classify_respiration_batch
 from ecg_realtime_processor import process_ecg_batch
 from flask import send_file
 from generate_pdf_report import create_pdf
+from partitions import start_partition_maintenance
+import ingest_queue
+import request_compression
+import dedupe_window
+import ingest_spool
+import ws_ingest
+import recent_readings
+import ecg_pool
+from binary_ingest import BINARY_MIMETYPE, VitalsColumns, decode_sensor_payload, decode_ecg_payload
+from demographics_cache import get_patient_demographics, get_shirt_demographics, invalidate_patient, invalidate_shirt, demographics_cache_stats
 from psycopg2.extras import execute_values
 from psycopg2.errors import UniqueViolation
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
+# gzip / deflate bodies on /sensor, /gateway/sensor and /ecg_batch
+app.wsgi_app = request_compression.DecompressRequestMiddleware(app.wsgi_app)
 
 # Store received sensor data (temporary storage for testing)
 sensor_data = {}
@@ -33,54 +51,68 @@ REFRESH_INTERVAL_SECONDS = 300
 
 PKT = timezone("Asia/Karachi")
 
+# Column order of the health_vitals value tuples built for insert_query
+HEALTH_VITALS_COLUMNS = ("timestamp", "ecg", "respiration_rate", "temperature", "patientid", "smartshirtid")
+
 @app.route('/')
 def home():
     return 'API is running!', 200
 
-def insert_postgres_only(sensor_data, ids):
-    try:
-        insert_query = """
-            INSERT INTO health_vitals (timestamp, ecg, respiration_rate, temperature, patientID, smartshirtID)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """
-        values = (
-            sensor_data["timestamp"],
-            sensor_data["ecg"],
-            sensor_data["respiration"],
-            sensor_data["temperature"],
-            ids["patient_id"],
-            ids["smartshirt_id"],
-        )
-
-        result = modify_and_return(insert_query, values)
-        if not result:
-            print("⚠️ Insert failed or returned no ID — skipping classification.")
-            return
-
-        hv_id = result["id"]
-        print(f"[SUCCESS] Inserted ECG record into Postgres with id={hv_id}")
-
-        # Only classify if insert succeeded
-        gevent.spawn_later(2, classify_and_insert_temp_status, sensor_data["temperature"], hv_id)
-        gevent.spawn_later(2, classify_and_insert_resp_status, sensor_data["respiration"], hv_id)
-
-    except psycopg2.errors.UniqueViolation:
-        print("⚠️ Duplicate entry blocked by DB constraint — skipping insert.")
-    except Exception as e:
-        print(f"❌ insert_postgres_only failed: {e}")
-        traceback.print_exc()
-
-def insert_multiple_postgres(sensor_list, ids):
-    try:
-        insert_query = """
-            INSERT INTO health_vitals (timestamp, ecg, respiration_rate, temperature, patientID, smartshirtID)
-            VALUES %s
-            ON CONFLICT DO NOTHING
-            RETURNING id
-        """
-
-        values = []
+# The per-reading INSERTs take their rows as one JSON array, so each is a single
+# fixed-shape statement that can be PREPAREd once per connection whatever the
+# batch size; json_populate_recordset types the fields from the table's own columns
+register_query("insert_health_vitals", """
+    INSERT INTO health_vitals (timestamp, ecg, respiration_rate, temperature, patientid, smartshirtid)
+    SELECT timestamp, ecg, respiration_rate, temperature, patientid, smartshirtid
+    FROM json_populate_recordset(NULL::health_vitals, %s::json)
+    ON CONFLICT DO NOTHING
+    RETURNING id, temperature, respiration_rate, smartshirtid, timestamp, ecg
+""")
+register_query("insert_temperature", """
+    INSERT INTO temperature (healthvitalsid, temperature, temperaturestatus, detecteddisease)
+    SELECT healthvitalsid, temperature, temperaturestatus, detecteddisease
+    FROM json_populate_recordset(NULL::temperature, %s::json)
+""")
+register_query("insert_respiration", """
+    INSERT INTO respiration (healthvitalsid, respiration, respirationstatus, detecteddisease)
+    SELECT healthvitalsid, respiration, respirationstatus, detecteddisease
+    FROM json_populate_recordset(NULL::respiration, %s::json)
+""")
+TEMPERATURE_COLUMNS = ("healthvitalsid", "temperature", "temperaturestatus", "detecteddisease")
+RESPIRATION_COLUMNS = ("healthvitalsid", "respiration", "respirationstatus", "detecteddisease")
+
+def _recordset_value(value):
+    # JSON has no NaN / Infinity (disconnected sensors send them); Postgres reads them from strings
+    if isinstance(value, float) and not math.isfinite(value):
+        return "NaN" if math.isnan(value) else ("Infinity" if value > 0 else "-Infinity")
+    return value
+
+def recordset_json(columns, rows):
+    """Value tuples as the JSON array of objects json_populate_recordset reads; datetimes as ISO 8601."""
+    return json.dumps(
+        [{column: _recordset_value(value) for column, value in zip(columns, row)} for row in rows],
+        default=lambda value: value.isoformat(), allow_nan=False,
+    )
+
+def insert_vitals_batches(batches):
+    """
+    Write readings from one or more shirts, each given as (sensor_list, ids);
+    sensor_list is a list of JSON readings or a binary-format VitalsColumns.
+    Inserts health_vitals and the temperature / respiration classifications in a
+    single transaction; raises on failure so the ingest queue can retry. A failed
+    classification only rolls back to a savepoint, so the readings still commit.
+    Returns {smartshirt id (text): rows inserted}; duplicates are not counted.
+    """
+    values = []
+    shirts = {}
+    for sensor_list, ids in batches:
+        # Stored demographics win over what the shirt sends; fall back to the payload
+        demographics = get_patient_demographics(ids["patient_id"]) or {"age": ids["age"], "gender": ids["gender"]}
+        # JSON may send the shirt id as a number or a string; key by its text form
+        shirts[str(ids["smartshirt_id"])] = {**demographics, "patient_id": ids["patient_id"]}
+        if isinstance(sensor_list, VitalsColumns):
+            values += sensor_list.rows(ids["patient_id"], ids["smartshirt_id"])
+            continue
         for sensor_data in sensor_list:
             utc_time = datetime.fromisoformat(sensor_data["timestamp"].replace("Z", "+00:00"))
             values.append((
@@ -92,58 +124,383 @@ def insert_multiple_postgres(sensor_list, ids):
                 ids["smartshirt_id"]
             ))
 
-        conn = get_connection()
-        cur = conn.cursor()
-        execute_values(cur, insert_query, values)
-        returned_ids = cur.fetchall()
-        conn.commit()
+    # Vitals plus their classifications commit together, one statement per table
+    with transaction() as tx:
+        # (id, temperature, respiration_rate, smartshirtid, timestamp, ecg) per inserted row
+        inserted = [
+            tuple(row.values())
+            for row in tx.execute_prepared("insert_health_vitals", (recordset_json(HEALTH_VITALS_COLUMNS, values),), fetch="all")
+        ]
 
-        inserted_count = len(returned_ids)
-        print(f"[SUCCESS] Inserted {inserted_count} batched readings")
+        print(f"[SUCCESS] Inserted {len(inserted)} of {len(values)} readings from {len(shirts)} shirt(s)")
 
-        # Classify only inserted entries
-        for hv_id, sensor_data in zip([row[0] for row in returned_ids], sensor_list[:inserted_count]):
-            gevent.spawn_later(1, classify_and_insert_temp_status, sensor_data["temperature"], hv_id)
-            gevent.spawn_later(1, classify_and_insert_resp_status, sensor_data["respiration"], hv_id)
+        # Age / gender thresholds differ per patient, so classify shirt by shirt
+        by_shirt = {}
+        for row in inserted:
+            by_shirt.setdefault(str(row[3]), []).append(row)
 
-    except UniqueViolation:
-        print("⚠️ One or more duplicate entries — some inserts skipped.")
-    except Exception as e:
-        print(f"❌ insert_multiple_postgres failed: {e}")
-        traceback.print_exc()
+        # A classification failure rolls back to the savepoint only: the raw
+        # readings still commit, without status rows
+        try:
+            with tx.savepoint("classify_batch"):
+                temp_rows, resp_rows = [], []
+                classified = []
+                for shirt_id, rows in by_shirt.items():
+                    demographics = shirts.get(shirt_id)
+                    if demographics is None:
+                        continue
+                    t, r = classify_inserted_batch(rows, demographics["age"], demographics["gender"])
+                    temp_rows += t
+                    resp_rows += r
+                    classified.append((shirt_id, demographics["patient_id"], rows, t, r))
+
+                if temp_rows:
+                    tx.execute_prepared("insert_temperature", (recordset_json(TEMPERATURE_COLUMNS, temp_rows),), fetch=None)
+                if resp_rows:
+                    tx.execute_prepared("insert_respiration", (recordset_json(RESPIRATION_COLUMNS, resp_rows),), fetch=None)
+            if inserted:
+                print(f"[SUCCESS] Classified batch: {len(temp_rows)} temperature, {len(resp_rows)} respiration rows")
+        except Exception as e:
+            print(f"❌ Classification failed, keeping {len(inserted)} unclassified readings: {e}")
+            traceback.print_exc()
+            classified = [
+                (shirt_id, shirts[shirt_id]["patient_id"], rows, [], [])
+                for shirt_id, rows in by_shirt.items() if shirt_id in shirts
+            ]
+
+        # Tell other workers' ring buffers that this patient has new readings
+        newest_by_patient, shirts_by_patient = {}, {}
+        for shirt_id, patient_id, rows, _, _ in classified:
+            key = str(uuid.UUID(str(patient_id)))
+            newest = recent_readings.newest_epoch_ms([row[4] for row in rows])
+            newest_by_patient[key] = max(newest, newest_by_patient.get(key, newest))
+            shirts_by_patient[key] = shirts_by_patient.get(key, 0) + 1
+        markers = recent_readings.bump_vitals_markers(tx, newest_by_patient)
+
+    # Committed; now the live views may show these readings
+    for shirt_id, patient_id, rows, t, r in classified:
+        key = str(uuid.UUID(str(patient_id)))
+        recent_readings.record_readings(
+            shirt_id, patient_id,
+            timestamps=[row[4] for row in rows],
+            ecg=[row[5] for row in rows],
+            resp=[row[2] for row in rows],
+            temp=[row[1] for row in rows],
+            temperature_status={"temperature": t[-1][1], "status": t[-1][2], "disease": t[-1][3]} if t else None,
+            respiration_status={"respiration": r[-1][1], "status": r[-1][2], "disease": r[-1][3]} if r else None,
+            # Two shirts of one patient share a marker bump; neither buffer saw it all
+            marker=markers.get(key) if shirts_by_patient[key] == 1 else None,
+        )
+    return {shirt_id: len(rows) for shirt_id, rows in by_shirt.items()}
+
+def classify_inserted_batch(inserted, age, gender):
+    """
+    Classify freshly inserted (id, temperature, respiration_rate, ...) rows in one
+    pass, using the patient's stored age and gender (the demographics cache; the
+    values sent with the batch only for an unknown patient). Disconnected sensors
+    (including NaN / inf values) and implausible values (temperature above 120 °F,
+    respiration of 5/min or less) get no status row.
+    """
+    hv_ids = [row[0] for row in inserted]
+    temps = np.asarray([row[1] for row in inserted], dtype=float)
+    resps = np.asarray([row[2] for row in inserted], dtype=float)
+
+    temp_statuses, temp_diseases = classify_temp_batch(temps, age, gender)
+    resp_statuses, resp_diseases = classify_respiration_batch(resps, age)
+
+    keep_temp = (temp_statuses != "Sensor Disconnected") & (temps <= 120)
+    keep_resp = (resp_statuses != "Sensor Disconnected") & (resps > 5.0)
+
+    temp_rows = [
+        (hv_ids[i], float(temps[i]), temp_statuses[i], temp_diseases[i])
+        for i in np.flatnonzero(keep_temp)
+    ]
+    resp_rows = [
+        (hv_ids[i], float(resps[i]), resp_statuses[i], resp_diseases[i])
+        for i in np.flatnonzero(keep_resp)
+    ]
+    return temp_rows, resp_rows
 
 @app.route('/sensor', methods=['POST'])
 def receive_sensor_data():
     try:
+        if request.mimetype == BINARY_MIMETYPE:  # Columnar binary batch
+            try:
+                columns, ids = decode_sensor_payload(request.get_data())
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            print(f"[BATCH RECEIVED] {len(columns)} readings (binary)")
+            return enqueue_response(columns, ids)
+
         data = request.get_json(force=True)
 
         if isinstance(data, list):  # Batch mode
             print(f"[BATCH RECEIVED] {len(data)} readings")
 
+            if not data or not isinstance(data[0], dict):
+                return jsonify({"error": "Expected a non-empty list of readings"}), 400
             required_fields = ["patient_id", "smartshirt_id", "age", "gender"]
             for field in required_fields:
                 if field not in data[0]:
                     return jsonify({"error": f"Missing '{field}' in readings"}), 400
 
-            ids = {
-                "patient_id": data[0]["patient_id"],
-                "smartshirt_id": data[0]["smartshirt_id"],
-                "age": int(data[0].get("age", 0)),
-                "gender": data[0].get("gender", "Male")
-            }
+            try:
+                ids = {
+                    "patient_id": data[0]["patient_id"],
+                    "smartshirt_id": data[0]["smartshirt_id"],
+                    "age": int(data[0].get("age", 0)),
+                    "gender": data[0].get("gender", "Male")
+                }
+            except (ValueError, TypeError):
+                return jsonify({"error": "'age' must be a number"}), 400
 
-            gevent.spawn(insert_multiple_postgres, data, ids)
-            return jsonify({"status": "batch_received", "count": len(data)}), 200
+            return enqueue_response(data, ids)
 
         # Otherwise fallback to single reading
-        process_single_sensor_reading(data)
-        return jsonify({"status": "success"}), 200
+        ids = process_single_sensor_reading(data)
+        if ids is None:
+            return jsonify({"status": "success"}), 200
+        return enqueue_response([data], ids)
 
     except Exception as e:
         print(f"[EXCEPTION] /sensor error: {e}")
         traceback.print_exc()
         return jsonify({"error": "Server error"}), 500
 
+SENSOR_READING_FIELDS = ("timestamp", "ecg_raw", "respiration", "temperature")
+
+def _finite_number(value, field):
+    if isinstance(value, bool):
+        raise ValueError(f"'{field}' is not a number")
+    number = float(value)
+    if not np.isfinite(number):
+        raise ValueError(f"'{field}' is not finite")
+    return number
+
+def validate_reading(reading):
+    """
+    Check one JSON reading and coerce its values, so one bad reading cannot fail
+    the transaction it is later merged into. Returns the reading with numeric
+    ecg_raw / respiration / temperature; raises ValueError (or TypeError).
+    """
+    if not isinstance(reading, dict):
+        raise ValueError("Reading is not an object")
+    missing = [field for field in SENSOR_READING_FIELDS if reading.get(field) is None]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}")
+    datetime.fromisoformat(reading["timestamp"].replace("Z", "+00:00"))
+    ecg = _finite_number(reading["ecg_raw"], "ecg_raw")
+    return {
+        **reading,
+        "ecg_raw": int(ecg) if ecg.is_integer() else ecg,
+        "respiration": _finite_number(reading["respiration"], "respiration"),
+        "temperature": _finite_number(reading["temperature"], "temperature"),
+    }
+
+def validate_ids(ids):
+    """
+    Check a shirt batch's ids before it is queued, so a bad id cannot fail the
+    coalesced write it would be merged into: patient_id must be a UUID and the
+    shirt must be registered to that patient. Returns the ids with the stored
+    age and gender; raises ValueError, or the database error if the lookup failed.
+    """
+    patient_id, smartshirt_id = ids.get("patient_id"), ids.get("smartshirt_id")
+    try:
+        patient_id = str(uuid.UUID(str(patient_id)))
+    except ValueError:
+        raise ValueError("'patient_id' is not a UUID") from None
+    if isinstance(smartshirt_id, bool) or not isinstance(smartshirt_id, (int, str)) or not str(smartshirt_id).strip():
+        raise ValueError("'smartshirt_id' must be a string or an integer")
+    shirt = get_shirt_demographics(smartshirt_id)
+    if not shirt or str(shirt["patient_id"]) != patient_id:
+        raise ValueError("SmartShirt is not registered to this patient")
+    return {
+        "patient_id": shirt["patient_id"],
+        "smartshirt_id": smartshirt_id,
+        "age": shirt["age"],
+        "gender": shirt["gender"],
+    }
+
+def ingest_readings(batch, ids):
+    """
+    Validate, dedupe, queue (or spool) one shirt's readings. Shared by /sensor and
+    the WebSocket channel; returns (result dict, HTTP status). Invalid JSON
+    readings are dropped and counted as "rejected"; if none are left, 400.
+    Ids that fail validate_ids reject the whole batch with 400.
+    A full queue answers 200 "spooled" (on local disk, not yet in Postgres) while
+    the spool is under its size limit, and 429 once it is not.
+    """
+    try:
+        ids = validate_ids(ids)
+    except ValueError as e:
+        return {"error": str(e), "rejected": len(batch)}, 400
+    except Exception as e:
+        print(f"❌ Shirt lookup failed for {ids.get('smartshirt_id')}: {e}")
+        return {"error": "Shirt lookup unavailable, retry later", "retry_after": ingest_queue.INGEST_RETRY_AFTER_SEC}, 503
+
+    # Binary batches arrive as typed columns; JSON readings are checked one by one
+    rejected = 0
+    if not isinstance(batch, VitalsColumns):
+        valid = []
+        for reading in batch:
+            try:
+                valid.append(validate_reading(reading))
+            except (ValueError, TypeError, AttributeError) as e:
+                rejected += 1
+                print(f"⚠️ Rejected reading from shirt {ids['smartshirt_id']}: {e}")
+        if not valid:
+            return {"error": "No valid readings", "rejected": rejected}, 400
+        batch = valid
+
+    # Readings seen recently from this shirt are retries; answer them without a DB trip
+    fresh = dedupe_window.new_readings(batch, ids["smartshirt_id"])
+    if not len(fresh):
+        return {"status": "duplicate", "count": 0, "duplicates": len(batch), "rejected": rejected}, 200
+
+    status = "batch_received"
+    refused = ingest_queue.submit(fresh, ids)
+    if refused:
+        # Queue full or shutting down: park the readings on disk for the replayer,
+        # unless the spool is already backed up too (ingest_spool.SpoolFull)
+        try:
+            ingest_spool.append(fresh, ids)
+            status = "spooled"
+        except Exception as e:
+            print(f"❌ Ingest spool append failed: {e}")
+            # 429 while the queue is full, 503 while this worker is shutting down
+            result = {"error": f"Ingest queue {refused}, retry later", "retry_after": ingest_queue.INGEST_RETRY_AFTER_SEC}
+            return result, 503 if refused == "draining" else 429
+
+    dedupe_window.remember(fresh, ids["smartshirt_id"])
+    return {"status": status, "count": len(fresh), "duplicates": len(batch) - len(fresh), "rejected": rejected}, 200
+
+def enqueue_response(batch, ids):
+    result, status = ingest_readings(batch, ids)
+    response = jsonify(result)
+    if "retry_after" in result:
+        response.headers["Retry-After"] = str(result["retry_after"])
+    return response, status
+
+GATEWAY_MAX_READINGS = int(os.getenv("GATEWAY_MAX_READINGS", 20000))
+
+@app.route('/gateway/sensor', methods=['POST'])
+def gateway_sensor():
+    """
+    Readings for many shirts in one body, for hubs relaying several shirts:
+      [{"smartshirt_id", "patient_id" (optional), "timestamp", "ecg_raw", "respiration", "temperature"}, ...]
+    or grouped: {"shirts": [{"smartshirt_id", "patient_id", "readings": [...]}, ...]}.
+    Each shirt is checked against the smartshirt → patient mapping and each
+    reading with validate_reading, then all shirts are written together (one
+    INSERT per table). Responds with per-shirt counts; an entry that is not an
+    object (or readings that are not a list) fails the whole body with 400.
+    """
+    try:
+        data = request.get_json(force=True)
+    except Exception:
+        return jsonify({"error": "Invalid JSON body"}), 400
+
+    # Group readings per shirt
+    grouped = {}
+    if isinstance(data, dict) and isinstance(data.get("shirts"), list):
+        for shirt in data["shirts"]:
+            if not isinstance(shirt, dict) or not isinstance(shirt.get("readings") or [], list):
+                return jsonify({"error": "Each shirt must be an object with a list of readings"}), 400
+            key = str(shirt.get("smartshirt_id"))
+            entry = grouped.setdefault(key, {"smartshirt_id": shirt.get("smartshirt_id"), "patient_id": shirt.get("patient_id"), "readings": []})
+            entry["readings"] += shirt.get("readings") or []
+    elif isinstance(data, list):
+        for reading in data:
+            if not isinstance(reading, dict):
+                return jsonify({"error": "Each reading must be an object"}), 400
+            key = str(reading.get("smartshirt_id"))
+            entry = grouped.setdefault(key, {"smartshirt_id": reading.get("smartshirt_id"), "patient_id": reading.get("patient_id"), "readings": []})
+            entry["readings"].append(reading)
+    else:
+        return jsonify({"error": "Expected a list of readings or {\"shirts\": [...]}"}), 400
+
+    if sum(len(entry["readings"]) for entry in grouped.values()) > GATEWAY_MAX_READINGS:
+        return jsonify({"error": f"At most {GATEWAY_MAX_READINGS} readings per request"}), 413
+
+    results = {}
+    batches = []
+    for key, entry in grouped.items():
+        result = results[key] = {"received": len(entry["readings"]), "accepted": 0, "rejected": 0, "duplicates": 0}
+
+        try:
+            shirt = get_shirt_demographics(entry["smartshirt_id"]) if entry["smartshirt_id"] is not None else None
+        except Exception as e:
+            # The database is down, not the shirt unknown: have the gateway resend it all
+            print(f"❌ Gateway shirt lookup failed for {entry['smartshirt_id']}: {e}")
+            return jsonify({"error": "Shirt lookup unavailable, retry later"}), 503, \
+                {"Retry-After": str(ingest_queue.INGEST_RETRY_AFTER_SEC)}
+        if not shirt:
+            result.update(rejected=result["received"], error="Unknown smartshirt_id")
+            continue
+        if entry["patient_id"] is not None and str(entry["patient_id"]) != str(shirt["patient_id"]):
+            result.update(rejected=result["received"], error="SmartShirt is not registered to this patient")
+            continue
+
+        valid = []
+        for reading in entry["readings"]:
+            try:
+                valid.append(validate_reading(reading))
+            except (ValueError, AttributeError, TypeError):
+                result["rejected"] += 1
+
+        ids = {
+            "patient_id": shirt["patient_id"],
+            "smartshirt_id": entry["smartshirt_id"],
+            "age": shirt["age"],
+            "gender": shirt["gender"],
+        }
+        fresh = dedupe_window.new_readings(valid, ids["smartshirt_id"])
+        result["duplicates"] = len(valid) - len(fresh)
+        if fresh:
+            batches.append((fresh, ids))
+
+    status = "written"
+    if batches:
+        try:
+            inserted = insert_vitals_batches(batches)
+        except Exception as e:
+            # Same fallback as the ingest queue: keep them on disk for the replayer
+            print(f"⚠️ Gateway write failed, spooling {len(batches)} shirt batch(es): {e}")
+            inserted = None
+            try:
+                for i, (batch, ids) in enumerate(batches):
+                    # One fsync covers them all; wait on it with the last one
+                    ingest_spool.append(batch, ids, wait=i == len(batches) - 1)
+                status = "spooled"
+            except Exception as spool_error:
+                print(f"❌ Gateway spool failed: {spool_error}")
+                # A full spool is backpressure (429, like /sensor); a failing disk is an outage
+                full = isinstance(spool_error, ingest_spool.SpoolFull)
+                error = "Ingest spool is full, retry later" if full else "Ingest unavailable, retry later"
+                return jsonify({"error": error, "shirts": results}), 429 if full else 503, \
+                    {"Retry-After": str(ingest_queue.INGEST_RETRY_AFTER_SEC)}
+
+        for batch, ids in batches:
+            key = str(ids["smartshirt_id"])
+            dedupe_window.remember(batch, ids["smartshirt_id"])
+            results[key]["accepted"] = len(batch)
+            if inserted is not None:
+                # Anything accepted but not inserted already existed in the table
+                results[key]["inserted"] = inserted.get(key, 0)
+
+    print(f"[GATEWAY] {len(grouped)} shirt(s), {sum(r['accepted'] for r in results.values())} readings accepted ({status})")
+    return jsonify({"status": status, "shirts": results}), 200
+
+def spool_dropped_readings(group):
+    # The writer gave up on these; keep them for the replayer
+    for batch, ids in group:
+        try:
+            # Already acknowledged, so this one may go past the spool's size limit
+            ingest_spool.append(batch, ids, wait=False, limit=False)
+        except Exception as e:
+            print(f"❌ Ingest spool append failed, {len(batch)} readings lost: {e}")
+            # Let the client's retry through at least
+            dedupe_window.forget(batch, ids["smartshirt_id"])
+
 def process_single_sensor_reading(data):
     try:
         ecg = data.get("ecg_raw")
@@ -161,14 +518,8 @@ def process_single_sensor_reading(data):
 
         print(f"[RECEIVED] ECG={ecg}, Resp={respiration}, Temp={temperature}, Time={raw_timestamp}, PID={patient_id}, SID={smartshirt_id}")
 
-        utc_time = datetime.fromisoformat(raw_timestamp.replace("Z", "+00:00"))
-
-        sensor_data = {
-            "ecg": ecg,
-            "respiration": respiration,
-            "temperature": temperature,
-            "timestamp": utc_time
-        }
+        # Reject a malformed timestamp here rather than in the writer
+        datetime.fromisoformat(raw_timestamp.replace("Z", "+00:00"))
 
         ids = {
             "patient_id": patient_id,
@@ -177,8 +528,8 @@ def process_single_sensor_reading(data):
             "gender": gender
         }
 
-        # Use gevent for async insert
-        gevent.spawn(insert_postgres_only, sensor_data, ids)
+        # Valid; /sensor queues it like a batch of one
+        return ids
 
     except Exception as e:
         print(f"❌ Failed to process reading: {e}")
@@ -187,12 +538,26 @@ def process_single_sensor_reading(data):
 @app.route("/ecg_batch", methods=["POST"])
 def ecg_batch():
     try:
-        data = request.get_json()
+        if request.mimetype == BINARY_MIMETYPE:
+            try:
+                data = decode_ecg_payload(request.get_data())
+            except (ValueError, KeyError) as e:
+                return jsonify({"error": f"Invalid binary ECG batch: {e}"}), 400
+        else:
+            data = request.get_json()
         if not data or not isinstance(data, list):
             return jsonify({"error": "Invalid request format — expected a list of ECG batches"}), 400
 
-        process_ecg_batch(data)
-        return jsonify({"message": "Batch processed successfully"}), 200
+        # Analysis runs in the ECG pool; the results land in the ecg table shortly after
+        try:
+            outcome = process_ecg_batch(data)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid ECG batch: {e}"}), 400
+        if outcome["rejected"]:
+            # Resend only the rejected shirts' windows; the rest are already queued
+            return jsonify({"error": "Some shirts could not be queued for ECG analysis, retry later", **outcome}), 429, \
+                {"Retry-After": str(ecg_pool.ECG_RETRY_AFTER_SEC)}
+        return jsonify({"message": "Batch accepted", **outcome}), 202
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -207,20 +572,13 @@ def register_patient():
         # Hash and decode password
         hashed_password = bcrypt.hashpw(data['password'].encode(), bcrypt.gensalt()).decode('utf-8')
 
-        # Insert user
-        sql_user = "INSERT INTO users (fullname, email, password, role) VALUES (%s, %s, %s, %s)"
-        modify_data(sql_user, (data['fullname'], email, hashed_password, 'patient'))
-
-        # Get user ID
-        sql_check_user = "SELECT userid FROM users WHERE email = %s"
-        user_check_result = fetch_data(sql_check_user, (email,))
-        if user_check_result is None:
-            return jsonify({"error": "Failed to retrieve UserID from users table"}), 500
-        user_id = user_check_result['userid']
+        # Insert user and patient atomically
+        with transaction() as tx:
+            sql_user = "INSERT INTO users (fullname, email, password, role) VALUES (%s, %s, %s, %s) RETURNING userid"
+            user_id = tx.fetch_one(sql_user, (data['fullname'], email, hashed_password, 'patient'))['userid']
 
-        # Insert patient
-        sql_patient = "INSERT INTO patients (userid, gender, age, contact, weight) VALUES (%s, %s, %s, %s, %s)"
-        modify_data(sql_patient, (user_id, data['gender'], data['age'], data['contact'], data['weight']))
+            sql_patient = "INSERT INTO patients (userid, gender, age, contact, weight) VALUES (%s, %s, %s, %s, %s)"
+            tx.execute(sql_patient, (user_id, data['gender'], data['age'], data['contact'], data['weight']))
 
         return jsonify({"message": "Patient registered successfully!"}), 201
     except Exception as e:
@@ -270,26 +628,20 @@ def register_specialist():
 
         hashed_password = bcrypt.hashpw(data['password'].encode(), bcrypt.gensalt()).decode('utf-8')
 
-        sql_user = """
-        INSERT INTO users (FullName, Email, Password, Role) 
-        VALUES (%s, %s, %s, %s)
-        """
-        modify_data(sql_user, (data['fullname'], email, hashed_password, 'specialist'))
-
-        sql_check_user = "SELECT userid FROM users WHERE email = %s"
-        user_check_result = fetch_data(sql_check_user, (email,))
-
-        if user_check_result is None:
-            return jsonify({"error": "Failed to retrieve UserID from users table"}), 500
-
-        user_id = user_check_result['userid']  
-        print(f"Retrieved UserID from users table: {user_id}")
+        with transaction() as tx:
+            sql_user = """
+            INSERT INTO users (FullName, Email, Password, Role) 
+            VALUES (%s, %s, %s, %s)
+            RETURNING userid
+            """
+            user_id = tx.fetch_one(sql_user, (data['fullname'], email, hashed_password, 'specialist'))['userid']
+            print(f"Retrieved UserID from users table: {user_id}")
 
-        sql_specialist = """
-        INSERT INTO health_specialist (userid, profession, speciality) 
-        VALUES (%s, %s, %s)
-        """
-        modify_data(sql_specialist, (user_id, data['profession'], data['speciality']))
+            sql_specialist = """
+            INSERT INTO health_specialist (userid, profession, speciality) 
+            VALUES (%s, %s, %s)
+            """
+            tx.execute(sql_specialist, (user_id, data['profession'], data['speciality']))
 
         return jsonify({"message": "Specialist registered successfully!"}), 201
     except Exception as e:
@@ -399,8 +751,9 @@ def register_mac():
             return jsonify({"message": "SmartShirt already registered!", "smartshirt_id": existing_entry['smartshirtid']}), 200
 
         # Register new SmartShirt
-        sql = "INSERT INTO smartshirt (patientid, devicemac, shirtstatus) VALUES (%s, %s, %s)"
-        modify_data(sql, (patient_id, mac_address, True))
+        sql = "INSERT INTO smartshirt (patientid, devicemac, shirtstatus) VALUES (%s, %s, %s) RETURNING smartshirtid"
+        shirt = modify_and_return(sql, (patient_id, mac_address, True))
+        invalidate_shirt(shirt["smartshirtid"])
 
         return jsonify({"message": "MAC registered successfully!"}), 201
 
@@ -454,8 +807,10 @@ def delete_smartshirt():
         if not mac:
             return jsonify({"error": "MAC address is required"}), 400
 
-        # Delete SmartShirt entry
-        modify_data("DELETE FROM smartshirt WHERE devicemac = %s", (mac,))
+        # Delete SmartShirt entry; this worker stops resolving it to its patient right away
+        deleted = modify_and_return("DELETE FROM smartshirt WHERE devicemac = %s RETURNING smartshirtid", (mac,))
+        if deleted:
+            invalidate_shirt(deleted["smartshirtid"])
         return jsonify({"message": "SmartShirt deleted"}), 200
     except Exception as e:
         return jsonify({"error": f"Failed to delete SmartShirt: {e}"}), 500
@@ -567,7 +922,6 @@ def update_patient_profile():
         SET fullname = %s, email = %s 
         WHERE userid = (SELECT userid FROM patients WHERE patientid = %s)
         """
-        modify_data(update_user_query, (full_name, email, patient_id))
 
         # **Update `patients` table (Gender, Age, Contact)**
         update_patient_query = """
@@ -575,7 +929,12 @@ def update_patient_profile():
         SET gender = %s, age = %s, contact = %s, weight = %s 
         WHERE patientid = %s
         """
-        modify_data(update_patient_query, (gender, age, contact, weight, patient_id))
+        with transaction() as tx:
+            tx.execute(update_user_query, (full_name, email, patient_id))
+            tx.execute(update_patient_query, (gender, age, contact, weight, patient_id))
+
+        # Age / gender may have changed; reload them on the next classification
+        invalidate_patient(patient_id)
 
         return jsonify({"message": "Profile updated successfully"}), 200
 
@@ -601,7 +960,6 @@ def update_specialist_profile():
         SET fullname = %s, email = %s 
         WHERE userid = (SELECT userid FROM health_specialist WHERE specialistid = %s)
         """
-        modify_data(update_user_query, (full_name, email, specialist_id))
 
         # Update Profession & Speciality in health_specialist
         update_specialist_query = """
@@ -609,7 +967,9 @@ def update_specialist_profile():
         SET profession = %s, speciality = %s
         WHERE specialistid = %s
         """
-        modify_data(update_specialist_query, (profession, speciality, specialist_id))
+        with transaction() as tx:
+            tx.execute(update_user_query, (full_name, email, specialist_id))
+            tx.execute(update_specialist_query, (profession, speciality, specialist_id))
 
         return jsonify({"message": "Specialist profile updated successfully"}), 200
 
@@ -770,7 +1130,6 @@ def get_patient_insights(patient_id):
         ORDER BY timestamp DESC 
         LIMIT 1
         """
-        vitals = fetch_data(sql_vitals, (patient_id,))
 
         # Fetch basic patient profile (like gender, age, weight)
         sql_profile = """
@@ -783,7 +1142,17 @@ def get_patient_insights(patient_id):
         JOIN users u ON p.userid = u.userid
         WHERE p.patientid = %s
         """
-        profile = fetch_data(sql_profile, (patient_id,))
+
+        # A streaming shirt's latest reading is already in memory
+        buffer = recent_readings.fresh_buffer_for_patient(patient_id)
+        if buffer:
+            vitals = buffer.latest()
+            profile = fetch_data(sql_profile, (patient_id,))
+        else:
+            # Both lookups are independent; the pool's wait callback lets two greenlets overlap them
+            vitals_job = gevent.spawn(fetch_data, sql_vitals, (patient_id,))
+            profile = fetch_data(sql_profile, (patient_id,))
+            vitals = vitals_job.get()
 
         if not profile:
             return jsonify({"error": "Patient profile not found"}), 404
@@ -830,36 +1199,29 @@ def classify_temp_status():
     classification = classify_temp(temp, age, gender)
     return jsonify(classification)
 
-def classify_and_insert_temp_status(temp_str, hv_id):
+def stream_trend_rows(rows):
+    """
+    Serialize trend rows as a JSON array one row at a time so large ranges never sit in memory.
+    The first row is fetched before the response starts, so a failing query is a 500; a failure
+    mid-stream aborts the response before the closing bracket, so it never parses as complete.
+    """
+    rows = iter(rows)
     try:
-        query = "SELECT hv.patientid, p.age, p.gender FROM health_vitals hv JOIN patients p ON hv.patientid = p.patientid WHERE hv.id = %s"
-        result = fetch_data(query, (hv_id,))
-        if not result:
-            print(f"[WARN] Skipping classification: hv_id {hv_id} not found")
-            return
-
-        age = result["age"]
-        gender = result["gender"]
-
-        temp = float(temp_str)
-        classification = classify_temp(temp, age, gender)
-
-        status = classification["status"]
-        disease = classification["disease"]
+        first = next(rows, None)
+    except Exception:
+        return jsonify({"error": "Server error"}), 500
 
-        if status == "Sensor Disconnected" or temp > 120:
-            # print(f"[SKIP] Temperature status '{status}' — not inserting")
+    def generate():
+        yield "["
+        if first is None:
+            yield "]"
             return
-
-        insert_query = """
-            INSERT INTO temperature (healthvitalsid, temperature, temperaturestatus, detecteddisease)
-            VALUES (%s, %s, %s, %s)
-        """
-        modify_data(insert_query, (hv_id, temp, status, disease))
-        print(f"[SUCCESS] Inserted temperature for hv_id {hv_id}")
-
-    except Exception as e:
-        print(f"❌ classify_and_insert_temp_status failed: {e}")
+        for i, row in enumerate(chain([first], rows)):
+            # Convert timestamps to ISO format
+            row["timestamp"] = row["timestamp"].astimezone(timezone("Asia/Karachi")).isoformat()
+            yield ("," if i else "") + app.json.dumps(row)
+        yield "]"
+    return Response(generate(), mimetype="application/json")
 
 @app.route('/temperature_trends', methods=['GET'])
 def get_temperature_trends():
@@ -885,13 +1247,8 @@ def get_temperature_trends():
         WHERE hv.patientID = %s AND hv.timestamp >= %s
         ORDER BY hv.timestamp ASC
     """
-    result = fetch_all_data(query, (patient_id, start_time))
-
-    # Convert timestamps to ISO format
-    for row in result:
-        row["timestamp"] = row["timestamp"].astimezone(timezone("Asia/Karachi")).isoformat()
-
-    return jsonify(result)
+    rows = stream_all_data(query, (patient_id, start_time), replica=True)
+    return stream_trend_rows(rows)
 
 @app.route("/classify_respiration_status", methods=["POST"])
 def classify_respiration_status():
@@ -901,41 +1258,6 @@ def classify_respiration_status():
     classification = classify_respiration(resp, age)
     return jsonify(classification)
 
-def classify_and_insert_resp_status(resp_str, hv_id):
-    try:
-        # Ensure health_vitals ID is valid
-        query = """
-            SELECT patients.age
-            FROM health_vitals
-            JOIN patients ON patients.patientid = health_vitals.patientid
-            WHERE health_vitals.id = %s
-        """
-        result = fetch_data(query, (hv_id,))
-        if not result:
-            print(f"[WARN] Skipping respiration classification: hv_id {hv_id} not linked to patient.")
-            return
-
-        age = int(result["age"])
-        resp = float(resp_str)
-        result = classify_respiration(resp, age)
-
-        status = result['status']
-        disease = result['disease']
-
-        if status == "Sensor Disconnected" or resp <= 5.0:
-            # print(f"[SKIP] Respiration status '{status}' — not inserting")
-            return
-
-        insert_query = """
-            INSERT INTO respiration (healthvitalsid, respiration, respirationstatus, detecteddisease)
-            VALUES (%s, %s, %s, %s)
-        """
-        modify_data(insert_query, (hv_id, resp, status, disease))
-        print(f"[SUCCESS] Inserted respiration for hv_id {hv_id}")
-
-    except Exception as e:
-        print(f"❌ classify_and_insert_resp_status failed: {e}")
-
 @app.route('/respiration_trends', methods=['GET'])
 def get_respiration_trends():
     patient_id = request.args.get("patient_id")
@@ -960,13 +1282,8 @@ def get_respiration_trends():
         WHERE hv.patientID = %s AND hv.timestamp >= %s
         ORDER BY hv.timestamp ASC
     """
-    result = fetch_all_data(query, (patient_id, start_time))
-
-    # Convert timestamps to ISO format
-    for row in result:
-        row["timestamp"] = row["timestamp"].astimezone(timezone("Asia/Karachi")).isoformat()
-
-    return jsonify(result)
+    rows = stream_all_data(query, (patient_id, start_time), replica=True)
+    return stream_trend_rows(rows)
 
 @app.route('/latest_ecg_status')
 def get_latest_ecg_status():
@@ -974,6 +1291,11 @@ def get_latest_ecg_status():
     if not patient_id:
         return jsonify({"error": "Missing patient_id"}), 400
 
+    buffer = recent_readings.fresh_buffer_for_patient(patient_id, ecg=True)
+    if buffer:
+        ecg = buffer.ecg_status
+        return jsonify({"bpm": ecg["bpm"], "ecgstatus": ecg["ecgstatus"]}), 200
+
     query = """
         SELECT e.bpm, e.ecgstatus
         FROM ecg e
@@ -988,6 +1310,15 @@ def get_latest_ecg_status():
 @app.route("/latest-ecg-segments/<patient_id>", methods=["GET"])
 def get_latest_ecg_segments(patient_id):
     try:
+        # Most rows carry BPM only; have the next window of this shirt fully delineated
+        smartshirt_id = recent_readings.shirt_for_patient(patient_id)
+        if smartshirt_id:
+            ecg_pool.request_full_analysis(smartshirt_id)
+
+        buffer = recent_readings.fresh_buffer_for_patient(patient_id, ecg=True)
+        if buffer:
+            return jsonify(buffer.ecg_status), 200
+
         query = """
             SELECT e.bpm, e.hrv, e.rr, e.pr, e.p, e.qrs, e.qt, e.qtc, e.ecgstatus
             FROM ecg e
@@ -1007,6 +1338,44 @@ def get_latest_ecg_segments(patient_id):
         print(f"❌ Error in /latest-ecg-segments: {e}")
         return jsonify({"error": "Server error"}), 500
 
+@app.route('/recent_vitals/<patient_id>', methods=['GET'])
+def get_recent_vitals(patient_id):
+    """Short window of raw readings (default 60 s, max 600 s) plus the latest classifications."""
+    try:
+        seconds = int(request.args.get("seconds", 60))
+    except ValueError:
+        return jsonify({"error": "'seconds' must be an integer"}), 400
+    seconds = max(0, min(seconds, 600))
+
+    # Served from memory only while no other worker has written this patient's readings
+    buffer = recent_readings.fresh_buffer_for_patient(patient_id, seconds)
+    if buffer:
+        rows = buffer.window(seconds)
+        classifications = {
+            "temperature": buffer.temperature_status,
+            "respiration": buffer.respiration_status,
+            "ecg": buffer.ecg_status,
+        }
+        source = "memory"
+    else:
+        rows = fetch_all_data("""
+            SELECT timestamp, ecg, respiration_rate, temperature
+            FROM health_vitals
+            WHERE patientid = %s
+              AND timestamp >= (SELECT max(timestamp) FROM health_vitals WHERE patientid = %s) - make_interval(secs => %s)
+            ORDER BY timestamp ASC
+        """, (patient_id, patient_id, seconds))
+        classifications = None
+        source = "database"
+
+    for row in rows:
+        row["timestamp"] = row["timestamp"].isoformat()
+    return jsonify({"source": source, "readings": rows, "classifications": classifications}), 200
+
+@app.route('/recent_readings_stats', methods=['GET'])
+def get_recent_readings_stats():
+    return jsonify(recent_readings.recent_readings_stats()), 200
+
 @app.route('/ecg_trends', methods=['GET'])
 def get_ecg_trends():
     patient_id = request.args.get("patient_id")
@@ -1031,13 +1400,8 @@ def get_ecg_trends():
         WHERE hv.patientID = %s AND hv.timestamp >= %s
         ORDER BY hv.timestamp ASC
     """
-    result = fetch_all_data(query, (patient_id, start_time))
-
-    # Convert timestamps to ISO format
-    for row in result:
-        row["timestamp"] = row["timestamp"].astimezone(timezone("Asia/Karachi")).isoformat()
-
-    return jsonify(result)
+    rows = stream_all_data(query, (patient_id, start_time), replica=True)
+    return stream_trend_rows(rows)
 
 def schedule_report_generation(patient_id, smartshirt_id, session_start, delay_sec=10):
     def task():
@@ -1087,7 +1451,34 @@ def generate_report():
         traceback.print_exc()
         return jsonify({"error": "Server error"}), 500
     
+INSERT_REPORT_SQL = """
+    INSERT INTO reports (
+        patient_id, smartshirt_id, session_start, session_end,
+        full_name, age, gender, weight,
+        avg_bpm, avg_temp, avg_resp,
+        temp_status, resp_status, ecg_status,
+        severity, recommendation,
+        recommendations_by_vital
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    RETURNING id
+"""
+
 def generate_report_logic(patient_id, smartshirt_id, session_start, session_end):
+    # Aggregate the session on a replica if one is close enough, then give that
+    # connection back before the report row is written on the primary, so a
+    # report never holds two pooled connections at once
+    with transaction(replica=True) as tx:
+        report_row, result = _summarize_session(tx, patient_id, smartshirt_id, session_start, session_end)
+    if report_row is None:
+        return result
+
+    with transaction() as tx:
+        report_id = tx.fetch_one(INSERT_REPORT_SQL, report_row)["id"]
+    return {"status": "success", "report_id": report_id, **result}
+
+def _summarize_session(tx, patient_id, smartshirt_id, session_start, session_end):
+    """Read and aggregate one session; returns (reports row values, response fields) or (None, error)."""
     # Fetch joined classified data within the session range
     query = """
         SELECT 
@@ -1104,34 +1495,45 @@ def generate_report_logic(patient_id, smartshirt_id, session_start, session_end)
         WHERE hv.patientid = %s AND hv.timestamp BETWEEN %s AND %s
 
     """
-    rows = fetch_all_data(query, (patient_id, session_start, session_end))
-    if not rows:
-        print("⚠️ No vitals found for session.")
-        return {"error": "No vitals found for session"}
+    from collections import Counter
 
-    bpms = [float(r["bpm"]) for r in rows if r["bpm"] not in [None, "", "-"]]
-    temps = [float(r["temperature"]) for r in rows if r["temperature"] not in [None, "", "-"]]
-    resps = [float(r["respiration"]) for r in rows if r["respiration"] not in [None, "", "-"]]
+    # Aggregate while streaming so a long session never materializes as a list
+    value_cols = {"bpm": "bpm", "temp": "temperature", "resp": "respiration"}
+    status_cols = {"ecg": "ecgstatus", "temp": "temperaturestatus", "resp": "respirationstatus"}
+    sums = {k: 0.0 for k in value_cols}
+    counts = {k: 0 for k in value_cols}
+    statuses = {k: Counter() for k in status_cols}
+    patient_info = None
+
+    for r in tx.stream(query, (patient_id, session_start, session_end)):
+        if patient_info is None:
+            patient_info = r
+        for key, col in value_cols.items():
+            if r[col] not in [None, "", "-"]:
+                sums[key] += float(r[col])
+                counts[key] += 1
+        for key, col in status_cols.items():
+            if r[col] not in [None, "", "Sensor Disconnected"]:
+                statuses[key][r[col]] += 1
+
+    if patient_info is None:
+        print("⚠️ No vitals found for session.")
+        return None, {"error": "No vitals found for session"}
 
-    ecg_statuses = [r["ecgstatus"] for r in rows if r["ecgstatus"] not in [None, "", "Sensor Disconnected"]]
-    temp_statuses = [r["temperaturestatus"] for r in rows if r["temperaturestatus"] not in [None, "", "Sensor Disconnected"]]
-    resp_statuses = [r["respirationstatus"] for r in rows if r["respirationstatus"] not in [None, "", "Sensor Disconnected"]]
+    bpm_avg = sums["bpm"] / counts["bpm"] if counts["bpm"] else None
+    temp_avg = sums["temp"] / counts["temp"] if counts["temp"] else None
+    resp_avg = sums["resp"] / counts["resp"] if counts["resp"] else None
 
-    bpm_avg = sum(bpms) / len(bpms) if bpms else None
-    temp_avg = sum(temps) / len(temps) if temps else None
-    resp_avg = sum(resps) / len(resps) if resps else None
+    def most_common(counter): return counter.most_common(1)[0][0] if counter else "-"
 
-    from collections import Counter
-    def most_common(statuses): return Counter(statuses).most_common(1)[0][0] if statuses else "-"
-
-    ecg_status = most_common(ecg_statuses)
-    temp_status = most_common(temp_statuses)
-    resp_status = most_common(resp_statuses)
+    ecg_status = most_common(statuses["ecg"])
+    temp_status = most_common(statuses["temp"])
+    resp_status = most_common(statuses["resp"])
 
     # Get specific recommendations
-    temp_rec = get_recommendation_by_vital("Temperature", temp_status)
-    resp_rec = get_recommendation_by_vital("Respiration", resp_status)
-    ecg_rec = get_recommendation_by_vital("ECG", ecg_status)
+    temp_rec = get_recommendation_by_vital("Temperature", temp_status, tx)
+    resp_rec = get_recommendation_by_vital("Respiration", resp_status, tx)
+    ecg_rec = get_recommendation_by_vital("ECG", ecg_status, tx)
 
     # Fallbacks
     default_title = "No Recommendation"
@@ -1164,7 +1566,6 @@ def generate_report_logic(patient_id, smartshirt_id, session_start, session_end)
     severity = most_critical_status if most_critical_status != "Normal" else "Normal"
     recommendation_title = recommendation[most_critical_vital]["title"]
 
-    patient_info = rows[0]
     # Collect ECG metrics dynamically
     ecg_metrics = {
         k: v for k, v in {
@@ -1178,19 +1579,7 @@ def generate_report_logic(patient_id, smartshirt_id, session_start, session_end)
         }.items() if v not in [None, "", "-"]
     }
 
-    insert_query = """
-        INSERT INTO reports (
-            patient_id, smartshirt_id, session_start, session_end,
-            full_name, age, gender, weight,
-            avg_bpm, avg_temp, avg_resp,
-            temp_status, resp_status, ecg_status,
-            severity, recommendation,
-            recommendations_by_vital
-        )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-    """
-    report_id = modify_and_return(insert_query, (
+    report_row = (
         patient_id, smartshirt_id, session_start, session_end,
         patient_info["fullname"], patient_info["age"], patient_info["gender"], patient_info["weight"],
         round(bpm_avg, 1) if bpm_avg else None,
@@ -1198,12 +1587,10 @@ def generate_report_logic(patient_id, smartshirt_id, session_start, session_end)
         round(resp_avg, 1) if resp_avg else None,
         temp_status, resp_status, ecg_status,
         severity, recommendation_title,
-        json.dumps(recommendation) 
-    ))["id"]
+        json.dumps(recommendation)
+    )
 
-    return {
-        "status": "success",
-        "report_id": report_id,
+    return report_row, {
         "severity": severity,
         "recommendation": recommendation_title,  # main summary
         "recommendations_by_vital": recommendation,  # per-vital details
@@ -1270,7 +1657,8 @@ def get_reports():
         ORDER BY session_end DESC
 
     """
-    rows = fetch_all_data(query, (patient_id, start_time))
+    # Listing reports tolerates replica lag like generating them does
+    rows = fetch_all_data(query, (patient_id, start_time), replica=True)
 
     # Format timestamp fields to ISO 8601 with +05:00
     for row in rows:
@@ -1305,12 +1693,12 @@ def get_priority_index(status):
         order = ["Critical", "Very High", "High", "Low", "Slow", "Rapid", "Elevated", "Below Normal", "Unknown", "Normal"]
         return order.index(status) if status in order else len(order)
 
-def get_recommendation_by_vital(vital_name, status):
+def get_recommendation_by_vital(vital_name, status, tx=None):
     query = """
         SELECT title, message FROM recommendations
         WHERE vital_name = %s AND status = %s AND active = TRUE
     """
-    rec = fetch_data(query, (vital_name, status))
+    rec = tx.fetch_one(query, (vital_name, status)) if tx else fetch_data(query, (vital_name, status))
     
     if not rec:
         print(f"⚠️ No recommendation found for {vital_name} with status '{status}'")
@@ -1327,6 +1715,57 @@ def testhook():
 def ping():
     return jsonify({"status": "online"}), 200
 
+@app.route('/db_pool_stats', methods=['GET'])
+def db_pool_stats():
+    return jsonify({**pool_stats(), "replicas": replica_stats()}), 200
+
+@app.route('/db_prepared_stats', methods=['GET'])
+def db_prepared_stats():
+    return jsonify(prepared_stats()), 200
+
+@app.route('/db_query_stats', methods=['GET'])
+def db_query_stats():
+    return jsonify(query_stats()), 200
+
+@app.route('/demographics_cache_stats', methods=['GET'])
+def get_demographics_cache_stats():
+    return jsonify(demographics_cache_stats()), 200
+
+@app.route('/ingest_stats', methods=['GET'])
+def get_ingest_stats():
+    return jsonify({
+        **ingest_queue.ingest_stats(),
+        "compression": request_compression.compression_stats(),
+        "dedupe": dedupe_window.dedupe_stats(),
+    }), 200
+
+@app.route('/ws_ingest_stats', methods=['GET'])
+def get_ws_ingest_stats():
+    return jsonify(ws_ingest.ws_ingest_stats()), 200
+
+@app.route("/ecg_pool_stats", methods=["GET"])
+def get_ecg_pool_stats():
+    return jsonify(ecg_pool.ecg_pool_stats()), 200
+
+@app.route('/ingest_spool_status', methods=['GET'])
+def get_ingest_spool_status():
+    return jsonify(ingest_spool.spool_status()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(metrics_text() + ingest_queue.metrics_text() + request_compression.metrics_text() + ecg_pool.metrics_text(), mimetype="text/plain; version=0.0.4")
+
+# Keep future health_vitals partitions ready and expire old ones
+start_partition_maintenance()
+
+# Writers for /sensor; gunicorn.conf.py drains them on worker shutdown
+ingest_queue.start(insert_vitals_batches, on_drop=spool_dropped_readings)
+# Fsyncs spooled readings and replays them once Postgres is back
+ingest_spool.start(insert_vitals_batches)
+
+# Socket.IO /ingest namespace: long-lived per-shirt streams into the same pipeline
+ws_ingest.init_app(app, ingest_readings)
+
 @app.before_request
 def log_start():
     print(f"[greenlet-{id(getcurrent())}] ▶️ {datetime.now()} {request.method} {request.path}")
@@ -1342,4 +1781,9 @@ if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     print(f"🌐 Starting dev server on port {port}")
     http_server = WSGIServer(('0.0.0.0', port), app)
-    http_server.serve_forever()
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        ingest_queue.drain()
+        ingest_spool.close()
+        ecg_pool.stop()
@@ -0,0 +1,46 @@
+"""
+Per-window cost of wavelet denoising one window at a time (wavelet_denoise)
+versus stacked across shirts (wavelet_denoise_batch), at growing fleet sizes.
+
+Usage (from flask_backend/):
+    python benchmarks/bench_batch_denoise.py [block_samples] [repeats]
+
+block_samples defaults to what ECGStream denoises per hop: ECG_HOP_SIZE plus
+ECG_DENOISE_MARGIN on both sides.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+from ecg_analysis import wavelet_denoise, wavelet_denoise_batch, ECG_HOP_SIZE, ECG_DENOISE_MARGIN
+
+FLEET_SIZES = (1, 10, 100, 1000)
+
+def timed(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def main():
+    block = int(sys.argv[1]) if len(sys.argv) > 1 else ECG_HOP_SIZE + 2 * ECG_DENOISE_MARGIN
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rng = np.random.default_rng(0)
+
+    print(f"windows of {block} samples, best of {repeats}")
+    for n in FLEET_SIZES:
+        windows = [rng.normal(size=block) for _ in range(n)]
+        batched = wavelet_denoise_batch(windows)
+        assert all(np.allclose(b, wavelet_denoise(w)) for b, w in zip(batched, windows))
+
+        loop_s = timed(lambda: [wavelet_denoise(w) for w in windows], repeats)
+        batch_s = timed(lambda: wavelet_denoise_batch(windows), repeats)
+        print(f"  {n:>5} shirts   one at a time {loop_s / n * 1e6:8.1f} µs/window   "
+              f"batched {batch_s / n * 1e6:8.1f} µs/window   ×{loop_s / batch_s:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compare the two ECG analysis tiers on nk.ecg_simulate windows: time per window
+and BPM error against the simulated heart rate.
+
+  full  wavelet_denoise → nk.ecg_clean → nk.ecg_process → nk.hrv_time (every
+        window before the fast path existed; still what a delineated row costs)
+  fast  wavelet_denoise → causal highpass → detect_r_peaks → BPM, RR, quality
+
+Usage (from flask_backend/):
+    python benchmarks/bench_ecg_tiers.py [sampling_rate] [window_samples] [repeats]
+
+The shirts' nominal 11 Hz is too low for either tier to find QRS complexes, so
+the default is 250 Hz.
+"""
+import os
+import sys
+import time
+import warnings
+
+# ecg_analysis builds its highpass for ECG_SAMPLING_RATE at import
+SAMPLING_RATE = int(sys.argv[1]) if len(sys.argv) > 1 else 250
+os.environ["ECG_SAMPLING_RATE"] = str(SAMPLING_RATE)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import neurokit2 as nk
+from scipy.signal import sosfilt, sosfilt_zi
+from ecg_analysis import wavelet_denoise, detect_r_peaks, rr_quality, _HIGHPASS
+
+warnings.filterwarnings("ignore")
+
+HEART_RATES = (50, 72, 95, 130)
+
+def make_windows(window, per_rate=5):
+    windows = []
+    for hr in HEART_RATES:
+        signal = nk.ecg_simulate(duration=window * per_rate / SAMPLING_RATE + 1, sampling_rate=SAMPLING_RATE,
+                                 heart_rate=hr, noise=0.05, random_state=hr)
+        raw = 2048 + signal * 200
+        windows += [(hr, raw[i * window:(i + 1) * window]) for i in range(per_rate)]
+    return windows
+
+def full_tier(raw):
+    ecg_mv = (raw - 2048) / 200.0
+    cleaned = nk.ecg_clean(wavelet_denoise(ecg_mv), sampling_rate=SAMPLING_RATE)
+    signals, info = nk.ecg_process(cleaned, sampling_rate=SAMPLING_RATE)
+    nk.hrv_time(signals, sampling_rate=SAMPLING_RATE)
+    return float(np.mean(signals["ECG_Rate"]))
+
+def fast_tier(raw):
+    ecg_mv = (raw - 2048) / 200.0
+    denoised = wavelet_denoise(ecg_mv)
+    cleaned, _ = sosfilt(_HIGHPASS, denoised, zi=sosfilt_zi(_HIGHPASS) * denoised[0])
+    rr = np.diff(detect_r_peaks(cleaned, SAMPLING_RATE)) * 1000 / SAMPLING_RATE
+    rr_quality(rr)
+    return float(np.mean(60000 / rr)) if len(rr) else float("nan")
+
+def attempt(tier, raw):
+    try:
+        return tier(raw)
+    except Exception:
+        return float("nan")   # neurokit gives up on windows it cannot delineate
+
+def run(tier, windows, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        bpms = [attempt(tier, raw) for _, raw in windows]
+        best = min(best, time.perf_counter() - started)
+    errors = [abs(bpm - hr) for (hr, _), bpm in zip(windows, bpms) if not np.isnan(bpm)]
+    return best * 1000 / len(windows), (float(np.mean(errors)) if errors else float("nan")), len(errors)
+
+def main():
+    window = int(sys.argv[2]) if len(sys.argv) > 2 else 10 * SAMPLING_RATE
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    windows = make_windows(window)
+
+    print(f"{len(windows)} windows of {window} samples at {SAMPLING_RATE} Hz "
+          f"(heart rates {', '.join(map(str, HEART_RATES))}), best of {repeats}")
+    results = {}
+    for name, tier in (("full", full_tier), ("fast", fast_tier)):
+        ms, error, ok = run(tier, windows, repeats)
+        results[name] = ms
+        print(f"  {name}  {ms:9.3f} ms/window   mean |BPM error| {error:5.2f}   ({ok}/{len(windows)} windows with a rate)")
+    print(f"  fast tier ×{results['full'] / results['fast']:.0f} cheaper")
+
+if __name__ == "__main__":
+    main()
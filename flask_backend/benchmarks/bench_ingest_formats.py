@@ -0,0 +1,78 @@
+"""
+Compare the JSON and binary (msgpack columnar) /sensor bodies: payload size and
+the server-side work of turning a body into health_vitals value tuples.
+
+Usage (from flask_backend/):
+    python benchmarks/bench_ingest_formats.py [readings_per_batch] [repeats]
+"""
+import os
+import sys
+import json
+import time
+import random
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from binary_ingest import encode_sensor_payload, decode_sensor_payload
+
+def make_readings(n):
+    start = datetime.now(timezone.utc)
+    return [
+        {
+            "ecg_raw": random.randint(1800, 2300),
+            "respiration": round(random.uniform(10, 22), 2),
+            "temperature": round(random.uniform(96, 101), 2),
+            "timestamp": (start + timedelta(milliseconds=100 * i)).isoformat().replace("+00:00", "Z"),
+            "patient_id": 42,
+            "smartshirt_id": 7,
+            "age": 35,
+            "gender": "Female",
+        }
+        for i in range(n)
+    ]
+
+def parse_json(body):
+    # What /sensor + insert_vitals_batches do for a JSON batch
+    data = json.loads(body)
+    ids = (data[0]["patient_id"], data[0]["smartshirt_id"])
+    return [
+        (
+            datetime.fromisoformat(r["timestamp"].replace("Z", "+00:00")),
+            r["ecg_raw"], r["respiration"], r["temperature"], *ids,
+        )
+        for r in data
+    ]
+
+def parse_binary(body):
+    columns, ids = decode_sensor_payload(body)
+    return columns.rows(ids["patient_id"], ids["smartshirt_id"])
+
+def timed(fn, body, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn(body)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    readings = make_readings(n)
+    json_body = json.dumps(readings).encode()
+    binary_body = encode_sensor_payload(readings)
+
+    assert len(parse_json(json_body)) == len(parse_binary(binary_body)) == n
+
+    json_ms = timed(parse_json, json_body, repeats)
+    binary_ms = timed(parse_binary, binary_body, repeats)
+    decode_only_ms = timed(decode_sensor_payload, binary_body, repeats)
+
+    print(f"{n} readings, best of {repeats}")
+    print(f"  JSON    {len(json_body):>9,} bytes   parse → rows {json_ms:8.3f} ms")
+    print(f"  binary  {len(binary_body):>9,} bytes   parse → rows {binary_ms:8.3f} ms   (decode to arrays {decode_only_ms:.3f} ms)")
+    print(f"  size  ×{len(json_body) / len(binary_body):.1f} smaller, parse ×{json_ms / binary_ms:.1f} faster")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import time
+from datetime import datetime, timezone
+import msgpack
+import numpy as np
+
+# --------------------- Compact Binary Ingest Format ---------------------------
+#
+# Alternative to the JSON bodies of /sensor and /ecg_batch. A msgpack map carries
+# the per-shirt fields once and each sample column as one packed little-endian
+# array, which decodes straight into NumPy without touching individual values.
+#
+# /sensor  (Content-Type: application/x-vitals-msgpack)
+#   {"v": 1, "patient_id", "smartshirt_id", "age", "gender",
+#    "ts":   <int64 epoch millis, UTC>,
+#    "ecg":  <uint16 raw ADC>,
+#    "resp": <float32 breaths/min>,
+#    "temp": <float32 °F>}
+#
+# /ecg_batch  (same content type)
+#   {"v": 1, "shirts": [{"smartshirt_id", "age", "gender", "ecg": <uint16 raw ADC>,
+#                        "offset" (optional, index of the first sample in the shirt's stream)}, ...]}
+#
+# Decoding rejects the whole body (ValueError, a 400) rather than let a bad value
+# through to the coalesced write: resp / temp must be finite, ts within
+# [MIN_TS_MS, now + MAX_FUTURE_MS] and age a non-negative integer.
+
+BINARY_MIMETYPE = "application/x-vitals-msgpack"
+FORMAT_VERSION = 1
+
+SENSOR_COLUMNS = {"ts": "<i8", "ecg": "<u2", "resp": "<f4", "temp": "<f4"}
+ECG_DTYPE = "<u2"
+MIN_TS_MS = 946_684_800_000          # 2000-01-01T00:00:00Z
+MAX_FUTURE_MS = 24 * 3600 * 1000     # shirt clocks may run ahead by up to a day
+
+class VitalsColumns:
+    """One shirt's readings as parallel NumPy arrays; len() is the reading count."""
+    def __init__(self, ts_ms, ecg, resp, temp):
+        self.ts_ms = ts_ms
+        self.ecg = ecg
+        self.resp = resp
+        self.temp = temp
+
+    def __len__(self):
+        return len(self.ts_ms)
+
+    def take(self, indices):
+        return VitalsColumns(self.ts_ms[indices], self.ecg[indices], self.resp[indices], self.temp[indices])
+
+    def rows(self, patient_id, smartshirt_id):
+        """health_vitals value tuples, in HEALTH_VITALS_COLUMNS order."""
+        timestamps = [datetime.fromtimestamp(ms / 1000, tz=timezone.utc) for ms in self.ts_ms.tolist()]
+        # float32 on the wire; round so 98.6 is not stored as 98.59999847
+        resp = np.round(self.resp.astype(np.float64), 2).tolist()
+        temp = np.round(self.temp.astype(np.float64), 2).tolist()
+        return [
+            (ts, ecg, r, t, patient_id, smartshirt_id)
+            for ts, ecg, r, t in zip(timestamps, self.ecg.tolist(), resp, temp)
+        ]
+
+def _unpack(body):
+    try:
+        payload = msgpack.unpackb(body, raw=False)
+    except Exception as e:
+        raise ValueError(f"Invalid msgpack body: {e}")
+    if not isinstance(payload, dict) or payload.get("v") != FORMAT_VERSION:
+        raise ValueError(f"Expected a version {FORMAT_VERSION} payload")
+    return payload
+
+def _array(payload, key, dtype):
+    raw = payload.get(key)
+    if not isinstance(raw, bytes) or len(raw) % np.dtype(dtype).itemsize:
+        raise ValueError(f"'{key}' must be packed {dtype} bytes")
+    return np.frombuffer(raw, dtype=dtype)
+
+def _age(value):
+    # msgpack has a real nil and bool; int() would take True or fail on None with a TypeError
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError("'age' must be a non-negative integer")
+    return value
+
+def _check_columns(columns):
+    if len({len(columns.ts_ms), len(columns.ecg), len(columns.resp), len(columns.temp)}) != 1:
+        raise ValueError("Sample arrays differ in length")
+    if not (np.isfinite(columns.resp).all() and np.isfinite(columns.temp).all()):
+        raise ValueError("'resp' and 'temp' must be finite")
+    newest_allowed = int(time.time() * 1000) + MAX_FUTURE_MS
+    if len(columns) and (columns.ts_ms.min() < MIN_TS_MS or columns.ts_ms.max() > newest_allowed):
+        raise ValueError("'ts' holds a timestamp out of range")
+
+def decode_sensor_payload(body):
+    """Decode a binary /sensor body into (VitalsColumns, ids); raises ValueError."""
+    payload = _unpack(body)
+    for field in ("patient_id", "smartshirt_id", "age", "gender"):
+        if field not in payload:
+            raise ValueError(f"Missing '{field}' in payload")
+
+    columns = VitalsColumns(*(_array(payload, key, dtype) for key, dtype in SENSOR_COLUMNS.items()))
+    _check_columns(columns)
+
+    ids = {
+        "patient_id": payload["patient_id"],
+        "smartshirt_id": payload["smartshirt_id"],
+        "age": _age(payload["age"]),
+        "gender": payload["gender"],
+    }
+    return columns, ids
+
+def decode_ecg_payload(body):
+    """
+    Decode a binary /ecg_batch body into the list-of-dicts shape process_ecg_batch
+    takes; raises ValueError (the offsets are checked by process_ecg_batch).
+    """
+    payload = _unpack(body)
+    shirts = payload.get("shirts", [])
+    if not isinstance(shirts, list):
+        raise ValueError("'shirts' must be a list")
+    batch = []
+    for shirt in shirts:
+        if not isinstance(shirt, dict):
+            raise ValueError("Each shirt must be a map")
+        for field in ("smartshirt_id", "age", "gender"):
+            if field not in shirt:
+                raise ValueError(f"Missing '{field}' in shirt")
+        batch.append({
+            "smartshirt_id": shirt["smartshirt_id"],
+            "age": _age(shirt["age"]),
+            "gender": shirt["gender"],
+            "ecg_values": _array(shirt, "ecg", ECG_DTYPE),
+            "offset": shirt.get("offset"),
+        })
+    return batch
+
+# --------------------- Encoders (clients, benchmark) ---------------------------
+
+def encode_sensor_payload(readings):
+    """Pack JSON-style /sensor readings (all from one shirt) into the binary format."""
+    first = readings[0]
+    ts_ms = [
+        int(datetime.fromisoformat(r["timestamp"].replace("Z", "+00:00")).timestamp() * 1000)
+        for r in readings
+    ]
+    return msgpack.packb({
+        "v": FORMAT_VERSION,
+        "patient_id": first["patient_id"],
+        "smartshirt_id": first["smartshirt_id"],
+        "age": int(first["age"]),
+        "gender": first["gender"],
+        "ts": np.asarray(ts_ms, dtype=SENSOR_COLUMNS["ts"]).tobytes(),
+        "ecg": np.asarray([r["ecg_raw"] for r in readings], dtype=SENSOR_COLUMNS["ecg"]).tobytes(),
+        "resp": np.asarray([r["respiration"] for r in readings], dtype=SENSOR_COLUMNS["resp"]).tobytes(),
+        "temp": np.asarray([r["temperature"] for r in readings], dtype=SENSOR_COLUMNS["temp"]).tobytes(),
+    }, use_bin_type=True)
+
+def encode_ecg_payload(batch):
+    return msgpack.packb({
+        "v": FORMAT_VERSION,
+        "shirts": [
+            {
+                "smartshirt_id": entry["smartshirt_id"],
+                "age": entry["age"],
+                "gender": entry["gender"],
+                "ecg": np.asarray(entry["ecg_values"], dtype=ECG_DTYPE).tobytes(),
+                "offset": entry.get("offset"),
+            }
+            for entry in batch
+        ],
+    }, use_bin_type=True)
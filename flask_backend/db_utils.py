@@ -1,98 +1,599 @@
 import os
+import re
+import time
+import hashlib
+from bisect import bisect_left
+from collections import deque
+import threading
+import uuid
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor, execute_values
+from gevent import monkey, Timeout
+from gevent.socket import wait_read, wait_write
 
 # --------------------- PostgreSQL Connection ---------------------------
 
 # Load database connection string from environment
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Optional comma-separated read replicas for read-only helpers
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
 
-def get_db_connection():
+# Pool config
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT", 10))    # seconds to wait for a free slot
+DB_POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", 300))           # close idle conns above min size after this
+DB_POOL_HEALTHCHECK_AFTER = float(os.getenv("DB_POOL_HEALTHCHECK_AFTER", 30))  # ping conns idle longer than this
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 30000))
+DB_STREAM_CHUNK_SIZE = int(os.getenv("DB_STREAM_CHUNK_SIZE", 2000))           # rows per server-side cursor fetch
+DB_STREAM_MAX_SEC = float(os.getenv("DB_STREAM_MAX_SEC", 60))                 # longest a streamed response may hold its connection
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 500))                  # log queries slower than this
+DB_METRICS_WINDOW = int(os.getenv("DB_METRICS_WINDOW", 1000))                 # recent samples kept per query for percentiles
+DB_REPLICA_MAX_LAG_SEC = float(os.getenv("DB_REPLICA_MAX_LAG_SEC", 5))         # replicas further behind fall back to primary
+DB_REPLICA_LAG_CHECK_SEC = float(os.getenv("DB_REPLICA_LAG_CHECK_SEC", 5))     # how long a lag reading is trusted
+DB_REPLICA_PROBE_TIMEOUT_SEC = float(os.getenv("DB_REPLICA_PROBE_TIMEOUT_SEC", 2))  # connect + lag query budget per probe
+
+# === gevent cooperation ===
+# psycopg2 blocks on its socket in C, so without a wait callback one slow query
+# stalls the whole gevent hub. Only install it when the worker is monkey-patched.
+def gevent_wait_callback(conn, timeout=None):
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state}")
+
+if monkey.is_module_patched("socket"):
+    extensions.set_wait_callback(gevent_wait_callback)
+
+# COPY FROM STDIN is not used for bulk loads: psycopg2 refuses copy_expert while
+# a wait callback is installed, and lifting the callback would block the hub for
+# the whole load. Large batches go through multi-row INSERTs like small ones.
+
+class PooledConnection(extensions.connection):
+    """psycopg2 connection carrying the bookkeeping the pool needs."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.statement_timeout_ms = DB_STATEMENT_TIMEOUT_MS
+        self.prepared = set()  # names of statements PREPAREd on this session
+
+def get_db_connection(dsn=None):
     try:
-        connection = psycopg2.connect(DATABASE_URL)
+        connection = psycopg2.connect(
+            dsn or DATABASE_URL,
+            connection_factory=PooledConnection,
+            options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+        )
         return connection
     except Exception as e:
         print(f"❌ Error: Unable to connect to the database. {e}")
         raise e
-    
-def get_connection():
-    return get_db_connection()  # alias for clarity in app.py
-
-# Execute SELECT query (single row)
-def fetch_data(query, params=None):
-    db = None
-    cursor = None
+
+class PoolTimeout(Exception):
+    pass
+
+class StreamDeadlineExceeded(Exception):
+    pass
+
+class ConnectionPool:
+    """
+    Bounded pool of psycopg2 connections.
+
+    Uses threading primitives, which gunicorn's gevent worker monkey-patches into
+    cooperative ones, so a greenlet waiting for a slot yields to the hub.
+    """
+    def __init__(self, dsn=None, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT, idle_timeout=DB_POOL_IDLE_TIMEOUT,
+                 healthcheck_after=DB_POOL_HEALTHCHECK_AFTER):
+        self.dsn = dsn or DATABASE_URL
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.idle_timeout = idle_timeout
+        self.healthcheck_after = healthcheck_after
+        self.pid = os.getpid()
+
+        self._idle = []  # LIFO stack so hot connections stay hot and cold ones age out
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._in_use = 0
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_ms": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "closed": 0,
+            "reaped": 0,
+            "failed_healthchecks": 0,
+        }
+
+    # --- public API ---
+    def getconn(self, statement_timeout_ms=None):
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            self._stats["waits"] += 1
+            if not self._slots.acquire(timeout=self.checkout_timeout):
+                self._stats["timeouts"] += 1
+                raise PoolTimeout(f"No database connection available within {self.checkout_timeout}s")
+        self._stats["wait_time_ms"] += (time.monotonic() - started) * 1000
+
+        try:
+            conn = self._checkout_idle() or self._connect()
+            self._apply_statement_timeout(conn, statement_timeout_ms or DB_STATEMENT_TIMEOUT_MS)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+        return conn
+
+    def putconn(self, conn):
+        try:
+            if not conn.closed:
+                tx_status = conn.get_transaction_status()
+                if tx_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    self._close(conn)
+                elif tx_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except Exception as e:
+            print(f"⚠️ Discarding broken pooled connection: {e}")
+            self._close(conn)
+
+        if not conn.closed:
+            conn.last_used = time.monotonic()
+            with self._lock:
+                self._idle.append(conn)
+
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+        self.reap_idle()
+
+    def reap_idle(self):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            # Oldest connections sit at the bottom of the stack
+            while len(self._idle) > self.min_size and now - self._idle[0].last_used > self.idle_timeout:
+                expired.append(self._idle.pop(0))
+        for conn in expired:
+            self._stats["reaped"] += 1
+            self._close(conn)
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "wait_time_ms": round(self._stats["wait_time_ms"], 1),
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+            }
+
+    # --- internals ---
+    def _checkout_idle(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn = self._idle.pop()
+            if self._is_healthy(conn):
+                return conn
+            self._stats["failed_healthchecks"] += 1
+            self._close(conn)
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used < self.healthcheck_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _connect(self):
+        conn = get_db_connection(self.dsn)
+        self._stats["created"] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._stats["closed"] += 1
+
+    def _apply_statement_timeout(self, conn, timeout_ms):
+        if conn.statement_timeout_ms == timeout_ms:
+            return
+        with conn.cursor() as cursor:
+            cursor.execute("SET statement_timeout = %s", (timeout_ms,))
+        conn.commit()
+        conn.statement_timeout_ms = timeout_ms
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+def get_pool(dsn=None):
+    dsn = dsn or DATABASE_URL
+    pool = _pools.get(dsn)
+    # Rebuild after fork so gunicorn workers never share sockets
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = _pools.get(dsn)
+            if pool is None or pool.pid != os.getpid():
+                pool = _pools[dsn] = ConnectionPool(dsn)
+    return pool
+
+# === Read replicas ===
+# url -> {"lag": seconds or None when unreachable, "checked_at": monotonic time}
+_replica_status = {url: {"lag": None, "checked_at": None} for url in DATABASE_REPLICA_URLS}
+_replica_cursor = 0
+
+def _replica_lag(url):
+    status = _replica_status[url]
+    now = time.monotonic()
+    if status["checked_at"] is not None and now - status["checked_at"] < DB_REPLICA_LAG_CHECK_SEC:
+        return status["lag"]
+
+    # Other greenlets keep the previous reading while this probe runs
+    status["checked_at"] = now
+
+    # Caught-up standbys report 0; a plain server (no WAL receiver) reports 0 as well.
+    # The probe uses its own short-lived connection: a replica that is down must cost
+    # at most DB_REPLICA_PROBE_TIMEOUT_SEC, not a pool slot and a checkout timeout.
+    lag = None
+    conn = None
+    try:
+        with Timeout(DB_REPLICA_PROBE_TIMEOUT_SEC, psycopg2.OperationalError("replica lag probe timed out")):
+            conn = psycopg2.connect(url, connect_timeout=max(1, int(DB_REPLICA_PROBE_TIMEOUT_SEC)))
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT CASE
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                """)
+                lag = float(cursor.fetchone()[0])
+    except Exception as e:
+        print(f"⚠️ Replica unavailable, routing reads to primary: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+
+    status["lag"], status["checked_at"] = lag, now
+    return lag
+
+def _choose_read_dsn():
+    global _replica_cursor
+    # Round-robin over replicas that are reachable and close enough to the primary
+    for _ in range(len(DATABASE_REPLICA_URLS)):
+        url = DATABASE_REPLICA_URLS[_replica_cursor % len(DATABASE_REPLICA_URLS)]
+        _replica_cursor += 1
+        lag = _replica_lag(url)
+        if lag is not None and lag <= DB_REPLICA_MAX_LAG_SEC:
+            return url
+    return DATABASE_URL
+
+@contextmanager
+def db_connection(statement_timeout_ms=None, readonly=False):
+    """
+    Check out a pooled connection, on the primary unless `readonly=True`, which may
+    be served by a replica up to DB_REPLICA_MAX_LAG_SEC behind. Only reads that
+    tolerate that lag (reports, trends) opt in.
+    """
+    pool = get_pool(_choose_read_dsn() if readonly and DATABASE_REPLICA_URLS else DATABASE_URL)
+    conn = pool.getconn(statement_timeout_ms)
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def pool_stats():
+    return get_pool().stats()
+
+def replica_stats():
+    return [
+        {
+            "replica": index,
+            "lag_sec": _replica_status[url]["lag"],
+            "healthy": _replica_status[url]["lag"] is not None and _replica_status[url]["lag"] <= DB_REPLICA_MAX_LAG_SEC,
+            **get_pool(url).stats(),
+        }
+        for index, url in enumerate(DATABASE_REPLICA_URLS)
+    ]
+
+# --------------------- Query Metrics ---------------------------
+
+# Upper bounds (ms) of the latency histogram buckets; a final +Inf bucket is implied
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_query_metrics = {}
+_metrics_lock = threading.Lock()
+
+def query_fingerprint(query):
+    """Collapse whitespace so the same statement always maps to the same short id."""
+    text = " ".join(str(query).split())
+    return hashlib.md5(text.encode()).hexdigest()[:12], text
+
+def _redact(params):
+    # Vitals and credentials must never reach the logs; keep only the shape
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: f"<{type(value).__name__}>" for key, value in params.items()}
+    return [f"<{type(value).__name__}>" for value in params]
+
+def record_query(fingerprint, text, elapsed_ms, rows, params=None, failed=False):
+    slow = elapsed_ms >= DB_SLOW_QUERY_MS
+    with _metrics_lock:
+        metrics = _query_metrics.get(fingerprint)
+        if metrics is None:
+            metrics = _query_metrics[fingerprint] = {
+                "query": text[:300],
+                "calls": 0,
+                "errors": 0,
+                "slow": 0,
+                "rows": 0,
+                "total_ms": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                "recent": deque(maxlen=DB_METRICS_WINDOW),
+            }
+        metrics["calls"] += 1
+        metrics["errors"] += int(failed)
+        metrics["slow"] += int(slow)
+        metrics["rows"] += max(rows or 0, 0)
+        metrics["total_ms"] += elapsed_ms
+        metrics["buckets"][bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        metrics["recent"].append(elapsed_ms)
+
+    if slow:
+        print(f"🐢 Slow query [{fingerprint}] {elapsed_ms:.1f} ms, rows={rows} | {text[:300]} | params={_redact(params)}")
+
+def _timed_execute(cursor, query, params=None, fingerprint=None):
+    fp, text = fingerprint or query_fingerprint(query)
+    started = time.monotonic()
+    failed = True
     try:
-        db = get_db_connection()
-        cursor = db.cursor(cursor_factory=RealDictCursor)
         cursor.execute(query, params or ())
-        return cursor.fetchone()
+        failed = False
+    finally:
+        record_query(fp, text, (time.monotonic() - started) * 1000, cursor.rowcount, params, failed)
+
+def _percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, int(round(pct / 100 * (len(sorted_samples) - 1))))
+    return round(sorted_samples[index], 2)
+
+def _metrics_snapshot():
+    with _metrics_lock:
+        return {fp: {**m, "buckets": list(m["buckets"]), "recent": sorted(m["recent"])} for fp, m in _query_metrics.items()}
+
+def query_stats():
+    bounds = [str(b) for b in LATENCY_BUCKETS_MS] + ["+Inf"]
+    stats = {}
+    for fp, m in _metrics_snapshot().items():
+        recent = m.pop("recent")
+        stats[fp] = {
+            **m,
+            "total_ms": round(m["total_ms"], 1),
+            "avg_ms": round(m["total_ms"] / m["calls"], 2) if m["calls"] else None,
+            "p50_ms": _percentile(recent, 50),
+            "p95_ms": _percentile(recent, 95),
+            "p99_ms": _percentile(recent, 99),
+            "buckets": dict(zip(bounds, m["buckets"])),
+        }
+    return stats
+
+def metrics_text():
+    """Prometheus text exposition of the per-query histograms and pool gauges."""
+    snapshot = _metrics_snapshot()
+    lines = [
+        "# HELP db_query_duration_ms Database query latency by statement fingerprint.",
+        "# TYPE db_query_duration_ms histogram",
+    ]
+    for fp, m in snapshot.items():
+        cumulative = 0
+        for bound, count in zip(list(LATENCY_BUCKETS_MS) + ["+Inf"], m["buckets"]):
+            cumulative += count
+            lines.append(f'db_query_duration_ms_bucket{{fingerprint="{fp}",le="{bound}"}} {cumulative}')
+        lines.append(f'db_query_duration_ms_sum{{fingerprint="{fp}"}} {m["total_ms"]:.3f}')
+        lines.append(f'db_query_duration_ms_count{{fingerprint="{fp}"}} {m["calls"]}')
+
+    for name in ("rows", "errors", "slow"):
+        lines.append(f"# TYPE db_query_{name}_total counter")
+        for fp, m in snapshot.items():
+            lines.append(f'db_query_{name}_total{{fingerprint="{fp}"}} {m[name]}')
+
+    for key, value in pool_stats().items():
+        lines.append(f"# TYPE db_pool_{key} gauge")
+        lines.append(f"db_pool_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+# --------------------- Transactions ---------------------------
+
+class Transaction:
+    """
+    Runs several statements on one pooled connection; `transaction()` commits
+    them together or rolls all of them back.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    # SELECT (single row) or INSERT/UPDATE/DELETE ... RETURNING
+    def fetch_one(self, query, params=None):
+        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            _timed_execute(cursor, query, params)
+            return cursor.fetchone()
+
+    # SELECT (all rows)
+    def fetch_all(self, query, params=None):
+        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            _timed_execute(cursor, query, params)
+            return cursor.fetchall()
+
+    # INSERT, UPDATE, DELETE — returns affected row count
+    def execute(self, query, params=None):
+        with self.conn.cursor() as cursor:
+            _timed_execute(cursor, query, params)
+            return cursor.rowcount
+
+    # Multi-row INSERT ... VALUES %s as one statement; returns the RETURNING tuples when fetch=True
+    def execute_values(self, query, rows, fetch=False):
+        fp, text = query_fingerprint(query)
+        started = time.monotonic()
+        failed = True
+        result = None
+        try:
+            with self.conn.cursor() as cursor:
+                result = execute_values(cursor, query, rows, page_size=max(len(rows), 1), fetch=fetch)
+            failed = False
+            return result
+        finally:
+            record_query(fp, text, (time.monotonic() - started) * 1000, len(result) if fetch and result else len(rows), None, failed)
+
+    # EXECUTE a registered prepared statement; fetch is "one", "all" or None
+    def execute_prepared(self, name, params=None, fetch="one"):
+        return _execute_prepared(self.conn, name, params, fetch)
+
+    # Statements inside roll back on their own when the block raises; the rest of the transaction carries on
+    @contextmanager
+    def savepoint(self, name):
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"SAVEPOINT {name}")
+        try:
+            yield self
+        except Exception:
+            with self.conn.cursor() as cursor:
+                cursor.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            raise
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"RELEASE SAVEPOINT {name}")
+
+    # SELECT (all rows) as a generator backed by a server-side cursor
+    def stream(self, query, params=None, chunk_size=DB_STREAM_CHUNK_SIZE):
+        return _stream_rows(self.conn, query, params, chunk_size)
+
+# replica=True for read-only work that tolerates replica lag; writes would fail there
+@contextmanager
+def transaction(statement_timeout_ms=None, replica=False):
+    with db_connection(statement_timeout_ms, readonly=replica) as conn:
+        try:
+            yield Transaction(conn)
+            conn.commit()
+        except Exception as e:
+            print(f"❌ Transaction rolled back: {e}")
+            conn.rollback()
+            raise e
+
+# Execute SELECT query (single row); replica=True lets a lagging replica answer
+def fetch_data(query, params=None, replica=False):
+    try:
+        with db_connection(readonly=replica) as db:
+            with db.cursor(cursor_factory=RealDictCursor) as cursor:
+                _timed_execute(cursor, query, params)
+                return cursor.fetchone()
     except Exception as e:
         print(f"❌ Error executing SELECT query: {e}")
         return None
-    finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
 
 # Execute SELECT query (all rows)
-def fetch_all_data(query, params=None):
-    db = None
-    cursor = None
+def fetch_all_data(query, params=None, replica=False):
     try:
-        db = get_db_connection()
-        cursor = db.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(query, params or ())
-        return cursor.fetchall()
+        with db_connection(readonly=replica) as db:
+            with db.cursor(cursor_factory=RealDictCursor) as cursor:
+                _timed_execute(cursor, query, params)
+                return cursor.fetchall()
     except Exception as e:
         print(f"❌ Error executing SELECT ALL query: {e}")
         return []
+
+# --------------------- Streaming ---------------------------
+
+def _stream_rows(conn, query, params, chunk_size, deadline=None):
+    # Named cursor keeps the result set on the server; only one chunk lives in memory.
+    # `deadline` (monotonic) bounds how long a slow consumer keeps the connection.
+    fp, text = query_fingerprint(query)
+    started = time.monotonic()
+    total = 0
+    failed = True
+    try:
+        with conn.cursor(name=f"stream_{uuid.uuid4().hex}", cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(query, params or ())
+            while True:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise StreamDeadlineExceeded(f"stream held its connection for over {DB_STREAM_MAX_SEC:g}s")
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                total += len(rows)
+                yield from rows
+        failed = False
     finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
+        # Includes time the consumer spent between chunks, i.e. how long the cursor was held open
+        record_query(fp, text, (time.monotonic() - started) * 1000, total, params, failed)
 
-# Execute INSERT, UPDATE, DELETE
-def modify_data(query, params=None):
-    db = None
-    cursor = None
+# Execute SELECT query (all rows), yielding them chunk by chunk for at most DB_STREAM_MAX_SEC.
+# Errors are raised, not swallowed: a response built on the stream must not end as if complete.
+def stream_all_data(query, params=None, chunk_size=DB_STREAM_CHUNK_SIZE, replica=False):
+    deadline = time.monotonic() + DB_STREAM_MAX_SEC
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-        cursor.execute(query, params or ())
-        db.commit()
+        with db_connection(readonly=replica) as db:
+            yield from _stream_rows(db, query, params, chunk_size, deadline)
     except Exception as e:
-        print(f"❌ Error executing query: {e}")
-        db.rollback()
+        print(f"❌ Error executing streaming SELECT query: {e}")
         raise e
-    finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
+
+# Execute INSERT, UPDATE, DELETE
+def modify_data(query, params=None):
+    with db_connection() as db:
+        try:
+            with db.cursor() as cursor:
+                _timed_execute(cursor, query, params)
+            db.commit()
+        except Exception as e:
+            print(f"❌ Error executing query: {e}")
+            db.rollback()
+            raise e
 
 # Execute INSERT/UPDATE/DELETE that returns something (e.g., RETURNING id)
 def modify_and_return(query, params=None):
-    db = None
-    cursor = None
-    try:
-        db = get_db_connection()
-        cursor = db.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(query, params or ())
-        result = cursor.fetchone()
-        db.commit()
-        return result
-    except Exception as e:
-        print(f"❌ Error executing modifying query with return: {e}")
-        db.rollback()
-        raise e
-    finally:
-        if cursor:
-            cursor.close()
-        if db:
-            db.close()
+    with db_connection() as db:
+        try:
+            with db.cursor(cursor_factory=RealDictCursor) as cursor:
+                _timed_execute(cursor, query, params)
+                result = cursor.fetchone()
+            db.commit()
+            return result
+        except Exception as e:
+            print(f"❌ Error executing modifying query with return: {e}")
+            db.rollback()
+            raise e
 
 def fetch_latest_data(table, column, value):
     sql = f"""
@@ -102,3 +603,85 @@ def fetch_latest_data(table, column, value):
         LIMIT 1
     """
     return fetch_data(sql, (value,))
+
+# --------------------- Prepared Statements ---------------------------
+
+# name -> {"sql": PREPARE body with $n placeholders, "nparams": int}
+PREPARED_QUERIES = {}
+_prepared_stats = {}
+_PREPARED_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+def to_numbered_params(query):
+    """Rewrite psycopg2 %s placeholders as the server-side $1, $2, ... form."""
+    counter = iter(range(1, query.count("%s") + 1))
+    return re.sub(r"%s", lambda _: f"${next(counter)}", query)
+
+def register_query(name, query):
+    """Register a hot %s-style query to be PREPAREd once per pooled connection."""
+    if not _PREPARED_NAME.match(name):
+        raise ValueError(f"Invalid prepared statement name: {name}")
+    PREPARED_QUERIES[name] = {
+        "sql": to_numbered_params(query),
+        "nparams": query.count("%s"),
+    }
+    _prepared_stats[name] = {"calls": 0, "prepares": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+def _execute_prepared(conn, name, params, fetch):
+    entry = PREPARED_QUERIES[name]
+    stats = _prepared_stats[name]
+    started = time.monotonic()
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        if name not in conn.prepared:
+            # PREPARE is session-scoped and survives rollbacks, so this runs once per connection
+            cursor.execute(f"PREPARE {name} AS {entry['sql']}")
+            conn.prepared.add(name)
+            stats["prepares"] += 1
+
+        placeholders = ", ".join(["%s"] * entry["nparams"])
+        statement = f"EXECUTE {name} ({placeholders})" if placeholders else f"EXECUTE {name}"
+        _timed_execute(cursor, statement, params, fingerprint=(f"prepared:{name}", entry["sql"]))
+        if fetch == "one":
+            result = cursor.fetchone()
+        elif fetch == "all":
+            result = cursor.fetchall()
+        else:
+            result = cursor.rowcount
+
+    elapsed_ms = (time.monotonic() - started) * 1000
+    stats["calls"] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    return result
+
+# Prepared SELECT (single row)
+# None means no row; a database error propagates so callers can tell "unknown" from "unavailable"
+def fetch_prepared(name, params=None, replica=False):
+    with db_connection(readonly=replica) as db:
+        try:
+            return _execute_prepared(db, name, params, "one")
+        except Exception as e:
+            print(f"❌ Error executing prepared SELECT {name}: {e}")
+            raise e
+
+# Prepared INSERT, UPDATE, DELETE
+def modify_prepared(name, params=None):
+    with db_connection() as db:
+        try:
+            _execute_prepared(db, name, params, None)
+            db.commit()
+        except Exception as e:
+            print(f"❌ Error executing prepared query {name}: {e}")
+            db.rollback()
+            raise e
+
+def prepared_stats():
+    return {
+        name: {
+            **stats,
+            "total_ms": round(stats["total_ms"], 1),
+            "max_ms": round(stats["max_ms"], 1),
+            "avg_ms": round(stats["total_ms"] / stats["calls"], 2) if stats["calls"] else None,
+        }
+        for name, stats in _prepared_stats.items()
+    }
@@ -0,0 +1,104 @@
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+from binary_ingest import VitalsColumns
+
+# --------------------- Ingest Dedupe Window ---------------------------
+#
+# The phone only clears its buffer on a 200, so a lost response means the whole
+# batch comes back. Remembering the reading timestamps each shirt sent recently
+# lets /sensor answer those retries straight away and pass only new readings on
+# to the ingest queue; ON CONFLICT DO NOTHING stays as the backstop for anything
+# that falls outside the window.
+#
+# Keys are the timestamp as sent: the ISO string for JSON bodies, epoch millis
+# for the binary format (a shirt sticks to one format).
+
+# Config
+DEDUPE_WINDOW_SEC = int(os.getenv("DEDUPE_WINDOW_SEC", 600))
+DEDUPE_MAX_KEYS_PER_SHIRT = int(os.getenv("DEDUPE_MAX_KEYS_PER_SHIRT", 20000))
+DEDUPE_MAX_SHIRTS = int(os.getenv("DEDUPE_MAX_SHIRTS", 5000))
+
+# shirt -> OrderedDict(timestamp key -> seen at), oldest first
+_seen = OrderedDict()
+_stats = {
+    "batches": 0,
+    "duplicate_batches": 0,
+    "partial_batches": 0,
+    "readings": 0,
+    "duplicate_readings": 0,
+}
+
+def _keys(batch):
+    if isinstance(batch, VitalsColumns):
+        return batch.ts_ms.tolist()
+    return [reading.get("timestamp") for reading in batch]
+
+def _window(smartshirt_id, create=False):
+    key = str(smartshirt_id)
+    window = _seen.get(key)
+    if window is None:
+        if not create:
+            return None
+        window = _seen[key] = OrderedDict()
+        while len(_seen) > DEDUPE_MAX_SHIRTS:
+            _seen.popitem(last=False)
+    _seen.move_to_end(key)
+
+    # Time-based eviction from the old end
+    cutoff = time.monotonic() - DEDUPE_WINDOW_SEC
+    while window and next(iter(window.values())) < cutoff:
+        window.popitem(last=False)
+    return window
+
+def new_readings(batch, smartshirt_id):
+    """Return the part of `batch` this shirt has not sent within the window (same type as `batch`)."""
+    keys = _keys(batch)
+    _stats["batches"] += 1
+    _stats["readings"] += len(keys)
+
+    window = _window(smartshirt_id)
+    if not window:
+        return batch
+    fresh = [i for i, key in enumerate(keys) if key not in window]
+    duplicates = len(keys) - len(fresh)
+    if not duplicates:
+        return batch
+
+    _stats["duplicate_readings"] += duplicates
+    if not fresh:
+        _stats["duplicate_batches"] += 1
+    else:
+        _stats["partial_batches"] += 1
+
+    if isinstance(batch, VitalsColumns):
+        return batch.take(np.asarray(fresh, dtype=np.intp))
+    return [batch[i] for i in fresh]
+
+def remember(batch, smartshirt_id):
+    """Record readings that were accepted for writing."""
+    window = _window(smartshirt_id, create=True)
+    now = time.monotonic()
+    for key in _keys(batch):
+        window[key] = now
+        window.move_to_end(key)
+    while len(window) > DEDUPE_MAX_KEYS_PER_SHIRT:
+        window.popitem(last=False)
+
+def forget(batch, smartshirt_id):
+    """Drop readings that never made it to the database, so a retry is not mistaken for a duplicate."""
+    window = _window(smartshirt_id)
+    if window:
+        for key in _keys(batch):
+            window.pop(key, None)
+
+def dedupe_stats():
+    batches, readings = _stats["batches"], _stats["readings"]
+    return {
+        "shirts": len(_seen),
+        "keys": sum(len(window) for window in _seen.values()),
+        "batch_hit_rate": round(_stats["duplicate_batches"] / batches, 3) if batches else None,
+        "reading_hit_rate": round(_stats["duplicate_readings"] / readings, 3) if readings else None,
+        **_stats,
+    }
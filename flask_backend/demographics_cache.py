@@ -0,0 +1,101 @@
+import os
+import time
+from collections import OrderedDict
+import psycopg2
+from db_utils import register_query, fetch_prepared
+
+# --------------------- Patient Demographics Cache ---------------------------
+#
+# Age and gender drive every vitals classification but almost never change, so
+# they are cached per process instead of being joined in for each reading.
+# Entries expire after DEMOGRAPHICS_CACHE_TTL_SEC; update_patient_profile calls
+# invalidate_patient(), and shirt registration / deletion call invalidate_shirt(),
+# so the change is picked up immediately by this worker (other workers catch up
+# within the TTL).
+
+# Config
+DEMOGRAPHICS_CACHE_TTL_SEC = int(os.getenv("DEMOGRAPHICS_CACHE_TTL_SEC", 600))
+DEMOGRAPHICS_CACHE_MAX_ENTRIES = int(os.getenv("DEMOGRAPHICS_CACHE_MAX_ENTRIES", 10000))
+
+register_query("demographics_by_patient", "SELECT age, gender FROM patients WHERE patientid = %s")
+register_query("patient_by_shirt", "SELECT patientid FROM smartshirt WHERE smartshirtid = %s")
+
+# key -> (expires_at, value); ids are keyed by their text form since clients send both ints and strings
+_patients = OrderedDict()
+_shirts = OrderedDict()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def _get(cache, key):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] < time.monotonic():
+        del cache[key]
+        return None
+    cache.move_to_end(key)
+    return entry[1]
+
+def _put(cache, key, value):
+    cache[key] = (time.monotonic() + DEMOGRAPHICS_CACHE_TTL_SEC, value)
+    cache.move_to_end(key)
+    while len(cache) > DEMOGRAPHICS_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+
+def get_patient_demographics(patient_id):
+    """
+    Return {"age", "gender"} for a patient, or None if the patient is unknown.
+    A failed lookup raises, so callers can answer "retry later" instead of "unknown".
+    """
+    key = str(patient_id)
+    cached = _get(_patients, key)
+    if cached is not None:
+        _stats["hits"] += 1
+        return cached
+
+    _stats["misses"] += 1
+    # Primary (the default), so a profile edit is never re-cached from a lagging replica
+    row = fetch_prepared("demographics_by_patient", (patient_id,))
+    if not row:
+        return None
+    demographics = {"age": int(row["age"] or 0), "gender": row["gender"]}
+    _put(_patients, key, demographics)
+    return demographics
+
+def get_shirt_demographics(smartshirt_id):
+    """
+    Resolve a smartshirt to its patient and return {"patient_id", "age", "gender"},
+    or None if the shirt is unknown. Raises if the lookup itself fails.
+    """
+    key = str(smartshirt_id)
+    patient_id = _get(_shirts, key)
+    if patient_id is None:
+        try:
+            row = fetch_prepared("patient_by_shirt", (smartshirt_id,))
+        except psycopg2.DataError:
+            return None  # not even a valid smartshirtid
+        if not row:
+            return None
+        patient_id = row["patientid"]
+        _put(_shirts, key, patient_id)
+
+    demographics = get_patient_demographics(patient_id)
+    if demographics is None:
+        return None
+    return {"patient_id": patient_id, **demographics}
+
+def invalidate_patient(patient_id):
+    _stats["invalidations"] += 1
+    _patients.pop(str(patient_id), None)
+
+def invalidate_shirt(smartshirt_id):
+    _stats["invalidations"] += 1
+    _shirts.pop(str(smartshirt_id), None)
+
+def demographics_cache_stats():
+    lookups = _stats["hits"] + _stats["misses"]
+    return {
+        "patients": len(_patients),
+        "shirts": len(_shirts),
+        "hit_rate": round(_stats["hits"] / lookups, 3) if lookups else None,
+        **_stats,
+    }
@@ -0,0 +1,415 @@
+import os
+import sys
+import time
+import msgpack
+import numpy as np
+import pywt
+import neurokit2 as nk
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import butter, sosfilt, sosfilt_zi
+from vitals_classifier import classify_ecg_bpm
+
+# --------------------- Streaming ECG Analysis ---------------------------
+#
+# Pure CPU work, no database and no gevent, so it runs inside the ECG worker
+# processes (see ecg_pool.py) while the web worker writes the results.
+#
+# Every shirt has an ECGStream that takes chunks of any size. Samples are
+# denoised once, in hop-sized blocks, and the highpass filter carries its state
+# from block to block. R-peaks come from a vectorised Pan–Tompkins style
+# detector, each beat once, when it is first seen with enough signal after it.
+# Every ECG_HOP_SIZE samples, once ECG_WINDOW_SIZE samples have arrived, the
+# beats of the last window are summarised into one ecg row. RR of a window's
+# first beat is measured from the previous window's last R-peak.
+#
+# A stream only joins chunks known to be contiguous: each chunk carries the
+# offset of its first sample in the shirt's stream. A chunk that starts past
+# the stream's end (its predecessors went to another web worker, or were lost)
+# finishes the stream and starts a new one; samples already seen are dropped.
+# Chunks without an offset are analysed on their own.
+#
+# Two tiers: every row gets BPM, RR, status and a quality flag from the R-peaks
+# alone ("fast"). Full neurokit delineation for PR/P/QRS/QT/QTc ("full") runs on
+# every ECG_FULL_EVERY_WINDOWS-th row, or on the next row when asked for.
+
+ECG_SAMPLING_RATE = int(os.getenv("ECG_SAMPLING_RATE", 11))
+ECG_WINDOW_SIZE = int(os.getenv("ECG_WINDOW_SIZE", 500))       # samples summarised per ecg row
+ECG_HOP_SIZE = int(os.getenv("ECG_HOP_SIZE", 250))             # new samples between rows (overlap = window - hop)
+ECG_DENOISE_MARGIN = 32        # raw samples either side of a block, so the wavelet edges do not show
+ECG_BEAT_TAIL = int(0.45 * ECG_SAMPLING_RATE) + 1   # signal needed after an R-peak to delineate its T wave
+ECG_MAX_BEATS = 256            # beats kept per stream
+ECG_FULL_EVERY_WINDOWS = int(os.getenv("ECG_FULL_EVERY_WINDOWS", 6))   # rows between full delineations
+ECG_STREAM_IDLE_SEC = int(os.getenv("ECG_STREAM_IDLE_SEC", 300))
+ECG_MAX_STREAMS = int(os.getenv("ECG_MAX_STREAMS", 2000))       # per worker process; least recently used go first
+
+# Same highpass as nk.ecg_clean (0.5 Hz, 5th order Butterworth), but causal so its state carries over
+_HIGHPASS = butter(5, 0.5, btype="highpass", fs=ECG_SAMPLING_RATE, output="sos")
+
+# === Wavelet Denoising ===
+def wavelet_denoise(signal, wavelet='db6', level=2):
+    coeffs = pywt.wavedec(signal, wavelet, level=level)
+    sigma = np.median(np.abs(coeffs[-1])) / 0.6745
+    uthresh = sigma * np.sqrt(2 * np.log(len(signal)))
+    coeffs[1:] = [pywt.threshold(i, value=uthresh, mode='soft') for i in coeffs[1:]]
+    return pywt.waverec(coeffs, wavelet)
+
+def wavelet_denoise_batch(signals, wavelet='db6', level=2):
+    """
+    wavelet_denoise for many signals at once: equal-length signals are stacked
+    into one 2-D array, decomposed, thresholded with a per-row noise sigma and
+    reconstructed in single vectorised calls. Returns the denoised signals in order.
+    """
+    denoised = [None] * len(signals)
+    by_length = {}
+    for i, signal in enumerate(signals):
+        by_length.setdefault(len(signal), []).append(i)
+    for length, rows in by_length.items():
+        if len(rows) == 1:
+            denoised[rows[0]] = wavelet_denoise(signals[rows[0]], wavelet, level)
+            continue
+        stacked = np.stack([signals[i] for i in rows])
+        coeffs = pywt.wavedec(stacked, wavelet, level=level, axis=-1)
+        sigma = np.median(np.abs(coeffs[-1]), axis=-1) / 0.6745
+        uthresh = (sigma * np.sqrt(2 * np.log(length)))[:, None]
+        # Soft thresholding, as pywt.threshold(mode='soft') but with a threshold per row
+        coeffs[1:] = [np.sign(c) * np.maximum(np.abs(c) - uthresh, 0) for c in coeffs[1:]]
+        for i, out in zip(rows, pywt.waverec(coeffs, wavelet, axis=-1)):
+            denoised[i] = out
+    return denoised
+
+# === Pan–Tompkins R-peak detection ===
+def detect_r_peaks(signal, sampling_rate=ECG_SAMPLING_RATE):
+    """
+    R-peak indices of a filtered ECG segment: derivative, squaring, moving
+    window integration, a threshold between the noise and QRS energy levels,
+    a 200 ms refractory period, then the largest deflection near each hit.
+    """
+    x = np.asarray(signal, dtype=float)
+    if len(x) < 5:
+        return np.empty(0, dtype=int)
+    x = x - x.mean()
+    derivative = np.convolve(x, np.array([1, 2, 0, -2, -1]) * sampling_rate / 8, mode="same")
+    integrated = np.convolve(derivative ** 2, np.ones(max(1, int(0.15 * sampling_rate))), mode="same")
+
+    # Local maxima of the integrated energy are the candidates
+    middle = integrated[1:-1]
+    candidates = np.flatnonzero((middle > integrated[:-2]) & (middle >= integrated[2:])) + 1
+    if len(candidates) < 2:
+        return np.empty(0, dtype=int)
+    heights = integrated[candidates]
+    noise, qrs = np.median(heights), np.percentile(heights, 90)
+    candidates = candidates[heights > noise + 0.25 * (qrs - noise)]
+
+    # Refractory period: of two hits closer than 200 ms keep the stronger
+    refractory = max(1, int(0.2 * sampling_rate))
+    kept = []
+    for c in candidates:
+        if kept and c - kept[-1] < refractory:
+            if integrated[c] > integrated[kept[-1]]:
+                kept[-1] = c
+        else:
+            kept.append(c)
+    if not kept:
+        return np.empty(0, dtype=int)
+
+    # The R-peak is the largest deflection within ±75 ms of the energy peak
+    half = max(1, int(0.075 * sampling_rate))
+    padded = np.pad(np.abs(x), half, mode="edge")
+    neighbourhoods = sliding_window_view(padded, 2 * half + 1)[np.asarray(kept)]
+    return np.unique(np.asarray(kept) - half + neighbourhoods.argmax(axis=1))
+
+def rr_quality(rr_ms):
+    """"good", "irregular" (plausible but uneven RR), "noisy" (implausible RR) or "insufficient"."""
+    rr = np.asarray([v for v in rr_ms if v], dtype=float)
+    if len(rr) < 2:
+        return "insufficient"
+    if rr.min() < 250 or rr.max() > 2000:   # outside 30–240 bpm
+        return "noisy"
+    return "good" if rr.std() / rr.mean() < 0.25 else "irregular"
+
+def _mean_ms(values):
+    values = [v for v in values if v is not None and not np.isnan(v)]
+    return round(float(np.mean(values)), 1) if values else "-"
+
+def summarize_beats(beats, age, gender, full=False):
+    """
+    One ecg row from a window's beats (dicts with rr/pr/p/qrs/qt in ms):
+    {"bpm", "ecgstatus", "detecteddisease", "hrv", "rr", "pr", "p", "qrs", "qt", "qtc",
+     "quality", "tier"} (measurements as strings, None when unavailable; interval
+    fields only for full=True, i.e. delineated beats), or {"skipped": reason}.
+    """
+    if len(beats) < 2:
+        return {"skipped": "Too few R-peaks"}
+    rr_ms = [b["rr"] for b in beats if b["rr"]]
+    if not rr_ms:
+        return {"skipped": "Invalid HR (NaN)"}
+
+    # HR & HRV
+    hr = round(float(np.mean(60000 / np.asarray(rr_ms))), 1)
+    hrv = round(float(np.mean(rr_ms)), 1)   # HRV_MeanNN
+    rr = hrv
+
+    # ECG Durations
+    delineated = [b for b in beats if b["delineated"]] if full else []
+    pr = _mean_ms(b["pr"] for b in delineated)
+    p_dur = _mean_ms(b["p"] for b in delineated)
+    qrs = _mean_ms(b["qrs"] for b in delineated)
+    qt = _mean_ms(b["qt"] for b in delineated)
+
+    # QTc (Bazett's)
+    qtc = round(qt / ((rr / 1000) ** 0.5), 1) if qt != "-" else "-"
+
+    # Classification
+    classification = classify_ecg_bpm(hr, age, gender)
+
+    def safe_str(value):
+        return str(value) if value != "-" else None
+
+    return {
+        "quality": rr_quality(rr_ms),
+        "tier": "full" if full else "fast",
+        "bpm": safe_str(hr),
+        "ecgstatus": classification["status"],
+        "detecteddisease": classification["disease"],
+        "hrv": safe_str(hrv),
+        "rr": safe_str(rr),
+        "pr": safe_str(pr),
+        "p": safe_str(p_dur),
+        "qrs": safe_str(qrs),
+        "qt": safe_str(qt),
+        "qtc": safe_str(qtc),
+    }
+
+class ECGStream:
+    """Rolling analysis state of one shirt; positions are absolute sample indices from `start`."""
+    def __init__(self, window=ECG_WINDOW_SIZE, hop=ECG_HOP_SIZE, start=0):
+        self.window = window
+        self.hop = hop
+        self.raw = np.empty(0)       # raw mV from raw_start: denoise context + not yet denoised
+        self.raw_start = start
+        self.denoised_end = start    # samples [start, denoised_end) are denoised and filtered
+        self.zi = None               # highpass state
+        self.clean = np.empty(0)     # filtered samples from clean_start up to denoised_end
+        self.clean_start = start
+        self.detected_end = start    # R-peaks before this were detected
+        self.last_r = None
+        self.beats = []              # {"r", "rr", "pr", "p", "qrs", "qt", "delineated"}, oldest first
+        self.next_row_end = start + window
+        self.rows = 0
+        self.want_full = False       # delineate the next row whatever the schedule
+        self.last_used = time.monotonic()
+
+    @property
+    def end(self):
+        """Absolute index of the next sample the stream expects."""
+        return self.raw_start + len(self.raw)
+
+    def feed(self, samples, age, gender, full=False):
+        """
+        Add raw ADC samples; returns the ecg rows of every window completed by them.
+        full=True asks for full delineation of the next row.
+        """
+        self.append(samples, full)
+        return self.consume(wavelet_denoise_batch(self.ready_blocks()), age, gender)
+
+    # feed() in two halves, so the raw blocks of many streams can be denoised in one batch
+
+    def append(self, samples, full=False):
+        self.last_used = time.monotonic()
+        self.want_full = self.want_full or full
+        self.raw = np.concatenate((self.raw, (np.asarray(samples, dtype=float) - 2048) / 200.0))
+
+    def ready_blocks(self, final=False):
+        """
+        Raw segments to denoise: each hop-sized block with a margin of raw signal
+        on both sides. final=True also returns the tail, when no more samples will come.
+        """
+        blocks = []
+        end = self.denoised_end
+        while self.end - end >= self.hop + ECG_DENOISE_MARGIN or (final and self.end > end):
+            lo = max(end - ECG_DENOISE_MARGIN, self.raw_start)
+            hi = min(end + self.hop + ECG_DENOISE_MARGIN, self.end)
+            blocks.append(self.raw[lo - self.raw_start:hi - self.raw_start])
+            end += min(self.hop, self.end - end)
+        return blocks
+
+    def consume(self, denoised_blocks, age, gender, final=False):
+        """
+        Take the denoised ready_blocks() in order; returns the ecg rows they
+        complete. final=True (after ready_blocks(final=True)) closes the stream.
+        """
+        rows = []
+        for i, denoised in enumerate(denoised_blocks):
+            self._filter_block(denoised)
+            self._detect_beats(final and i == len(denoised_blocks) - 1)
+            while self.detected_end >= self.next_row_end:
+                start = self.next_row_end - self.window
+                beats = [b for b in self.beats if start <= b["r"] < self.next_row_end]
+                full = self.want_full or self.rows % ECG_FULL_EVERY_WINDOWS == 0
+                if full:
+                    self._delineate(beats)
+                    self.want_full = False
+                rows.append(summarize_beats(beats, age, gender, full))
+                self.rows += 1
+                self.next_row_end += self.hop
+        return rows
+
+    def _filter_block(self, denoised):
+        # Only the middle of the denoised segment is kept; the margins were context
+        end = self.denoised_end
+        offset = end - max(end - ECG_DENOISE_MARGIN, self.raw_start)
+        block = denoised[offset:offset + min(self.hop, self.end - end)]
+
+        if self.zi is None:
+            self.zi = sosfilt_zi(_HIGHPASS) * block[0]
+        filtered, self.zi = sosfilt(_HIGHPASS, block, zi=self.zi)
+        self.denoised_end = end + len(block)
+
+        self.clean = np.concatenate((self.clean, filtered))
+        # Keep a window of filtered signal for peak detection
+        excess = len(self.clean) - self.window
+        if excess > 0:
+            self.clean = self.clean[excess:]
+            self.clean_start += excess
+        # Keep only the margin of raw signal before the next block
+        drop = self.denoised_end - ECG_DENOISE_MARGIN - self.raw_start
+        if drop > 0:
+            self.raw = self.raw[drop:]
+            self.raw_start += drop
+
+    def _detect_beats(self, final=False):
+        # Fast tier: R-peaks and RR of the beats not seen yet; at the end of the stream, up to its last sample
+        limit = self.denoised_end if final else self.denoised_end - ECG_BEAT_TAIL
+        for r in detect_r_peaks(self.clean) + self.clean_start:
+            if self.detected_end <= r < limit and (self.last_r is None or r > self.last_r):
+                r = int(r)
+                self.beats.append({
+                    "r": r,
+                    "rr": (r - self.last_r) * 1000 / ECG_SAMPLING_RATE if self.last_r is not None else None,
+                    "pr": None, "p": None, "qrs": None, "qt": None,
+                    "delineated": False,
+                })
+                self.last_r = r
+        del self.beats[:-ECG_MAX_BEATS]
+        self.detected_end = limit
+
+    def _delineate(self, beats):
+        # Full tier: P/Q/T waves of the window's beats that are still in the filtered signal
+        todo = [b for b in beats if not b["delineated"] and b["r"] >= self.clean_start]
+        if len(todo) < 2:
+            return
+        peaks = np.asarray([b["r"] for b in todo]) - self.clean_start
+        try:
+            _, waves = nk.ecg_delineate(self.clean, rpeaks=peaks, sampling_rate=ECG_SAMPLING_RATE, method="dwt")
+        except Exception:
+            return
+
+        def duration_ms(i, start_key, end_key):
+            start, end = waves.get(start_key), waves.get(end_key)
+            if start is None or end is None or i >= len(start) or i >= len(end):
+                return None
+            s, e = start[i], end[i]
+            if np.isnan(s) or np.isnan(e) or e <= s:
+                return None
+            return (e - s) * 1000 / ECG_SAMPLING_RATE
+
+        for i, beat in enumerate(todo):
+            beat["pr"] = duration_ms(i, "ECG_P_Onsets", "ECG_R_Onsets")
+            beat["p"] = duration_ms(i, "ECG_P_Onsets", "ECG_P_Offsets")
+            beat["qrs"] = duration_ms(i, "ECG_R_Onsets", "ECG_R_Offsets")
+            beat["qt"] = duration_ms(i, "ECG_Q_Peaks", "ECG_T_Offsets")
+            beat["delineated"] = True
+
+# --------------------- Worker Process ---------------------------
+#
+# ecg_pool.py runs this file as `python ecg_analysis.py`: msgpack tasks
+# [task id, [[smartshirt id, samples (<f8 bytes), age, gender, full, offset], ...]]
+# arrive on stdin and [task id, [[smartshirt id, [ecg row, ...]], ...], analysis ms]
+# go back on stdout, one per task. A plain subprocess rather than multiprocessing,
+# so the child never re-imports app.py. Within a web worker the pool sends all of
+# a shirt's chunks to the same child, in order, and as many queued chunks per task
+# as it has; chunks the shirt sent through other web workers show up as gaps.
+
+def analyze_chunks(streams, chunks):
+    """
+    Feed a task's chunks to their streams, denoising every ready block of every
+    shirt in one batch. A gap in a shirt's offsets adds a {"gap": missing samples}
+    row before the rows of the stream it closed.
+    """
+    live = {}       # smartshirt id -> (age, gender) of its last chunk, in arrival order
+    closing = []    # (smartshirt id, stream, age, gender) of streams no more samples will reach
+    results = []
+    for smartshirt_id, samples, age, gender, full, offset in chunks:
+        samples = np.frombuffer(samples, dtype="<f8")
+        if offset is None:
+            # Nothing says where the chunk sits in the shirt's stream, so it stands alone
+            stream = ECGStream()
+            stream.append(samples, full)
+            closing.append((smartshirt_id, stream, age, gender))
+            continue
+
+        stream = streams.get(smartshirt_id)
+        if stream is not None and offset > stream.end:
+            results.append([smartshirt_id, [{"gap": offset - stream.end}]])
+            closing.append((smartshirt_id, streams.pop(smartshirt_id), age, gender))
+            live.pop(smartshirt_id, None)
+            stream = None
+        if stream is None:
+            stream = streams[smartshirt_id] = ECGStream(start=offset)
+        # A resent chunk may overlap samples the stream already has
+        stream.append(samples[max(0, stream.end - offset):], full)
+        live[smartshirt_id] = (age, gender)
+
+    work = [(sid, stream, age, gender, True) for sid, stream, age, gender in closing]
+    work += [(sid, streams[sid], age, gender, False) for sid, (age, gender) in live.items()]
+    blocks = [stream.ready_blocks(final) for _, stream, _, _, final in work]
+    flat = wavelet_denoise_batch([block for stream_blocks in blocks for block in stream_blocks])
+
+    position = 0
+    for (sid, stream, age, gender, final), stream_blocks in zip(work, blocks):
+        denoised = flat[position:position + len(stream_blocks)]
+        position += len(stream_blocks)
+        try:
+            rows = stream.consume(denoised, age, gender, final)
+        except Exception as e:
+            if streams.get(sid) is stream:
+                streams.pop(sid)   # start the shirt over rather than carry broken state
+            rows = [{"error": f"{type(e).__name__}: {e}"}]
+        results.append([sid, rows])
+    return results
+
+def worker_main(task_fd, result_file):
+    streams = {}
+    unpacker = msgpack.Unpacker(raw=False)
+    while True:
+        chunk = os.read(task_fd, 65536)
+        if not chunk:
+            return  # parent closed the pipe
+        unpacker.feed(chunk)
+        for task_id, chunks in unpacker:
+            started = time.perf_counter()
+            try:
+                result = analyze_chunks(streams, chunks)
+            except Exception as e:
+                for smartshirt_id, *_ in chunks:
+                    streams.pop(smartshirt_id, None)
+                result = [[smartshirt_id, [{"error": f"{type(e).__name__}: {e}"}]] for smartshirt_id, *_ in chunks]
+            result_file.write(msgpack.packb([task_id, result, (time.perf_counter() - started) * 1000], use_bin_type=True))
+            result_file.flush()
+
+            # Forget shirts that stopped streaming, and hold no more than
+            # ECG_MAX_STREAMS whatever the shirt ids sent
+            now = time.monotonic()
+            for key in [k for k, s in streams.items() if now - s.last_used > ECG_STREAM_IDLE_SEC]:
+                del streams[key]
+            if len(streams) > ECG_MAX_STREAMS:
+                by_age = sorted(streams, key=lambda k: streams[k].last_used)
+                for key in by_age[:len(streams) - ECG_MAX_STREAMS]:
+                    del streams[key]
+
+if __name__ == "__main__":
+    # Keep stray prints (library warnings) off the result pipe
+    results = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    worker_main(0, results)
@@ -0,0 +1,362 @@
+import os
+import sys
+import time
+import subprocess
+from collections import deque
+import msgpack
+import numpy as np
+import gevent
+from gevent.queue import Queue, Full
+from gevent.socket import wait_read, wait_write
+from db_utils import transaction
+import recent_readings
+
+# --------------------- ECG Analysis Pool ---------------------------
+#
+# ECG is analysed (wavelet denoise + neurokit) in separate worker processes
+# instead of on the gevent hub, where one window used to stall every other
+# request of the web worker. Callers submit chunks of a shirt's ECG stream to a
+# bounded queue and get a rejection to turn into 429 when it is full; one
+# dispatcher greenlet per child process feeds it, and a writer greenlet inserts
+# the resulting ecg rows in batches.
+#
+# The children run ecg_analysis.py (no database, no gevent) and talk msgpack
+# over their stdin/stdout. Each child keeps the streaming state of the shirts it
+# analyses, so within this web worker a shirt always goes to the same child and
+# its chunks stay in order. A child that dies or hangs is replaced; its chunk is
+# counted as failed and its shirts' streams start over. The pool is per gunicorn
+# worker and starts on first use.
+#
+# Consecutive chunks of one shirt can land on different gunicorn workers, so a
+# stream never assumes it saw every chunk: chunks carry the offset of their
+# first sample, and a stream is only continued by the chunk that starts where it
+# ended (see ecg_analysis.py). Anything else closes it and counts a gap.
+
+# Config
+ECG_POOL_WORKERS = int(os.getenv("ECG_POOL_WORKERS", 1))                     # analysis processes per web worker
+ECG_QUEUE_MAX_CHUNKS = int(os.getenv("ECG_QUEUE_MAX_CHUNKS", 200))           # queued chunks per process before 429
+ECG_TASK_TIMEOUT_SEC = float(os.getenv("ECG_TASK_TIMEOUT_SEC", 30))          # child is restarted past this
+ECG_DISPATCH_MAX_CHUNKS = int(os.getenv("ECG_DISPATCH_MAX_CHUNKS", 64))      # queued chunks sent to a child as one task
+ECG_RETRY_AFTER_SEC = int(os.getenv("ECG_RETRY_AFTER_SEC", 5))
+ECG_WRITE_INTERVAL_MS = int(os.getenv("ECG_WRITE_INTERVAL_MS", 500))         # results are flushed this often
+ECG_WRITE_MAX_PENDING = int(os.getenv("ECG_WRITE_MAX_PENDING", 5000))        # unwritten rows kept while the db fails
+ECG_STOP_TIMEOUT_SEC = float(os.getenv("ECG_STOP_TIMEOUT_SEC", 3))
+ECG_METRICS_WINDOW = 1000      # recent samples kept for percentiles
+ECG_UTILIZATION_WINDOW_SEC = 60
+
+ANALYSIS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ecg_analysis.py")
+
+ECG_COLUMNS = ("smartshirtid", "bpm", "ecgstatus", "detecteddisease", "hrv", "rr", "pr", "p", "qrs", "qt", "qtc")
+INSERT_ECG_SQL = f"INSERT INTO ecg ({', '.join(ECG_COLUMNS)}) VALUES %s"
+
+_workers = []
+_greenlets = []
+_pending = []   # (smartshirt id, result) analysed but not yet written
+_full_requested = set()   # smartshirt ids (text) whose next row should be fully delineated
+_stopping = False
+_started_at = None
+_analysis_ms = deque(maxlen=ECG_METRICS_WINDOW)
+_queue_wait_ms = deque(maxlen=ECG_METRICS_WINDOW)
+_batch_sizes = deque(maxlen=ECG_METRICS_WINDOW)   # chunks per task
+_busy = deque()   # (monotonic time, busy seconds) per finished task, for utilization
+_stats = {
+    "submitted": 0,
+    "rejected_full": 0,
+    "rejected_stopped": 0,
+    "tasks": 0,
+    "chunks": 0,
+    "rows": 0,
+    "full_rows": 0,
+    "fast_rows": 0,
+    "full_requests": 0,
+    "skipped": 0,
+    "stream_gaps": 0,
+    "failed": 0,
+    "worker_restarts": 0,
+    "writes": 0,
+    "written_rows": 0,
+    "write_failures": 0,
+    "dropped_rows": 0,
+}
+
+class _Worker:
+    """One analysis child process, its queue and the read side of its result pipe."""
+    def __init__(self, index):
+        self.index = index
+        self.queue = Queue(maxsize=ECG_QUEUE_MAX_CHUNKS)
+        self.busy = False
+        self.proc = None
+        self._spawn()
+
+    def _spawn(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, ANALYSIS_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0,
+        )
+        self.unpacker = msgpack.Unpacker(raw=False)
+        self.next_id = 0
+
+    def analyze(self, chunks):
+        """
+        chunks: [(smartshirt id, samples, age, gender, full, offset), ...]. Returns
+        ([(smartshirt id text, [ecg row, ...]), ...], analysis ms); raises
+        EOFError if the child died.
+        """
+        self.next_id += 1
+        task = [self.next_id, [
+            [str(sid), np.asarray(samples, dtype="<f8").tobytes(), age, gender, full, offset]
+            for sid, samples, age, gender, full, offset in chunks
+        ]]
+        self._send(msgpack.packb(task, use_bin_type=True))
+        fd = self.proc.stdout.fileno()
+        while True:
+            for task_id, result, analysis_ms in self.unpacker:
+                if task_id == self.next_id:
+                    return result, analysis_ms
+            wait_read(fd)
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise EOFError(f"ECG worker {self.index} exited with {self.proc.poll()}")
+            self.unpacker.feed(chunk)
+
+    def _send(self, data):
+        # A task of many chunks can exceed the pipe buffer
+        fd = self.proc.stdin.fileno()
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(fd, view):]
+            except BlockingIOError:
+                wait_write(fd)
+
+    def restart(self):
+        self.kill()
+        self._spawn()
+        _stats["worker_restarts"] += 1
+
+    def kill(self):
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except Exception:
+            pass
+
+    def close(self):
+        # EOF on stdin ends the child's loop
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=2)
+        except Exception:
+            self.kill()
+
+def submit(smartshirt_id, samples, age, gender, offset=None):
+    """
+    Queue the next chunk of a shirt's ECG stream for analysis. `offset` is the
+    index of its first sample in the shirt's stream; without one the chunk is
+    analysed on its own. Returns None when accepted, or "full" / "stopped" when
+    the caller should back off.
+    """
+    if _stopping:
+        _stats["rejected_stopped"] += 1
+        return "stopped"
+    if not _workers:
+        start()
+    worker = _workers[hash(str(smartshirt_id)) % len(_workers)]
+    try:
+        worker.queue.put_nowait((time.monotonic(), smartshirt_id, samples, age, gender, offset))
+    except Full:
+        _stats["rejected_full"] += 1
+        return "full"
+    _stats["submitted"] += 1
+    return None
+
+def request_full_analysis(smartshirt_id):
+    """
+    Fully delineate (PR/QRS/QT) the shirt's next row instead of waiting for its
+    turn. Only reaches the shirt if its ECG goes through this gunicorn worker;
+    otherwise the ECG_FULL_EVERY_WINDOWS schedule still covers it.
+    """
+    key = str(smartshirt_id)
+    if key not in _full_requested:
+        _full_requested.add(key)
+        _stats["full_requests"] += 1
+
+def _next_chunks(worker):
+    # Block for the first chunk, then take whatever else is already waiting,
+    # so the child can denoise the windows of many shirts in one batch
+    items = [worker.queue.get()]
+    while len(items) < ECG_DISPATCH_MAX_CHUNKS and not worker.queue.empty():
+        items.append(worker.queue.get_nowait())
+    return items
+
+def _dispatch(worker):
+    while True:
+        items = _next_chunks(worker)
+        started = time.monotonic()
+        worker.busy = True
+        chunks, ids = [], {}
+        for submitted, smartshirt_id, samples, age, gender, offset in items:
+            _queue_wait_ms.append((started - submitted) * 1000)
+            key = str(smartshirt_id)
+            ids[key] = smartshirt_id
+            chunks.append((smartshirt_id, samples, age, gender, key in _full_requested, offset))
+            _full_requested.discard(key)
+        try:
+            with gevent.Timeout(ECG_TASK_TIMEOUT_SEC):
+                results, analysis_ms = worker.analyze(chunks)
+        except (gevent.Timeout, EOFError, OSError) as e:
+            _stats["failed"] += len(chunks)
+            print(f"❌ ECG worker {worker.index} lost {len(chunks)} chunks, restarting: {e or 'timeout'}")
+            worker.restart()
+            continue
+        except Exception as e:
+            # Never let one bad task end the dispatcher; the child may hold half a task, so replace it
+            _stats["failed"] += len(chunks)
+            print(f"❌ ECG task of {len(chunks)} chunks failed on worker {worker.index}, restarting: {e}")
+            worker.restart()
+            continue
+        finally:
+            worker.busy = False
+            _busy.append((time.monotonic(), time.monotonic() - started))
+
+        _analysis_ms.append(analysis_ms / len(chunks))   # per chunk, so batching shows up as cheaper chunks
+        _batch_sizes.append(len(chunks))
+        _stats["tasks"] += 1
+        _stats["chunks"] += len(chunks)
+        for key, rows in results:
+            smartshirt_id = ids.get(key, key)
+            for result in rows:
+                if "error" in result:
+                    _stats["failed"] += 1
+                    print(f"❌ ECG processing failed for {smartshirt_id}: {result['error']}")
+                elif "skipped" in result:
+                    _stats["skipped"] += 1
+                    print(f"⚠️ {result['skipped']} — skipping ECG window for {smartshirt_id}")
+                elif "gap" in result:
+                    _stats["stream_gaps"] += 1
+                    print(f"⚠️ {result['gap']} ECG samples of {smartshirt_id} missing here, starting a new stream")
+                else:
+                    _stats["rows"] += 1
+                    _stats[f"{result['tier']}_rows"] += 1
+                    _pending.append((smartshirt_id, result))
+
+# ------- Batched Write-back -------
+
+def flush():
+    """Insert every analysed window waiting to be written in one statement."""
+    global _pending
+    if not _pending:
+        return
+    batch, _pending = _pending, []
+    rows = [(sid,) + tuple(result[c] for c in ECG_COLUMNS[1:]) for sid, result in batch]
+    try:
+        with transaction() as tx:
+            tx.execute_values(INSERT_ECG_SQL, rows)
+            # Lets workers serve the latest ECG row from memory only if they wrote it
+            seqs = recent_readings.bump_ecg_markers(tx, [sid for sid, _ in batch])
+    except Exception as e:
+        _stats["write_failures"] += 1
+        # Keep the rows for the next round, oldest dropped past the limit
+        retry = batch + _pending
+        _stats["dropped_rows"] += max(0, len(retry) - ECG_WRITE_MAX_PENDING)
+        _pending = retry[-ECG_WRITE_MAX_PENDING:]
+        print(f"⚠️ ECG result write failed, {len(_pending)} rows pending: {e}")
+        return
+    _stats["writes"] += 1
+    _stats["written_rows"] += len(rows)
+    for sid, result in batch:
+        recent_readings.record_ecg_status(sid, {
+            key: result[key] for key in ("bpm", "hrv", "rr", "pr", "p", "qrs", "qt", "qtc", "ecgstatus", "quality", "tier")
+        }, seqs.get(str(sid)))
+
+def _write_loop():
+    while True:
+        gevent.sleep(ECG_WRITE_INTERVAL_MS / 1000)
+        try:
+            flush()
+        except Exception as e:
+            print(f"❌ ECG result writer error: {e}")
+
+# ------- Lifecycle -------
+
+def start():
+    """Spawn the analysis processes, their dispatchers and the result writer."""
+    global _started_at
+    if _workers:
+        return
+    _started_at = time.monotonic()
+    for index in range(ECG_POOL_WORKERS):
+        worker = _Worker(index)
+        _workers.append(worker)
+        _greenlets.append(gevent.spawn(_dispatch, worker))
+    _greenlets.append(gevent.spawn(_write_loop))
+    print(f"✅ ECG pool started ({ECG_POOL_WORKERS} processes, max {ECG_QUEUE_MAX_CHUNKS} queued chunks each)")
+
+def stop(timeout=ECG_STOP_TIMEOUT_SEC):
+    """Stop accepting chunks, give the queues `timeout` seconds, write what was analysed."""
+    global _stopping
+    _stopping = True
+    if not _workers:
+        return
+    deadline = time.monotonic() + timeout
+    while any(w.busy or not w.queue.empty() for w in _workers) and time.monotonic() < deadline:
+        gevent.sleep(0.05)
+    left = sum(w.queue.qsize() for w in _workers)
+    if left:
+        print(f"⚠️ ECG pool stopping with {left} chunks unanalysed")
+    gevent.killall(_greenlets)
+    _greenlets.clear()
+    for worker in _workers:
+        worker.close()
+    _workers.clear()
+    flush()
+
+# ------- Metrics -------
+
+def _summary(samples):
+    if not samples:
+        return None, None, None
+    p50, p95 = np.percentile(samples, [50, 95])
+    return round(float(p50), 2), round(float(p95), 2), round(float(max(samples)), 2)
+
+def _utilization():
+    if not _workers or _started_at is None:
+        return 0.0
+    now = time.monotonic()
+    cutoff = now - ECG_UTILIZATION_WINDOW_SEC
+    while _busy and _busy[0][0] < cutoff:
+        _busy.popleft()
+    span = min(ECG_UTILIZATION_WINDOW_SEC, now - _started_at) or 1
+    return min(1.0, sum(busy for _, busy in _busy) / (span * len(_workers)))
+
+def ecg_pool_stats():
+    analysis_p50, analysis_p95, analysis_max = _summary(_analysis_ms)
+    wait_p50, wait_p95, wait_max = _summary(_queue_wait_ms)
+    return {
+        "workers": len(_workers),
+        "workers_busy": sum(1 for w in _workers if w.busy),
+        "worker_utilization": round(_utilization(), 3),
+        "queue_depth": sum(w.queue.qsize() for w in _workers),
+        "queue_capacity": ECG_QUEUE_MAX_CHUNKS * ECG_POOL_WORKERS,
+        "pending_writes": len(_pending),
+        "analysis_ms_p50": analysis_p50,
+        "analysis_ms_p95": analysis_p95,
+        "analysis_ms_max": analysis_max,
+        "queue_wait_ms_p50": wait_p50,
+        "queue_wait_ms_p95": wait_p95,
+        "queue_wait_ms_max": wait_max,
+        "chunks_per_task": round(float(np.mean(_batch_sizes)), 2) if _batch_sizes else None,
+        "stopping": _stopping,
+        **_stats,
+    }
+
+def metrics_text():
+    """Prometheus gauges/counters for the ECG analysis pool."""
+    lines = []
+    for key, value in ecg_pool_stats().items():
+        if value is None:
+            continue
+        kind = "counter" if key in _stats else "gauge"
+        lines.append(f"# TYPE ecg_pool_{key} {kind}")
+        lines.append(f"ecg_pool_{key} {int(value) if isinstance(value, bool) else value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,16 @@
+# gunicorn picks this file up automatically from the working directory.
+# The CLI flags in the Dockerfile still set bind / worker class / timeout.
+
+# Leave time for the ingest queue to drain before the arbiter kills the worker
+graceful_timeout = 30
+
+def worker_exit(server, worker):
+    # Runs inside the worker process once it stops taking requests
+    import ingest_queue
+    import ingest_spool
+    import ecg_pool
+    ingest_queue.drain()
+    # Release the open spool segment so the surviving workers replay it
+    ingest_spool.close()
+    # Write what the ECG processes already analysed, then stop them
+    ecg_pool.stop()
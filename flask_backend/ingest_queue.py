@@ -0,0 +1,191 @@
+import os
+import time
+from collections import deque
+import gevent
+from gevent.queue import Queue, Full, Empty
+from gevent.event import Event
+
+# --------------------- Write-behind Ingest Queue ---------------------------
+#
+# /sensor hands readings to a bounded queue and returns straight away; a small
+# pool of writer greenlets drains it, coalescing batches from different shirts
+# into one database write. When the queue is full the caller gets a rejection
+# to turn into 429 + Retry-After instead of piling up greenlets; during
+# shutdown it gets 503 while the writers drain what is already queued.
+
+# Config
+INGEST_QUEUE_MAX_BATCHES = int(os.getenv("INGEST_QUEUE_MAX_BATCHES", 500))     # queued batches before 429
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))                           # writer greenlets per process
+INGEST_COALESCE_MAX_ROWS = int(os.getenv("INGEST_COALESCE_MAX_ROWS", 2000))    # rows merged into one write
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", 3))
+INGEST_RETRY_AFTER_SEC = int(os.getenv("INGEST_RETRY_AFTER_SEC", 2))
+INGEST_DRAIN_TIMEOUT_SEC = float(os.getenv("INGEST_DRAIN_TIMEOUT_SEC", 25))
+INGEST_RATE_WINDOW_SEC = 60
+
+_queue = Queue(maxsize=INGEST_QUEUE_MAX_BATCHES)
+_workers = []
+_handler = None
+_on_drop = None
+_draining = False
+_idle = Event()
+_idle.set()
+_in_flight = 0
+_queued_rows = 0
+_drained = deque()  # (monotonic time, rows) per completed write, for the drain rate
+_stats = {
+    "accepted_batches": 0,
+    "accepted_rows": 0,
+    "rejected_full": 0,
+    "rejected_draining": 0,
+    "written_rows": 0,
+    "writes": 0,
+    "retries": 0,
+    "split_writes": 0,
+    "dropped_rows": 0,
+}
+
+def submit(batch, ids):
+    """
+    Queue one shirt's readings for writing. Returns None when accepted, or
+    "full" / "draining" when the caller should back off.
+    """
+    global _queued_rows
+    if _draining or not _workers:
+        _stats["rejected_draining"] += 1
+        return "draining"
+    try:
+        _queue.put_nowait((batch, ids))
+    except Full:
+        _stats["rejected_full"] += 1
+        return "full"
+    _idle.clear()
+    _queued_rows += len(batch)
+    _stats["accepted_batches"] += 1
+    _stats["accepted_rows"] += len(batch)
+    return None
+
+def _next_group():
+    # Block for the first batch, then take whatever else is already waiting
+    group = [_queue.get()]
+    rows = len(group[0][0])
+    while rows < INGEST_COALESCE_MAX_ROWS:
+        try:
+            item = _queue.get_nowait()
+        except Empty:
+            break
+        group.append(item)
+        rows += len(item[0])
+    return group, rows
+
+def _written(rows):
+    _stats["writes"] += 1
+    _stats["written_rows"] += rows
+    _drained.append((time.monotonic(), rows))
+
+def _dropped(group, rows, e):
+    _stats["dropped_rows"] += rows
+    print(f"❌ Ingest write failed, dropping {rows} rows: {e}")
+    if _on_drop:
+        _on_drop(group)
+
+def _write(group, rows):
+    for attempt in range(INGEST_MAX_RETRIES + 1):
+        try:
+            _handler(group)
+            _written(rows)
+            return
+        except Exception as e:
+            error = e
+            if attempt == INGEST_MAX_RETRIES:
+                print(f"⚠️ Ingest write of {len(group)} batches failed after {attempt + 1} attempts: {e}")
+                break
+            _stats["retries"] += 1
+            print(f"⚠️ Ingest write failed (attempt {attempt + 1}), retrying: {e}")
+            gevent.sleep(0.5 * 2 ** attempt)
+
+    if len(group) == 1:
+        _dropped(group, rows, error)
+        return
+    # One bad batch (say, a constraint violation) fails the whole coalesced write;
+    # write each batch on its own once so its neighbours still land
+    _stats["split_writes"] += 1
+    for batch, ids in group:
+        try:
+            _handler([(batch, ids)])
+            _written(len(batch))
+        except Exception as e:
+            _dropped([(batch, ids)], len(batch), e)
+
+def _worker():
+    global _in_flight, _queued_rows
+    while True:
+        group, rows = _next_group()
+        _in_flight += 1
+        _queued_rows -= rows
+        try:
+            _write(group, rows)
+        finally:
+            _in_flight -= 1
+            if _in_flight == 0 and _queue.empty():
+                _idle.set()
+
+def start(handler, on_drop=None):
+    """
+    Start the writer greenlets. `handler` receives a list of (batch, ids) and
+    raises on failure; once retries are exhausted each batch is tried on its
+    own, and `on_drop` gets a list of the ones that still failed.
+    """
+    global _handler, _on_drop
+    if _workers:
+        return
+    _handler = handler
+    _on_drop = on_drop
+    for _ in range(INGEST_WORKERS):
+        _workers.append(gevent.spawn(_worker))
+    print(f"✅ Ingest queue started ({INGEST_WORKERS} writers, max {INGEST_QUEUE_MAX_BATCHES} batches)")
+
+def drain(timeout=INGEST_DRAIN_TIMEOUT_SEC):
+    """Stop accepting work and wait for queued and in-flight writes to finish."""
+    global _draining
+    _draining = True
+    pending = _queue.qsize() + _in_flight
+    print(f"⏳ Draining ingest queue ({pending} batches pending)")
+    if not _idle.wait(timeout):
+        print(f"⚠️ Ingest drain timed out, {_queued_rows} rows still queued")
+    else:
+        print("✅ Ingest queue drained")
+    gevent.killall(_workers)
+    _workers.clear()
+
+    # Whatever is still queued goes to on_drop rather than dying with the process
+    leftover = []
+    while not _queue.empty():
+        leftover.append(_queue.get_nowait())
+    if leftover and _on_drop:
+        _on_drop(leftover)
+
+def _drain_rate():
+    cutoff = time.monotonic() - INGEST_RATE_WINDOW_SEC
+    while _drained and _drained[0][0] < cutoff:
+        _drained.popleft()
+    return sum(rows for _, rows in _drained) / INGEST_RATE_WINDOW_SEC
+
+def ingest_stats():
+    return {
+        "queue_depth": _queue.qsize(),
+        "queue_rows": _queued_rows,
+        "queue_capacity": INGEST_QUEUE_MAX_BATCHES,
+        "in_flight": _in_flight,
+        "drain_rows_per_sec": round(_drain_rate(), 2),
+        "draining": _draining,
+        **_stats,
+    }
+
+def metrics_text():
+    """Prometheus gauges/counters for the ingest queue."""
+    lines = []
+    for key, value in ingest_stats().items():
+        kind = "counter" if key in _stats else "gauge"
+        lines.append(f"# TYPE ingest_{key} {kind}")
+        lines.append(f"ingest_{key} {int(value) if isinstance(value, bool) else value}")
+    return "\n".join(lines) + "\n"
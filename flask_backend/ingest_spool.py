@@ -0,0 +1,366 @@
+import os
+import time
+import glob
+import zlib
+import fcntl
+import struct
+import msgpack
+import numpy as np
+import psycopg2
+import gevent
+from gevent.event import Event
+from gevent.lock import RLock
+from binary_ingest import VitalsColumns
+from db_utils import PoolTimeout
+
+# --------------------- Durable Ingest Spool ---------------------------
+#
+# Where readings go when they cannot reach Postgres right now: the ingest queue is
+# full, the worker is shutting down, or the writer has given up retrying. Each
+# batch is appended to a local segment file and fsynced in groups (one fsync per
+# SPOOL_FSYNC_INTERVAL_MS, however many requests are waiting on it), so /sensor
+# can still answer 200 ("spooled") without waiting for the database. That hides
+# the backpressure of a full queue from clients until the spooled backlog passes
+# SPOOL_MAX_BYTES; then append() raises SpoolFull and they get 429 again.
+#
+# A replayer greenlet in every worker loads closed segments back through the
+# normal batch writer once the database answers again. health_vitals' unique
+# (smartshirtid, timestamp) plus ON CONFLICT DO NOTHING make a replay that is cut
+# short and repeated insert every reading exactly once. Connection-level errors
+# pause the replay until the next round; any other failure is the data's fault,
+# so the records that still fail on their own are moved to the quarantine
+# directory (same framing, for inspection) and the replay carries on.
+#
+# Files: spool-<epoch ms>-<pid>-<seq>.seg, so name order is age order. The writing process holds an flock on its open
+# segment; any segment a replayer can lock is closed (rotated, or its worker died).
+# Record framing: <u32 length><u32 crc32><msgpack {"ids", "json" | "bin"}>.
+#
+# Appends, rotation and close hold _lock, so nothing is written to a segment that
+# is being fsynced for closing. Every appended byte gets a position in this
+# process's spool; a waiting append returns once an fsync that started after its
+# write has completed, not merely the next one to finish.
+
+# Config
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingest_spool"))
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024))
+SPOOL_SEGMENT_MAX_AGE_SEC = int(os.getenv("SPOOL_SEGMENT_MAX_AGE_SEC", 30))   # rotate so replay is not held back
+SPOOL_FSYNC_INTERVAL_MS = int(os.getenv("SPOOL_FSYNC_INTERVAL_MS", 50))
+SPOOL_REPLAY_INTERVAL_SEC = int(os.getenv("SPOOL_REPLAY_INTERVAL_SEC", 10))
+SPOOL_REPLAY_BATCH_ROWS = int(os.getenv("SPOOL_REPLAY_BATCH_ROWS", 5000))
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", 512 * 1024 * 1024))        # backlog past which ingest gets 429 again
+SPOOL_QUARANTINE_DIR = os.getenv("SPOOL_QUARANTINE_DIR", os.path.join(INGEST_SPOOL_DIR, "quarantine"))
+SPOOL_BACKLOG_CHECK_SEC = 1
+
+# The database is unreachable or overloaded: retry later. Anything else fails again on replay.
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+
+_HEADER = struct.Struct("<II")
+
+class SpoolFull(Exception):
+    pass
+
+_segment = None        # open file object of the current segment
+_segment_opened = 0.0
+_seq = 0
+_lock = RLock()        # held by append, rotation and close
+_written = 0           # bytes appended by this process, across segments
+_synced = 0            # of those, how many a completed fsync covers
+_sync_event = Event()  # set whenever _synced advances; swapped for a new one each time
+_handler = None
+_greenlets = []
+_quarantine = None     # open quarantine file of this process
+_backlog = {"bytes": 0, "checked_at": None}
+_stats = {
+    "appended_batches": 0,
+    "appended_rows": 0,
+    "fsyncs": 0,
+    "replayed_batches": 0,
+    "replayed_rows": 0,
+    "replayed_segments": 0,
+    "replay_failures": 0,
+    "corrupt_segments": 0,
+    "rejected_full": 0,
+    "quarantined_records": 0,
+    "quarantined_rows": 0,
+}
+_last_replay_error = None
+_last_fsync_ms = None
+
+# ------- Encoding -------
+
+def _frame(payload):
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def _encode(batch, ids):
+    if isinstance(batch, VitalsColumns):
+        body = {"bin": {
+            "ts": batch.ts_ms.astype("<i8").tobytes(),
+            "ecg": batch.ecg.astype("<u2").tobytes(),
+            "resp": batch.resp.astype("<f4").tobytes(),
+            "temp": batch.temp.astype("<f4").tobytes(),
+        }}
+    else:
+        body = {"json": batch}
+    return _frame(msgpack.packb({"ids": ids, **body}, use_bin_type=True))
+
+def _decode(payload):
+    record = msgpack.unpackb(payload, raw=False)
+    if "bin" in record:
+        b = record["bin"]
+        batch = VitalsColumns(
+            np.frombuffer(b["ts"], dtype="<i8"), np.frombuffer(b["ecg"], dtype="<u2"),
+            np.frombuffer(b["resp"], dtype="<f4"), np.frombuffer(b["temp"], dtype="<f4"),
+        )
+    else:
+        batch = record["json"]
+    return batch, record["ids"]
+
+def _read_segment(path):
+    """Yield raw record payloads; stops at a torn or corrupt tail."""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            length, crc = _HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                _stats["corrupt_segments"] += 1
+                print(f"⚠️ Spool segment {os.path.basename(path)} has a torn/corrupt record, skipping the rest")
+                return
+            yield payload
+
+# ------- Writing -------
+
+def _open_segment():
+    global _segment, _segment_opened, _seq
+    os.makedirs(INGEST_SPOOL_DIR, exist_ok=True)
+    _seq += 1
+    path = os.path.join(INGEST_SPOOL_DIR, f"spool-{int(time.time() * 1000):013d}-{os.getpid()}-{_seq:06d}.seg")
+    _segment = open(path, "ab")
+    fcntl.flock(_segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    _segment_opened = time.monotonic()
+
+def _fsync(f):
+    f.flush()
+    # fsync blocks the OS thread; keep it off the hub
+    gevent.get_hub().threadpool.apply(os.fsync, (f.fileno(),))
+
+def _mark_synced(position):
+    global _synced, _sync_event
+    if position > _synced:
+        _synced = position
+        done, _sync_event = _sync_event, Event()
+        done.set()
+
+def _close_segment():
+    # fsync first, then releasing the flock hands the segment to the replayers.
+    # Callers hold _lock, so nothing lands in the segment while it is synced and closed.
+    global _segment
+    if _segment is None:
+        return
+    position = _written
+    _fsync(_segment)
+    empty = _segment.tell() == 0
+    path = _segment.name
+    _segment.close()
+    _segment = None
+    _mark_synced(position)
+    if empty:
+        os.remove(path)
+
+def _backlog_bytes():
+    now = time.monotonic()
+    if _backlog["checked_at"] is None or now - _backlog["checked_at"] >= SPOOL_BACKLOG_CHECK_SEC:
+        total = 0
+        for path in _segments():
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        _backlog["bytes"], _backlog["checked_at"] = total, now
+    return _backlog["bytes"]
+
+def append(batch, ids, wait=True, limit=True):
+    """
+    Spool one shirt's readings. With wait=True, returns once they are fsynced.
+    Raises SpoolFull past SPOOL_MAX_BYTES unless limit=False (readings already
+    acknowledged to the client, which must not be lost).
+    """
+    global _written
+    if limit and _backlog_bytes() >= SPOOL_MAX_BYTES:
+        _stats["rejected_full"] += 1
+        raise SpoolFull(f"Ingest spool holds {_backlog['bytes']} bytes (limit {SPOOL_MAX_BYTES})")
+    record = _encode(batch, ids)
+    with _lock:
+        if _segment is None or _segment.tell() >= SPOOL_SEGMENT_BYTES:
+            _close_segment()
+            _open_segment()
+        _segment.write(record)
+        _written += len(record)
+        position = _written
+    _stats["appended_batches"] += 1
+    _stats["appended_rows"] += len(batch)
+    if wait:
+        while _synced < position:
+            _sync_event.wait()
+
+def _sync_round():
+    global _last_fsync_ms
+    if _segment is None or _synced >= _written:
+        return
+    # Everything written so far is flushed to the fd before the fsync starts.
+    # The fsync runs on a duplicate fd, so a rotation closing the segment
+    # meanwhile cannot pull it out from under the threadpool.
+    position = _written
+    _segment.flush()
+    fd = os.dup(_segment.fileno())
+    started = time.monotonic()
+    try:
+        gevent.get_hub().threadpool.apply(os.fsync, (fd,))
+    finally:
+        os.close(fd)
+    _last_fsync_ms = round((time.monotonic() - started) * 1000, 2)
+    _stats["fsyncs"] += 1
+    _mark_synced(position)
+
+def _fsync_loop():
+    while True:
+        gevent.sleep(SPOOL_FSYNC_INTERVAL_MS / 1000)
+        try:
+            _sync_round()
+            if _segment is not None and time.monotonic() - _segment_opened > SPOOL_SEGMENT_MAX_AGE_SEC:
+                with _lock:
+                    _close_segment()
+        except Exception as e:
+            # Waiters stay blocked until a later round gets the bytes to disk
+            print(f"❌ Spool fsync failed: {e}")
+
+# ------- Replay -------
+
+def _quarantine_record(payload, rows, reason):
+    global _quarantine
+    if _quarantine is None:
+        os.makedirs(SPOOL_QUARANTINE_DIR, exist_ok=True)
+        _quarantine = open(os.path.join(SPOOL_QUARANTINE_DIR, f"quarantine-{int(time.time() * 1000):013d}-{os.getpid()}.seg"), "ab")
+    _quarantine.write(_frame(payload))
+    _fsync(_quarantine)
+    _stats["quarantined_records"] += 1
+    _stats["quarantined_rows"] += rows
+    print(f"☣️ Quarantined a spooled record of {rows} readings: {reason}")
+
+def _replay_group(group):
+    """group: [(payload, batch, ids)]. Raises TRANSIENT_ERRORS; quarantines records that fail on their own."""
+    try:
+        _handler([(batch, ids) for _, batch, ids in group])
+    except TRANSIENT_ERRORS:
+        raise
+    except Exception as e:
+        if len(group) == 1:
+            _quarantine_record(group[0][0], len(group[0][1]), f"{type(e).__name__}: {e}")
+            return
+        # One bad record fails the whole transaction; find it
+        for record in group:
+            _replay_group([record])
+        return
+    _stats["replayed_batches"] += len(group)
+    _stats["replayed_rows"] += sum(len(batch) for _, batch, _ in group)
+
+def _replay_segment(path):
+    group, rows = [], 0
+    for payload in _read_segment(path):
+        try:
+            batch, ids = _decode(payload)
+        except Exception as e:
+            _quarantine_record(payload, 0, f"undecodable: {type(e).__name__}: {e}")
+            continue
+        group.append((payload, batch, ids))
+        rows += len(batch)
+        if rows >= SPOOL_REPLAY_BATCH_ROWS:
+            _replay_group(group)
+            group, rows = [], 0
+    if group:
+        _replay_group(group)
+
+def replay_once():
+    """Replay every closed segment, oldest first; stops at the first connection-level database failure."""
+    global _last_replay_error
+    for path in sorted(_segments()):
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            continue  # another worker just finished it
+        try:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # still being written, or another worker is replaying it
+            if not os.path.exists(path):
+                continue
+            try:
+                _replay_segment(path)
+            except TRANSIENT_ERRORS as e:
+                _stats["replay_failures"] += 1
+                _last_replay_error = f"{type(e).__name__}: {e}"
+                print(f"⚠️ Spool replay paused, database still failing: {e}")
+                return
+            os.remove(path)
+            _stats["replayed_segments"] += 1
+            _last_replay_error = None
+            print(f"✅ Replayed spool segment {os.path.basename(path)}")
+        finally:
+            f.close()
+
+def _replay_loop():
+    while True:
+        gevent.sleep(SPOOL_REPLAY_INTERVAL_SEC)
+        try:
+            replay_once()
+        except Exception as e:
+            print(f"❌ Spool replayer error: {e}")
+
+def start(handler):
+    """Start the fsync and replay greenlets; `handler` takes a list of (batch, ids) like the ingest queue's."""
+    global _handler
+    if _greenlets:
+        return
+    _handler = handler
+    _greenlets.append(gevent.spawn(_fsync_loop))
+    _greenlets.append(gevent.spawn(_replay_loop))
+
+def close():
+    """Flush and release the current segment so other workers can replay it."""
+    global _quarantine
+    with _lock:
+        _close_segment()
+    if _quarantine is not None:
+        _quarantine.close()
+        _quarantine = None
+
+# ------- Status -------
+
+def _segments():
+    return glob.glob(os.path.join(INGEST_SPOOL_DIR, "spool-*.seg"))
+
+def spool_status():
+    segments = _segments()
+    sizes, mtimes = [], []
+    for path in segments:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        sizes.append(st.st_size)
+        mtimes.append(st.st_mtime)
+    return {
+        "dir": INGEST_SPOOL_DIR,
+        "segments": len(sizes),
+        "backlog_bytes": sum(sizes),
+        "max_bytes": SPOOL_MAX_BYTES,
+        "quarantine_dir": SPOOL_QUARANTINE_DIR,
+        "oldest_segment_age_sec": round(time.time() - min(mtimes), 1) if mtimes else None,
+        "current_segment": os.path.basename(_segment.name) if _segment is not None else None,
+        "last_fsync_ms": _last_fsync_ms,
+        "last_replay_error": _last_replay_error,
+        **_stats,
+    }
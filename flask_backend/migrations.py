@@ -0,0 +1,373 @@
+import re
+import sys
+import json
+from db_utils import get_db_connection
+
+# --------------------- Schema Migrations ---------------------------
+#
+# Usage:
+#   python migrations.py migrate   # apply pending migrations
+#   python migrations.py check     # EXPLAIN the hot queries, exit 1 on a sequential scan
+#
+# Each entry is (version, name, statements, transactional). Index builds use
+# CREATE INDEX CONCURRENTLY so they never block ingest writes, which only works
+# outside a transaction; those migrations run in autocommit, one statement at a time.
+# Transactional migrations run all their statements in one BEGIN/COMMIT.
+#
+# A concurrent build that fails (or is interrupted) leaves an INVALID index behind,
+# which IF NOT EXISTS would then skip forever; migrate() drops such an index and
+# builds it again.
+
+MIGRATIONS = [
+    (1, "hot_read_path_indexes", [
+        # Trend / insights / report range scans: patient + time, covering the vitals columns
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_health_vitals_patient_ts
+        ON health_vitals (patientid, timestamp)
+        INCLUDE (id, respiration_rate, temperature, ecg)
+        """,
+        # Latest-per-shirt lookups and the ECG → health_vitals join on smartshirtid
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_health_vitals_shirt_ts
+        ON health_vitals (smartshirtid, timestamp)
+        """,
+        # Classified rows joined back to health_vitals
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_temperature_hv
+        ON temperature (healthvitalsid)
+        INCLUDE (temperature, temperaturestatus)
+        """,
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_respiration_hv
+        ON respiration (healthvitalsid)
+        INCLUDE (respiration, respirationstatus)
+        """,
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_ecg_hv
+        ON ecg (healthvitalsid)
+        INCLUDE (bpm, ecgstatus)
+        """,
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_ecg_shirt
+        ON ecg (smartshirtid)
+        """,
+        # /get_reports: patient + recent sessions, newest first
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reports_patient_session_end
+        ON reports (patient_id, session_end DESC)
+        """,
+        # Logins compare LOWER(email)
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_lower_email
+        ON users (LOWER(email))
+        """,
+        # Profile joins from patients / specialists to users
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_patients_userid
+        ON patients (userid)
+        """,
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_health_specialist_userid
+        ON health_specialist (userid)
+        """,
+    ], False),
+    (2, "prepare_health_vitals_partitioning", [
+        # Everything migration 3 would otherwise build while it holds ACCESS
+        # EXCLUSIVE on health_vitals is built here, with ingest still writing.
+        # The partitioned primary key needs (id, timestamp); built concurrently, it
+        # becomes the legacy partition's key in migration 3.
+        """
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS health_vitals_id_ts_key
+        ON health_vitals (id, timestamp)
+        """,
+        # Backs the legacy partition's share of the (smartshirtid, timestamp) unique
+        # constraint. Duplicate readings already in the table fail the build (and
+        # leave it INVALID, rebuilt on the next run); remove them first.
+        """
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS health_vitals_shirt_ts_key
+        ON health_vitals (smartshirtid, timestamp)
+        """,
+        # A validated NOT NULL CHECK spares the key swap in migration 3 a scan for
+        # NULL timestamps. It holds no time bound, so nothing breaks if migration 3
+        # runs much later; the range is only fixed when the table is attached.
+        # NOT VALID only takes the lock for the catalog update.
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                           WHERE conrelid = 'health_vitals'::regclass AND conname = 'health_vitals_ts_not_null') THEN
+                ALTER TABLE health_vitals ADD CONSTRAINT health_vitals_ts_not_null CHECK (timestamp IS NOT NULL) NOT VALID;
+            END IF;
+        END $$
+        """,
+        # Validation scans under SHARE UPDATE EXCLUSIVE, so writes carry on meanwhile
+        "ALTER TABLE health_vitals VALIDATE CONSTRAINT health_vitals_ts_not_null",
+    ], False),
+    (3, "partition_health_vitals_by_time", [
+        # Partition bounds are UTC days whatever the server's TimeZone
+        "SET LOCAL TIME ZONE 'UTC'",
+        # Keep the existing rows where they are; they become the first partition
+        "ALTER TABLE health_vitals RENAME TO health_vitals_legacy",
+        # Foreign keys cannot reference health_vitals(id) alone once the table is
+        # partitioned (unique keys must include the partition column). Expiring a
+        # partition deletes its temperature / respiration / ecg rows instead (partitions.py).
+        """
+        DO $$
+        DECLARE fk record;
+        BEGIN
+            FOR fk IN
+                SELECT conrelid::regclass AS tbl, conname
+                FROM pg_constraint
+                WHERE contype = 'f' AND confrelid = 'health_vitals_legacy'::regclass
+            LOOP
+                EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', fk.tbl, fk.conname);
+            END LOOP;
+        END $$
+        """,
+        # Swap the legacy key on (id) for the (id, timestamp) index from migration 2;
+        # the validated NOT NULL CHECK spares SET NOT NULL a scan
+        """
+        DO $$
+        DECLARE pk name;
+        BEGIN
+            SELECT conname INTO pk
+            FROM pg_constraint
+            WHERE contype = 'p' AND conrelid = 'health_vitals_legacy'::regclass;
+            IF pk IS NOT NULL THEN
+                EXECUTE format('ALTER TABLE health_vitals_legacy DROP CONSTRAINT %I', pk);
+            END IF;
+        END $$
+        """,
+        "ALTER TABLE health_vitals_legacy ADD CONSTRAINT health_vitals_legacy_pkey PRIMARY KEY USING INDEX health_vitals_id_ts_key",
+        # ATTACH only reuses a partition index for a constraint if it backs one too
+        "ALTER TABLE health_vitals_legacy ADD CONSTRAINT health_vitals_legacy_shirt_ts_key UNIQUE USING INDEX health_vitals_shirt_ts_key",
+        """
+        CREATE TABLE health_vitals (LIKE health_vitals_legacy INCLUDING DEFAULTS)
+        PARTITION BY RANGE (timestamp)
+        """,
+        # id numbering carries on from the legacy table. A serial id's nextval()
+        # default was copied above; its sequence moves to the new table so expiring
+        # the legacy partition cannot drop it. An identity id is not copied by LIKE
+        # and a partition may not have its own, so the parent takes it over.
+        """
+        DO $$
+        DECLARE
+            seq text := pg_get_serial_sequence('health_vitals_legacy', 'id');
+            next_id bigint;
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_attribute
+                       WHERE attrelid = 'health_vitals_legacy'::regclass AND attname = 'id' AND attidentity <> '') THEN
+                SELECT coalesce(max(id), 0) + 1 INTO next_id FROM health_vitals_legacy;
+                ALTER TABLE health_vitals_legacy ALTER COLUMN id DROP IDENTITY;
+                ALTER TABLE health_vitals ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+                EXECUTE format('ALTER TABLE health_vitals ALTER COLUMN id RESTART WITH %s', next_id);
+            ELSIF seq IS NOT NULL THEN
+                EXECUTE format('ALTER SEQUENCE %s OWNED BY health_vitals.id', seq);
+            END IF;
+        END $$
+        """,
+        "ALTER TABLE health_vitals ADD PRIMARY KEY (id, timestamp)",
+        # Same duplicate guard the ingest paths rely on via ON CONFLICT DO NOTHING
+        "ALTER TABLE health_vitals ADD CONSTRAINT health_vitals_shirt_ts_key UNIQUE (smartshirtid, timestamp)",
+        """
+        CREATE INDEX idx_hv_part_patient_ts
+        ON health_vitals (patientid, timestamp)
+        INCLUDE (id, respiration_rate, temperature, ecg)
+        """,
+        # Legacy rows cover everything up to midnight UTC after today or after the
+        # newest reading; partitions.py creates the day/week partitions from there on.
+        # The rename above keeps writers out, so the bound cannot go stale before it
+        # is attached. Proving it costs ATTACH one scan of the legacy table under the
+        # lock; the primary key, unique and patient/timestamp indexes are reused as built.
+        """
+        DO $$
+        DECLARE cutover timestamp;
+        BEGIN
+            SELECT greatest(date_trunc('day', now() AT TIME ZONE 'UTC'), date_trunc('day', max(timestamp))) + interval '1 day'
+            INTO cutover
+            FROM health_vitals_legacy;
+            EXECUTE format(
+                'ALTER TABLE health_vitals ATTACH PARTITION health_vitals_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+                cutover
+            );
+        END $$
+        """,
+        # The partition constraint covers it from here (legacy_range is what an earlier
+        # version of migration 2 added)
+        "ALTER TABLE health_vitals_legacy DROP CONSTRAINT IF EXISTS health_vitals_ts_not_null",
+        "ALTER TABLE health_vitals_legacy DROP CONSTRAINT IF EXISTS health_vitals_legacy_range",
+        # Catches readings with clock-skewed timestamps outside any partition
+        "CREATE TABLE health_vitals_default PARTITION OF health_vitals DEFAULT",
+    ], True),
+    (4, "patient_write_markers", [
+        # One row per patient, bumped by every transaction that writes its readings
+        # or ECG rows; recent_readings.py compares it with what a worker's ring
+        # buffer saw before serving from memory
+        """
+        CREATE TABLE IF NOT EXISTS patient_write_marker (
+            patientid UUID PRIMARY KEY,
+            vitals_seq BIGINT NOT NULL DEFAULT 0,
+            vitals_newest_ms BIGINT,
+            ecg_seq BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+    ], True),
+]
+
+# Representative shapes of the hot queries in app.py; %(patient)s is filled from the DB
+HOT_QUERIES = {
+    "temperature_trends": """
+        SELECT hv.timestamp, t.temperature, t.temperaturestatus
+        FROM health_vitals hv
+        JOIN temperature t ON hv.id = t.healthvitalsid
+        WHERE hv.patientID = %(patient)s AND hv.timestamp >= now() - interval '24 hours'
+        ORDER BY hv.timestamp ASC
+    """,
+    "respiration_trends": """
+        SELECT hv.timestamp, r.respiration, r.respirationstatus
+        FROM health_vitals hv
+        JOIN respiration r ON hv.id = r.healthvitalsid
+        WHERE hv.patientID = %(patient)s AND hv.timestamp >= now() - interval '24 hours'
+        ORDER BY hv.timestamp ASC
+    """,
+    "ecg_trends": """
+        SELECT hv.timestamp, e.bpm, e.ecgstatus
+        FROM health_vitals hv
+        JOIN ecg e ON hv.id = e.healthvitalsid
+        WHERE hv.patientID = %(patient)s AND hv.timestamp >= now() - interval '24 hours'
+        ORDER BY hv.timestamp ASC
+    """,
+    "patient_insights_latest": """
+        SELECT respiration_rate, temperature, ecg, timestamp
+        FROM health_vitals
+        WHERE patientid = %(patient)s
+        ORDER BY timestamp DESC
+        LIMIT 1
+    """,
+    "get_reports": """
+        SELECT id, session_end
+        FROM reports
+        WHERE patient_id = %(patient)s AND session_end >= now() - interval '7 days'
+        ORDER BY session_end DESC
+    """,
+    "login_by_email": """
+        SELECT * FROM users WHERE LOWER(email) = %(email)s
+    """,
+}
+
+# Stands in for %(patient)s when the patients table is empty; patientid is a UUID
+EMPTY_DB_PATIENT_ID = "00000000-0000-0000-0000-000000000000"
+
+# Seq scans on these are fine (tiny lookup tables)
+SEQ_SCAN_ALLOWED = {"recommendations"}
+
+def _ensure_migrations_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+
+def applied_versions(cursor):
+    _ensure_migrations_table(cursor)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+CONCURRENT_INDEX = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE)
+
+def _drop_invalid_index(cursor, statement):
+    match = CONCURRENT_INDEX.search(statement)
+    if not match:
+        return
+    name = match.group(1)
+    cursor.execute("""
+        SELECT NOT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_table_is_visible(c.oid)
+    """, (name,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        print(f"⚠️ Index {name} is INVALID (an earlier build failed); rebuilding")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+def migrate():
+    conn = get_db_connection()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            # Index builds and table rewrites run far past the 30 s default of
+            # get_db_connection; a migration is never cut off halfway
+            cursor.execute("SET statement_timeout = 0")
+            done = applied_versions(cursor)
+            for version, name, statements, transactional in MIGRATIONS:
+                if version in done:
+                    continue
+                print(f"⏳ Applying migration {version}: {name}")
+                if transactional:
+                    cursor.execute("BEGIN")
+                try:
+                    for statement in statements:
+                        if not transactional:
+                            _drop_invalid_index(cursor, statement)
+                        cursor.execute(statement)
+                    cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                    if transactional:
+                        cursor.execute("COMMIT")
+                except Exception as e:
+                    if transactional:
+                        cursor.execute("ROLLBACK")
+                    print(f"❌ Migration {version} failed: {e}")
+                    raise e
+                print(f"✅ Migration {version} applied")
+    finally:
+        conn.close()
+
+def _seq_scans(plan_node):
+    """Yield relation names of every Seq Scan node in an EXPLAIN (FORMAT JSON) plan."""
+    if plan_node.get("Node Type") == "Seq Scan":
+        yield plan_node.get("Relation Name")
+    for child in plan_node.get("Plans", []):
+        yield from _seq_scans(child)
+
+def check_hot_queries():
+    conn = get_db_connection()
+    failures = []
+    try:
+        with conn.cursor() as cursor:
+            # patientid = NULL would fold to a one-time false filter and plan no scans at
+            # all, so an empty database gets a literal (nil) UUID instead
+            cursor.execute("SELECT patientid FROM patients LIMIT 1")
+            row = cursor.fetchone()
+            params = {"patient": row[0] if row else EMPTY_DB_PATIENT_ID, "email": "someone@example.com"}
+
+            # With seq scans priced out, any Seq Scan left means no usable index exists,
+            # even on a small local database where a seq scan would otherwise win.
+            cursor.execute("SET enable_seqscan = off")
+            for name, query in HOT_QUERIES.items():
+                cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                scanned = [rel for rel in _seq_scans(plan[0]["Plan"]) if rel not in SEQ_SCAN_ALLOWED]
+                if scanned:
+                    failures.append((name, scanned))
+                    print(f"❌ {name}: sequential scan on {', '.join(scanned)}")
+                else:
+                    print(f"✅ {name}: index scans only")
+        conn.rollback()
+    finally:
+        conn.close()
+    return failures
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command == "migrate":
+        migrate()
+    elif command == "check":
+        sys.exit(1 if check_hot_queries() else 0)
+    else:
+        print(f"Unknown command: {command} (expected 'migrate' or 'check')")
+        sys.exit(2)
@@ -0,0 +1,204 @@
+import os
+import re
+from datetime import datetime, timedelta, timezone
+import gevent
+from psycopg2 import sql
+from db_utils import get_db_connection
+
+# --------------------- health_vitals Partition Maintenance ---------------------------
+#
+# Works on the partitioned health_vitals created by migration 3 (see migrations.py):
+# pre-creates the next day/week partitions and detaches or drops the expired ones,
+# health_vitals_legacy included once its whole range is past retention.
+# Every gunicorn worker runs the loop; an advisory lock lets only one do the work.
+#
+# health_vitals has no foreign keys pointing at it any more, so expiring a
+# partition first deletes its temperature / respiration / ecg rows, a batch of
+# readings per transaction, then detaches it; a detached partition keeps only the
+# raw vitals. A pass cut short leaves the partition attached and the next pass
+# carries on.
+#
+# Usage:
+#   python partitions.py   # run one maintenance pass
+
+# Config
+PARTITION_INTERVAL = os.getenv("HEALTH_VITALS_PARTITION_INTERVAL", "day")          # "day" or "week"
+PARTITION_PRECREATE = int(os.getenv("PARTITION_PRECREATE", 7))                     # future partitions kept ready
+PARTITION_RETENTION_DAYS = int(os.getenv("PARTITION_RETENTION_DAYS", 0))           # 0 keeps everything
+PARTITION_EXPIRE_ACTION = os.getenv("PARTITION_EXPIRE_ACTION", "detach")           # "detach" or "drop"
+PARTITION_MAINTENANCE_INTERVAL_SEC = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL_SEC", 3600))
+PARTITION_MAINTENANCE_ENABLED = os.getenv("PARTITION_MAINTENANCE_ENABLED", "1") == "1"
+PARTITION_EXPIRE_BATCH_ROWS = int(os.getenv("PARTITION_EXPIRE_BATCH_ROWS", 5000))  # readings whose children go per DELETE
+
+PARENT_TABLE = "health_vitals"
+DEFAULT_PARTITION = "health_vitals_default"
+LEGACY_PARTITION = "health_vitals_legacy"
+CHILD_TABLES = ("temperature", "respiration", "ecg")  # rows keyed by healthvitalsid
+PARTITION_NAME = re.compile(r"^health_vitals_p(\d{8})$")
+ADVISORY_LOCK_KEY = 72_011_008  # arbitrary, shared by every worker
+
+def _period_start(day):
+    if PARTITION_INTERVAL == "week":
+        return day - timedelta(days=day.weekday())  # Monday
+    return day
+
+def _period_length():
+    return timedelta(days=7 if PARTITION_INTERVAL == "week" else 1)
+
+def _partition_name(start):
+    return f"{PARENT_TABLE}_p{start:%Y%m%d}"
+
+def _bound(day):
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+def _is_partitioned(cursor):
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relkind = 'p'", (PARENT_TABLE,))
+    return cursor.fetchone() is not None
+
+def _existing_partitions(cursor):
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = %s
+    """, (PARENT_TABLE,))
+    return {row[0] for row in cursor.fetchall()}
+
+def _legacy_upper_bound(cursor):
+    # Nothing may be created below the range already owned by health_vitals_legacy.
+    # The bound is cast to timestamptz by Postgres (session TimeZone is UTC), so it
+    # compares as an instant against the _bound() values.
+    cursor.execute("""
+        SELECT (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \\(''([^'']+)''\\)'))[1]::timestamptz
+        FROM pg_class c
+        WHERE c.relname = %s AND c.relispartition
+    """, (LEGACY_PARTITION,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def create_partition(conn, start, lower=None):
+    # `lower` (a timestamptz) trims the first partition so it begins exactly where legacy ends
+    end = _bound(start + _period_length())
+    lower = lower or _bound(start)
+    name = _partition_name(start)
+    with conn.cursor() as cursor:
+        # Rows that landed in the default partition for this range have to move
+        # first, or ATTACH would fail on the overlap.
+        cursor.execute(sql.SQL("CREATE TABLE {name} (LIKE {parent} INCLUDING DEFAULTS)").format(
+            name=sql.Identifier(name), parent=sql.Identifier(PARENT_TABLE)))
+        cursor.execute(sql.SQL("""
+            WITH moved AS (
+                DELETE FROM {default} WHERE timestamp >= %s AND timestamp < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """).format(default=sql.Identifier(DEFAULT_PARTITION), name=sql.Identifier(name)),
+            (lower, end))
+        cursor.execute(sql.SQL("ALTER TABLE {parent} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)").format(
+            parent=sql.Identifier(PARENT_TABLE), name=sql.Identifier(name)),
+            (lower, end))
+    conn.commit()
+    print(f"✅ Created partition {name} [{lower:%Y-%m-%d %H:%M} → {end:%Y-%m-%d %H:%M})")
+
+def expire_partition(conn, name):
+    deleted = dict.fromkeys(CHILD_TABLES, 0)
+    last_id = None
+    with conn.cursor() as cursor:
+        # Classified rows go first, in short transactions walking the partition's
+        # ids, so no single statement or row lock set covers the whole period
+        while True:
+            cursor.execute(sql.SQL("""
+                SELECT id FROM {name} WHERE %s IS NULL OR id > %s ORDER BY id LIMIT %s
+            """).format(name=sql.Identifier(name)), (last_id, last_id, PARTITION_EXPIRE_BATCH_ROWS))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            for child in CHILD_TABLES:
+                cursor.execute(sql.SQL("DELETE FROM {child} WHERE healthvitalsid = ANY(%s)").format(
+                    child=sql.Identifier(child)), (ids,))
+                deleted[child] += cursor.rowcount
+            conn.commit()
+            last_id = ids[-1]
+        cursor.execute(sql.SQL("ALTER TABLE {parent} DETACH PARTITION {name}").format(
+            parent=sql.Identifier(PARENT_TABLE), name=sql.Identifier(name)))
+        if PARTITION_EXPIRE_ACTION == "drop":
+            cursor.execute(sql.SQL("DROP TABLE {name}").format(name=sql.Identifier(name)))
+    conn.commit()
+    print(f"🗑️ Expired partition {name} ({PARTITION_EXPIRE_ACTION}; deleted {deleted})")
+
+def run_partition_maintenance(today=None):
+    today = today or datetime.now(timezone.utc).date()
+    try:
+        conn = get_db_connection()
+    except Exception:
+        return  # already logged; retry on the next pass
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+            if not cursor.fetchone()[0]:
+                return  # another worker is on it
+            conn.commit()
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SET TIME ZONE 'UTC'")
+                # Moving rows out of the default partition and expiring a partition's
+                # children can outlast get_db_connection's statement_timeout
+                cursor.execute("SET statement_timeout = 0")
+                if not _is_partitioned(cursor):
+                    return
+                existing = _existing_partitions(cursor)
+                legacy_upper = _legacy_upper_bound(cursor)
+            conn.commit()
+
+            # Pre-create the current period and the next PARTITION_PRECREATE ones
+            start = _period_start(today)
+            for i in range(PARTITION_PRECREATE + 1):
+                period = start + _period_length() * i
+                if legacy_upper and _bound(period + _period_length()) <= legacy_upper:
+                    continue
+                if _partition_name(period) in existing:
+                    continue
+                lower = legacy_upper if legacy_upper and _bound(period) < legacy_upper else None
+                try:
+                    create_partition(conn, period, lower)
+                    existing.add(_partition_name(period))
+                except Exception as e:
+                    conn.rollback()
+                    print(f"❌ Failed to create partition for {period}: {e}")
+
+            if PARTITION_RETENTION_DAYS > 0:
+                cutoff = today - timedelta(days=PARTITION_RETENTION_DAYS)
+                for name in sorted(existing):
+                    match = PARTITION_NAME.match(name)
+                    if match:
+                        period = datetime.strptime(match.group(1), "%Y%m%d").date()
+                        expired = _bound(period + _period_length()) <= _bound(cutoff)
+                    else:
+                        expired = name == LEGACY_PARTITION and legacy_upper is not None and legacy_upper <= _bound(cutoff)
+                    if expired:
+                        try:
+                            expire_partition(conn, name)
+                        except Exception as e:
+                            conn.rollback()
+                            print(f"❌ Failed to expire partition {name}: {e}")
+        finally:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+            conn.commit()
+    except Exception as e:
+        print(f"❌ Partition maintenance failed: {e}")
+    finally:
+        conn.close()
+
+def _maintenance_loop():
+    while True:
+        run_partition_maintenance()
+        gevent.sleep(PARTITION_MAINTENANCE_INTERVAL_SEC)
+
+def start_partition_maintenance():
+    if PARTITION_MAINTENANCE_ENABLED:
+        return gevent.spawn(_maintenance_loop)
+
+if __name__ == "__main__":
+    run_partition_maintenance()
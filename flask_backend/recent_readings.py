@@ -0,0 +1,300 @@
+import os
+import time
+from datetime import datetime, timezone
+import numpy as np
+from db_utils import register_query, fetch_prepared
+
+# --------------------- Recent Readings Ring Buffers ---------------------------
+#
+# The last RECENT_BUFFER_SIZE readings of every shirt that is streaming right now,
+# kept in fixed-size NumPy arrays and filled by the ingest writer after each commit
+# (so memory never shows readings the database does not have). Latest-value and
+# short-window endpoints read from here while a shirt is hot and fall back to SQL
+# otherwise. Shirts that stop sending are evicted after RECENT_IDLE_EVICT_SEC.
+#
+# Buffers are per gunicorn worker: a shirt's batches can be written by different
+# workers, so a buffer may miss the batch another worker wrote. Every write
+# transaction bumps the patient's row in patient_write_marker (migration 4) and
+# hands the new sequence number to the buffer after commit. A read serves from
+# memory only when one primary-key lookup of that row shows the same sequence
+# number the buffer last saw, i.e. no other worker has written since:
+#   - the latest reading / window: the vitals sequence matches and the buffer has
+#     held every reading since the window's start (a skipped sequence number, or
+#     a reading older than the ring's newest, restarts that from the next one);
+#   - the latest ECG row: the ECG sequence matches.
+
+# Config
+RECENT_BUFFER_SIZE = int(os.getenv("RECENT_BUFFER_SIZE", 1024))           # readings kept per shirt
+RECENT_HOT_SEC = int(os.getenv("RECENT_HOT_SEC", 60))                     # served from memory if written this recently
+RECENT_IDLE_EVICT_SEC = int(os.getenv("RECENT_IDLE_EVICT_SEC", 600))
+RECENT_SWEEP_INTERVAL_SEC = 30
+
+# Marker bumps run inside the writers' transactions; rows are sorted by patient
+# so concurrent writers lock them in the same order
+VITALS_MARKER_SQL = """
+    INSERT INTO patient_write_marker AS m (patientid, vitals_seq, vitals_newest_ms)
+    VALUES %s
+    ON CONFLICT (patientid) DO UPDATE
+    SET vitals_seq = m.vitals_seq + 1,
+        vitals_newest_ms = greatest(m.vitals_newest_ms, excluded.vitals_newest_ms)
+    RETURNING patientid::text, vitals_seq, vitals_newest_ms
+"""
+# The ecg table only knows the shirt, so the shirt → patient mapping happens here
+ECG_MARKER_SQL = """
+    WITH bumped AS (
+        INSERT INTO patient_write_marker AS m (patientid, ecg_seq)
+        SELECT DISTINCT patientid, 1 FROM smartshirt WHERE smartshirtid::text = ANY(%s) ORDER BY patientid
+        ON CONFLICT (patientid) DO UPDATE SET ecg_seq = m.ecg_seq + 1
+        RETURNING patientid, ecg_seq
+    )
+    SELECT s.smartshirtid::text AS shirt, b.ecg_seq, count(*) OVER (PARTITION BY b.patientid) AS shirts
+    FROM bumped b
+    JOIN smartshirt s ON s.patientid = b.patientid
+    WHERE s.smartshirtid::text = ANY(%s)
+"""
+register_query("write_marker", "SELECT vitals_seq, ecg_seq FROM patient_write_marker WHERE patientid = %s")
+
+class ShirtBuffer:
+    """Fixed-capacity ring of one shirt's readings plus its latest classifications."""
+    def __init__(self, patient_id, capacity=RECENT_BUFFER_SIZE):
+        self.patient_id = patient_id
+        self.ts_ms = np.zeros(capacity, dtype=np.int64)
+        self.ecg = np.zeros(capacity, dtype=np.int32)
+        self.resp = np.zeros(capacity, dtype=np.float32)
+        self.temp = np.zeros(capacity, dtype=np.float32)
+        self.head = 0      # next write position
+        self.count = 0
+        self.last_write = time.monotonic()
+        self.temperature_status = None   # {"temperature", "status", "disease"}
+        self.respiration_status = None   # {"respiration", "status", "disease"}
+        self.ecg_status = None           # latest row written to the ecg table
+        self.naive = False               # hand timestamps back the way the database returned them
+        self.vitals_seq = None           # patient_write_marker values after this buffer's last write
+        self.ecg_seq = None
+        self.complete_from_ms = None     # every reading from here on is in the ring (None: nothing known)
+
+    def push(self, ts_ms, ecg, resp, temp):
+        n = len(ts_ms)
+        capacity = len(self.ts_ms)
+        if n >= capacity:
+            # Only the newest `capacity` readings survive anyway
+            ts_ms, ecg, resp, temp = ts_ms[-capacity:], ecg[-capacity:], resp[-capacity:], temp[-capacity:]
+            n = capacity
+        idx = (self.head + np.arange(n)) % capacity
+        self.ts_ms[idx] = ts_ms
+        self.ecg[idx] = ecg
+        self.resp[idx] = resp
+        self.temp[idx] = temp
+        self.head = (self.head + n) % capacity
+        self.count = min(self.count + n, capacity)
+        self.last_write = time.monotonic()
+
+    def _ordered(self):
+        # Indices oldest → newest
+        capacity = len(self.ts_ms)
+        return (self.head - self.count + np.arange(self.count)) % capacity
+
+    def latest(self):
+        if not self.count:
+            return None
+        i = (self.head - 1) % len(self.ts_ms)
+        return {
+            "timestamp": _to_datetime(self.ts_ms[i], self.naive),
+            "ecg": int(self.ecg[i]),
+            "respiration_rate": round(float(self.resp[i]), 2),
+            "temperature": round(float(self.temp[i]), 2),
+        }
+
+    def newest_ms(self):
+        return int(self.ts_ms[(self.head - 1) % len(self.ts_ms)]) if self.count else None
+
+    def window(self, seconds):
+        """Readings from the last `seconds` (relative to the newest one), oldest first."""
+        idx = self._ordered()
+        if not len(idx):
+            return []
+        ts = self.ts_ms[idx]
+        keep = idx[ts >= ts[-1] - seconds * 1000]
+        return [
+            {
+                "timestamp": _to_datetime(t, self.naive),
+                "ecg": int(e),
+                "respiration_rate": round(float(r), 2),
+                "temperature": round(float(tp), 2),
+            }
+            for t, e, r, tp in zip(self.ts_ms[keep], self.ecg[keep], self.resp[keep], self.temp[keep])
+        ]
+
+    def is_hot(self):
+        return time.monotonic() - self.last_write <= RECENT_HOT_SEC
+
+    def holds_since(self, since_ms):
+        """True if the ring has every reading of the shirt from `since_ms` on."""
+        if self.complete_from_ms is None or since_ms < self.complete_from_ms:
+            return False
+        # A full ring has dropped its oldest readings
+        capacity = len(self.ts_ms)
+        return self.count < capacity or since_ms >= self.ts_ms[self.head % capacity]
+
+_buffers = {}      # smartshirt id (text) -> ShirtBuffer
+_by_patient = {}   # patient id (text) -> smartshirt id (text) of its most recently active shirt
+_last_sweep = time.monotonic()
+_stats = {"memory_hits": 0, "sql_fallbacks": 0, "stale_buffers": 0, "evicted": 0}
+
+def _to_datetime(ts_ms, naive=False):
+    dt = datetime.fromtimestamp(int(ts_ms) / 1000, tz=timezone.utc)
+    return dt.replace(tzinfo=None) if naive else dt
+
+def _epoch_ms(ts):
+    # A timestamp-without-time-zone column comes back naive; its value is UTC
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return int(ts.timestamp() * 1000)
+
+def _sweep():
+    global _last_sweep
+    now = time.monotonic()
+    if now - _last_sweep < RECENT_SWEEP_INTERVAL_SEC:
+        return
+    _last_sweep = now
+    for key in [k for k, b in _buffers.items() if now - b.last_write > RECENT_IDLE_EVICT_SEC]:
+        buffer = _buffers.pop(key)
+        if _by_patient.get(str(buffer.patient_id)) == key:
+            del _by_patient[str(buffer.patient_id)]
+        _stats["evicted"] += 1
+
+def _buffer(smartshirt_id, patient_id):
+    key = str(smartshirt_id)
+    buffer = _buffers.get(key)
+    if buffer is None:
+        buffer = _buffers[key] = ShirtBuffer(patient_id)
+    _by_patient[str(patient_id)] = key
+    return buffer
+
+def newest_epoch_ms(timestamps):
+    return max(_epoch_ms(ts) for ts in timestamps)
+
+def bump_vitals_markers(tx, newest_ms_by_patient):
+    """
+    Bump patient_write_marker for every patient a write transaction inserted
+    readings for ({patient id (text): newest reading, epoch ms}). Returns
+    {patient id (text): (vitals_seq, vitals_newest_ms)} to pass to record_readings.
+    """
+    rows = sorted((patient_id, 1, newest_ms) for patient_id, newest_ms in newest_ms_by_patient.items())
+    if not rows:
+        return {}
+    return {patient_id: (seq, newest) for patient_id, seq, newest in tx.execute_values(VITALS_MARKER_SQL, rows, fetch=True)}
+
+def bump_ecg_markers(tx, smartshirt_ids):
+    """
+    Bump patient_write_marker for the patients of shirts whose ECG rows a write
+    transaction inserted. Returns {smartshirt id (text): ecg_seq}; None for a
+    shirt whose patient had another shirt in the same write.
+    """
+    keys = sorted({str(sid) for sid in smartshirt_ids})
+    if not keys:
+        return {}
+    return {
+        row["shirt"]: row["ecg_seq"] if row["shirts"] == 1 else None
+        for row in tx.fetch_all(ECG_MARKER_SQL, (keys, keys))
+    }
+
+def record_readings(smartshirt_id, patient_id, timestamps, ecg, resp, temp,
+                    temperature_status=None, respiration_status=None, marker=None):
+    """
+    Append committed readings (any order) and the newest classifications for one
+    shirt. `marker` is the patient's (vitals_seq, vitals_newest_ms) after the
+    write, or None if unknown (then the buffer is not served until the next write).
+    """
+    _sweep()
+    ts_ms = np.fromiter((_epoch_ms(ts) for ts in timestamps), dtype=np.int64, count=len(timestamps))
+    order = np.argsort(ts_ms, kind="stable")
+    buffer = _buffer(smartshirt_id, patient_id)
+    buffer.naive = bool(timestamps) and timestamps[0].tzinfo is None
+    # Spool replays can deliver old readings; the ring only moves forward in time
+    dropped = False
+    if buffer.count:
+        newest = buffer.ts_ms[(buffer.head - 1) % len(buffer.ts_ms)]
+        kept = order[ts_ms[order] > newest]
+        dropped = len(kept) < len(order)
+        order = kept
+    if len(order):
+        buffer.push(
+            ts_ms[order],
+            np.asarray(ecg, dtype=np.int32)[order],
+            np.asarray(resp, dtype=np.float32)[order],
+            np.asarray(temp, dtype=np.float32)[order],
+        )
+    if temperature_status:
+        buffer.temperature_status = temperature_status
+    if respiration_status:
+        buffer.respiration_status = respiration_status
+
+    seq, newest_ms = marker if marker else (None, None)
+    if seq is None or buffer.vitals_seq is None or seq != buffer.vitals_seq + 1 or dropped:
+        # Another worker wrote in between, or this write had readings the ring could
+        # not take. Whatever was missed is no newer than the marker's newest reading,
+        # so only readings after it are known to be complete.
+        buffer.complete_from_ms = newest_ms + 1 if newest_ms is not None else None
+    buffer.vitals_seq = seq
+
+ECG_INTERVAL_FIELDS = ("pr", "p", "qrs", "qt", "qtc")
+
+def record_ecg_status(smartshirt_id, ecg_row, seq=None):
+    """
+    Keep the latest ECG analysis of a shirt that already has a buffer. A BPM-only
+    ("fast") row keeps the intervals of the last fully delineated one. `seq` is
+    the patient's ecg_seq after the write (None: not served until the next one).
+    """
+    buffer = _buffers.get(str(smartshirt_id))
+    if buffer is None:
+        return
+    previous = buffer.ecg_status
+    if previous and ecg_row.get("tier") == "fast":
+        ecg_row = {**ecg_row, **{key: previous.get(key) for key in ECG_INTERVAL_FIELDS}}
+    buffer.ecg_status = ecg_row
+    buffer.ecg_seq = seq
+
+def shirt_for_patient(patient_id):
+    """Smartshirt id (text) of the patient's most recently active shirt, if it has a buffer."""
+    return _by_patient.get(str(patient_id))
+
+def _fresh(buffer, patient_id, seconds, ecg):
+    if ecg:
+        if buffer.ecg_status is None or buffer.ecg_seq is None:
+            return False
+    elif not buffer.count or not buffer.holds_since(buffer.newest_ms() - seconds * 1000):
+        return False
+    try:
+        marker = fetch_prepared("write_marker", (patient_id,))
+    except Exception:
+        return False  # the SQL fallback reports the error
+    if marker is None:
+        return False
+    return marker["ecg_seq"] == buffer.ecg_seq if ecg else marker["vitals_seq"] == buffer.vitals_seq
+
+def fresh_buffer_for_patient(patient_id, seconds=0, ecg=False):
+    """
+    The ShirtBuffer of a patient's shirt if it is streaming right now and holds
+    what the database holds: the readings from `seconds` before the newest one
+    on, or with ecg=True the latest ECG row. Else None (count it as a SQL fallback).
+    """
+    key = _by_patient.get(str(patient_id))
+    buffer = _buffers.get(key) if key else None
+    if buffer is not None and buffer.is_hot():
+        if _fresh(buffer, patient_id, seconds, ecg):
+            _stats["memory_hits"] += 1
+            return buffer
+        _stats["stale_buffers"] += 1
+    _stats["sql_fallbacks"] += 1
+    return None
+
+def recent_readings_stats():
+    lookups = _stats["memory_hits"] + _stats["sql_fallbacks"]
+    return {
+        "shirts": len(_buffers),
+        "hot_shirts": sum(1 for b in _buffers.values() if b.is_hot()),
+        "capacity_per_shirt": RECENT_BUFFER_SIZE,
+        "memory_hit_rate": round(_stats["memory_hits"] / lookups, 3) if lookups else None,
+        **_stats,
+    }
@@ -0,0 +1,134 @@
+import os
+import io
+import json
+import zlib
+from werkzeug.wsgi import get_input_stream
+
+# --------------------- Compressed Request Bodies ---------------------------
+#
+# WSGI middleware that inflates `Content-Encoding: gzip` / `deflate` bodies on the
+# ingest routes before Flask sees them, so request.get_json() / get_data() work
+# unchanged. Decompression is streamed in chunks and stops as soon as the output
+# passes the size cap or the compression ratio looks like a zip bomb.
+
+# Config
+COMPRESSED_ROUTES = tuple(r for r in os.getenv("COMPRESSED_ROUTES", "/sensor,/gateway/sensor,/ecg_batch").split(",") if r)
+MAX_DECOMPRESSED_BYTES = int(os.getenv("MAX_DECOMPRESSED_BYTES", 16 * 1024 * 1024))
+MAX_COMPRESSION_RATIO = int(os.getenv("MAX_COMPRESSION_RATIO", 100))
+RATIO_CHECK_AFTER_BYTES = 1024 * 1024  # small bodies can legitimately compress very well
+READ_CHUNK_BYTES = 64 * 1024
+
+_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "x-gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+_stats = {}
+
+class BodyRejected(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _route_stats(path):
+    return _stats.setdefault(path, {
+        "requests": 0,
+        "compressed_bytes": 0,
+        "decompressed_bytes": 0,
+        "rejected": 0,
+    })
+
+def _decompressor(encoding, first_chunk):
+    if encoding == "deflate" and first_chunk and (first_chunk[0] & 0x0F) != 8:
+        # Some clients send raw DEFLATE without the zlib header
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+    return zlib.decompressobj(_WBITS[encoding])
+
+def inflate(stream, encoding):
+    """Decompress a request body stream; returns (body, compressed_bytes)."""
+    out = io.BytesIO()
+    read = 0
+    decompressor = None
+    while True:
+        chunk = stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        read += len(chunk)
+        decompressor = decompressor or _decompressor(encoding, chunk)
+        data = chunk
+        while data:
+            try:
+                # max_length bounds each step, so a bomb never inflates past the cap
+                piece = decompressor.decompress(data, MAX_DECOMPRESSED_BYTES - out.tell() + 1)
+            except zlib.error as e:
+                raise BodyRejected(400, f"Corrupt {encoding} body: {e}")
+            out.write(piece)
+            if out.tell() > MAX_DECOMPRESSED_BYTES:
+                raise BodyRejected(413, f"Decompressed body exceeds {MAX_DECOMPRESSED_BYTES} bytes")
+            if out.tell() > RATIO_CHECK_AFTER_BYTES and out.tell() > read * MAX_COMPRESSION_RATIO:
+                raise BodyRejected(413, f"Compression ratio exceeds {MAX_COMPRESSION_RATIO}:1")
+            data = decompressor.unconsumed_tail
+    if decompressor is not None:
+        out.write(decompressor.flush())
+        if out.tell() > MAX_DECOMPRESSED_BYTES:
+            raise BodyRejected(413, f"Decompressed body exceeds {MAX_DECOMPRESSED_BYTES} bytes")
+        if not decompressor.eof:
+            raise BodyRejected(400, f"Truncated {encoding} body")
+    return out.getvalue(), read
+
+class DecompressRequestMiddleware:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if not encoding or encoding == "identity" or path not in COMPRESSED_ROUTES:
+            return self.wsgi_app(environ, start_response)
+
+        stats = _route_stats(path)
+        stats["requests"] += 1
+        try:
+            if encoding not in _WBITS:
+                raise BodyRejected(415, f"Unsupported Content-Encoding: {encoding}")
+            body, compressed = inflate(get_input_stream(environ), encoding)
+        except BodyRejected as e:
+            stats["rejected"] += 1
+            print(f"⚠️ Rejected {encoding} body on {path}: {e}")
+            return self._error(start_response, e.status, str(e))
+
+        stats["compressed_bytes"] += compressed
+        stats["decompressed_bytes"] += len(body)
+
+        # Hand Flask a plain body
+        environ["wsgi.input"] = io.BytesIO(body)
+        environ["CONTENT_LENGTH"] = str(len(body))
+        environ.pop("HTTP_CONTENT_ENCODING", None)
+        return self.wsgi_app(environ, start_response)
+
+    @staticmethod
+    def _error(start_response, status, message):
+        reasons = {400: "BAD REQUEST", 413: "REQUEST ENTITY TOO LARGE", 415: "UNSUPPORTED MEDIA TYPE"}
+        payload = json.dumps({"error": message}).encode()
+        start_response(f"{status} {reasons[status]}", [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(payload))),
+        ])
+        return [payload]
+
+def compression_stats():
+    result = {}
+    for path, s in _stats.items():
+        ratio = s["decompressed_bytes"] / s["compressed_bytes"] if s["compressed_bytes"] else None
+        result[path] = {**s, "ratio": round(ratio, 2) if ratio else None}
+    return result
+
+def metrics_text():
+    """Prometheus counters of compressed vs decompressed request bytes per route."""
+    lines = []
+    for key in ("requests", "compressed_bytes", "decompressed_bytes", "rejected"):
+        lines.append(f"# TYPE request_body_{key}_total counter")
+        for path, s in _stats.items():
+            lines.append(f'request_body_{key}_total{{route="{path}"}} {s[key]}')
+    return "\n".join(lines) + "\n"
@@ -1,3 +1,5 @@
+import numpy as np
+
 def classify_temp(tempF, age, gender):
     """
     Classify temperature based on age and gender.
@@ -98,3 +100,49 @@ def classify_ecg_bpm(bpm, age, gender):
 
     # Fallback
     return {"status": "Normal", "disease": None}
+
+# === Vectorized classification for batch ingest ===
+# Same thresholds as the scalar functions above, applied to a whole batch of one
+# patient's readings at once. Each returns (statuses, diseases) as object arrays.
+# Non-finite values (NaN / inf) are classified as a disconnected sensor.
+
+TEMP_STATUSES = np.array(["Sensor Disconnected", "Low", "Below Normal", "Normal", "Elevated", "High", "Very High", "Critical"], dtype=object)
+TEMP_DISEASES = np.array([None, "Hypothermia", None, None, None, "Fever", "Hyperthermia", "Hyperpyrexia"], dtype=object)
+
+RESP_STATUSES = np.array(["Sensor Disconnected", "Slow", "Rapid", "Normal"], dtype=object)
+RESP_DISEASES = np.array([None, "Bradypnea", "Tachypnea", None], dtype=object)
+
+def classify_temp_batch(tempsF, age, gender):
+    temps = np.asarray(tempsF, dtype=float)
+
+    if age >= 60:
+        normal_low, normal_high = 96.0, 98.5
+    elif gender == "Female":
+        normal_low, normal_high = 97.2, 99.2
+    else:
+        normal_low, normal_high = 96.8, 98.8
+
+    index = np.select(
+        [~np.isfinite(temps) | (temps == -100.0), temps < 95.0, temps < normal_low, temps <= normal_high,
+         temps <= 100.4, temps <= 104.0, temps <= 107.0],
+        [0, 1, 2, 3, 4, 5, 6],
+        default=7,
+    )
+    return TEMP_STATUSES[index], TEMP_DISEASES[index]
+
+def classify_respiration_batch(resps, age):
+    resps = np.asarray(resps, dtype=float)
+
+    if age < 40:
+        normal_low, normal_high = 12, 18
+    elif age < 60:
+        normal_low, normal_high = 14, 18
+    else:
+        normal_low, normal_high = 14, 20
+
+    index = np.select(
+        [~np.isfinite(resps) | (resps <= 0), resps < normal_low, resps > normal_high],
+        [0, 1, 2],
+        default=3,
+    )
+    return RESP_STATUSES[index], RESP_DISEASES[index]
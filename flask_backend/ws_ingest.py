@@ -0,0 +1,174 @@
+import os
+from collections import deque
+from flask import request
+from flask_socketio import SocketIO, ConnectionRefusedError
+from binary_ingest import decode_sensor_payload, ECG_DTYPE
+from demographics_cache import get_shirt_demographics
+from ecg_realtime_processor import process_ecg_batch
+from ecg_pool import ECG_RETRY_AFTER_SEC
+import numpy as np
+
+# --------------------- WebSocket Ingest Channel ---------------------------
+#
+# Socket.IO namespace /ingest: one long-lived stream per shirt session carrying
+# the same readings as /sensor and the same ECG windows as /ecg_batch, without
+# a new HTTP request (and TLS handshake, and JSON envelope) every few seconds.
+#
+# Connect with auth {"patient_id", "smartshirt_id"}; the shirt must be registered
+# to that patient. A second connection for the same shirt replaces the first.
+#
+# Every frame carries a client sequence number and is answered through the
+# Socket.IO ack callback:
+#   emit("readings", {"seq": 7, "readings": [{timestamp, ecg_raw, respiration, temperature}, ...]})
+#   emit("readings", {"seq": 8, "data": <binary /sensor body, see binary_ingest>})
+#   emit("ecg",      {"seq": 9, "ecg_values": [...]} or {"seq": 9, "samples": <uint16 bytes>},
+#                    plus "offset": index of the first sample in the shirt's ECG stream)
+#   → ack {"seq": 7, "status": "batch_received" | "spooled" | "duplicate" | "retry" | "error", ...}
+#     ("ecg" frames ack "queued" | "skipped" | "duplicate" | "retry"; analysis runs in ecg_pool)
+# A frame acked "retry" (ingest backpressure) should be resent with the same seq
+# after `retry_after` seconds; a resent seq that was already acked is not re-ingested.
+#
+# WebSocket transport only (clients must connect with transports: ['websocket']).
+# gunicorn runs WEB_CONCURRENCY workers with no sticky sessions, and HTTP
+# long-polling sends each poll of one Socket.IO session as a separate request
+# that may land on a worker that never saw the handshake. A WebSocket is a single
+# connection, so the session and its state stay on one worker.
+
+WS_INGEST_NAMESPACE = "/ingest"
+WS_ACK_HISTORY = int(os.getenv("WS_ACK_HISTORY", 1024))  # seqs remembered per stream for resends
+
+socketio = SocketIO(async_mode="gevent", cors_allowed_origins="*", transports=["websocket"])
+
+_sessions = {}   # sid -> {"ids", "acked"}
+_streams = {}    # smartshirt id (text) -> sid
+_ingest = None   # app's ingest_readings(batch, ids) -> (result, http status)
+_stats = {"connects": 0, "refused": 0, "replaced": 0, "frames": 0, "rows": 0, "ecg_frames": 0, "duplicate_frames": 0}
+
+def init_app(app, ingest_readings):
+    """Attach the namespace to the Flask app; frames go through `ingest_readings`, like /sensor."""
+    global _ingest
+    _ingest = ingest_readings
+    socketio.init_app(app)
+
+@socketio.on("connect", namespace=WS_INGEST_NAMESPACE)
+def on_connect(auth):
+    auth = auth or {}
+    patient_id, smartshirt_id = auth.get("patient_id"), auth.get("smartshirt_id")
+    if patient_id is None or smartshirt_id is None:
+        _stats["refused"] += 1
+        raise ConnectionRefusedError("patient_id and smartshirt_id are required")
+
+    try:
+        shirt = get_shirt_demographics(smartshirt_id)
+    except Exception as e:
+        _stats["refused"] += 1
+        print(f"❌ WebSocket ingest lookup failed for shirt {smartshirt_id}: {e}")
+        raise ConnectionRefusedError("Shirt lookup unavailable, retry later")
+    if not shirt or str(shirt["patient_id"]) != str(patient_id):
+        _stats["refused"] += 1
+        print(f"⚠️ WebSocket ingest refused: shirt {smartshirt_id} is not registered to patient {patient_id}")
+        raise ConnectionRefusedError("SmartShirt is not registered to this patient")
+
+    # One stream per shirt; a reconnecting phone takes over from its stale socket
+    key = str(smartshirt_id)
+    previous = _streams.get(key)
+    if previous and previous in _sessions:
+        _stats["replaced"] += 1
+        socketio.server.disconnect(previous, namespace=WS_INGEST_NAMESPACE)
+
+    _streams[key] = request.sid
+    _sessions[request.sid] = {
+        "ids": {
+            "patient_id": shirt["patient_id"],
+            "smartshirt_id": smartshirt_id,
+            "age": shirt["age"],
+            "gender": shirt["gender"],
+        },
+        "acked": deque(maxlen=WS_ACK_HISTORY),
+    }
+    _stats["connects"] += 1
+    print(f"🔌 WebSocket ingest connected: shirt {smartshirt_id} (sid {request.sid})")
+
+@socketio.on("disconnect", namespace=WS_INGEST_NAMESPACE)
+def on_disconnect():
+    session = _sessions.pop(request.sid, None)
+    if session:
+        key = str(session["ids"]["smartshirt_id"])
+        if _streams.get(key) == request.sid:
+            del _streams[key]
+        print(f"🔌 WebSocket ingest disconnected: shirt {key}")
+
+def _frame(data):
+    """Common frame checks; returns (session, seq, None), or an ack to send back instead."""
+    session = _sessions.get(request.sid)
+    if session is None:
+        return None, None, {"status": "error", "error": "Not connected"}
+    if not isinstance(data, dict) or "seq" not in data:
+        return None, None, {"status": "error", "error": "Frame needs a seq"}
+    seq = data["seq"]
+    _stats["frames"] += 1
+    if seq in session["acked"]:
+        _stats["duplicate_frames"] += 1
+        return None, seq, {"seq": seq, "status": "duplicate"}
+    return session, seq, None
+
+@socketio.on("readings", namespace=WS_INGEST_NAMESPACE)
+def on_readings(data):
+    session, seq, ack = _frame(data)
+    if ack:
+        return ack
+    ids = session["ids"]
+    try:
+        if "data" in data:
+            batch, _ = decode_sensor_payload(data["data"])  # the session decides whose readings these are
+        else:
+            batch = data["readings"]
+            if not isinstance(batch, list):
+                raise ValueError("'readings' must be a list")
+    except (ValueError, KeyError) as e:
+        return {"seq": seq, "status": "error", "error": str(e)}
+    if not len(batch):
+        return {"seq": seq, "status": "batch_received", "count": 0}
+
+    result, status = _ingest(batch, ids)
+    if status == 400:
+        # Nothing in the frame was valid; resending it will not help
+        session["acked"].append(seq)
+        return {"seq": seq, "status": "error", **result}
+    if status != 200:
+        return {"seq": seq, "status": "retry", "retry_after": result.get("retry_after"), "error": result.get("error")}
+    session["acked"].append(seq)
+    _stats["rows"] += len(batch)
+    return {"seq": seq, **result}
+
+@socketio.on("ecg", namespace=WS_INGEST_NAMESPACE)
+def on_ecg(data):
+    session, seq, ack = _frame(data)
+    if ack:
+        return ack
+    ids = session["ids"]
+    try:
+        if "samples" in data:
+            ecg_values = np.frombuffer(data["samples"], dtype=ECG_DTYPE)
+        else:
+            ecg_values = data["ecg_values"]
+        outcome = process_ecg_batch([{
+            "smartshirt_id": ids["smartshirt_id"],
+            "age": ids["age"],
+            "gender": ids["gender"],
+            "ecg_values": ecg_values,
+            "offset": data.get("offset"),
+        }])
+    except (TypeError, ValueError, KeyError) as e:
+        # A malformed frame is dropped; resending it will not help
+        session["acked"].append(seq)
+        return {"seq": seq, "status": "error", "error": str(e)}
+
+    if outcome["rejected"]:
+        return {"seq": seq, "status": "retry", "retry_after": ECG_RETRY_AFTER_SEC, "error": "ECG analysis unavailable"}
+    session["acked"].append(seq)
+    _stats["ecg_frames"] += 1
+    return {"seq": seq, "status": "queued" if outcome["queued"] else "skipped"}
+
+def ws_ingest_stats():
+    return {"open_streams": len(_streams), **_stats}
@@ -19,6 +19,7 @@ class ShirtWebSocketService {
   late Function(Map<String, dynamic>) _onRealtimeUpdate;
   DateTime? _startTimestamp; // To track the start time when data begins
   DateTime? _bufferReachedTimestamp; // To track the time when buffer reaches 500
+  int _ecgOffset = 0; // Index of _ecgBuffer[0] in this session's ECG stream
 
   ShirtWebSocketService({
     required this.patientId,
@@ -210,12 +211,15 @@ class ShirtWebSocketService {
     final gender = prefs.getString("gender") ?? "Male";
     final age = int.tryParse(prefs.getString("age") ?? "0") ?? 0;
 
+    // Readings keep arriving during the request; only drop the ones sent
+    final ecgValues = _ecgBuffer.map((reading) => reading["ecg_raw"]).toList();
     final ecgPayload = [
       {
         "smartshirt_id": smartshirtId,
         "age": age,
         "gender": gender,
-        "ecg_values": _ecgBuffer.map((reading) => reading["ecg_raw"]).toList(),
+        "ecg_values": ecgValues,
+        "offset": _ecgOffset, // lets the backend join consecutive chunks safely
       }
     ];
 
@@ -226,9 +230,11 @@ class ShirtWebSocketService {
         body: jsonEncode(ecgPayload),
       );
 
-      if (response.statusCode == 200) {
+      // 202: queued for analysis
+      if (response.statusCode == 200 || response.statusCode == 202) {
         print("✅ [ECG Flush] Success (${ecgPayload.length} entries)");
-        _ecgBuffer.clear();
+        _ecgOffset += ecgValues.length;
+        _ecgBuffer.removeRange(0, ecgValues.length);
       } else {
         print("❌ [ECG Flush] Failed: ${response.body}");
       }